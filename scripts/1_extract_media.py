@@ -2,74 +2,124 @@
 STEP 1 in media analysis pipeline: extract media from Twitter corpus
 """
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import csv
 import re
 from urllib.parse import urlparse
 
+import numpy as np
 import pandas as pd
 from urlextract import URLExtract
 from tqdm import tqdm
 
+from link_store import add_link_store_arguments, open_link_store
+from tweet_files import get_base_name, iter_corpus
+
+
+URL_PATTERN = re.compile(r'((http|ftp|https):\/\/([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:\/~+#-]*[\w@?^=%&\/~+#-]))', re.DOTALL)
+T_CO_PATTERN = re.compile(r'.*(https?://t.co/[a-zA-Z0-9]+).*')
+LINK_COLUMNS = ['tweet_id', 'created_at', 'user_screen_name', 'tweet_retweet_count']
+
 
 def extract_urls(text):
-	pattern = re.compile(r'((http|ftp|https):\/\/([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:\/~+#-]*[\w@?^=%&\/~+#-]))', re.DOTALL)
-	tco_pattern = re.compile(r'.*(https?://t.co/[a-zA-Z0-9]+).*')
-	urls = [x[0] for x in re.findall(pattern, text)]
 	final_urls = []
-	for url in urls:
+	for url, *_ in URL_PATTERN.findall(text):
 		if url.startswith('https://t.co') or url.startswith('http://t.co'):
-			url = tco_pattern.match(url)[1]
+			t_co = T_CO_PATTERN.match(url)
+			if t_co is not None:
+				url = t_co[1]
 		final_urls.append(url)
 	return final_urls
 
 
-def get_data_per_tweet(corpus_df):
-	data = []
-	total_rows = len(corpus_df)
-	for row in tqdm(corpus_df.itertuples(), total=total_rows):
-		urls = extract_urls(row.text)
-		for url in urls:
-			data.append({
-				'tweet_id': row.tweet_id,
-				'created_at': row.created_at,
-				'user_screen_name': row.user_screen_name,
-				'tweet_retweet_count': row.tweet_retweet_count,
-				'url': url,
-			})
-	return pd.DataFrame(data)
+def get_links(chunk):
+	"""One row per URL in the text of every tweet of the chunk (in tweet order), with the tweet's LINK_COLUMNS"""
+	urls = [extract_urls(text) for text in chunk['text'].fillna('').astype(str).tolist()]
+	rows = np.repeat(np.arange(len(chunk)), [len(tweet_urls) for tweet_urls in urls])
+	links = chunk[LINK_COLUMNS].take(rows).reset_index(drop=True)
+	links['url'] = [url for tweet_urls in urls for url in tweet_urls]
+	return links
 
 
 def prep_for_reanalyze(tweet_data_df):
 	df = tweet_data_df[['url', 'user_screen_name', 'tweet_retweet_count']]
 	df = df.assign(total_tweets_in_set=1)
-	df = df.groupby(['url', 'user_screen_name']).sum().reset_index()
-	return df.assign(expanded_url='', domain='', error_expanding=True)
+	return df.groupby(['url', 'user_screen_name']).sum()
 
 
-def process_data_df(args):
-	file_name = args['corpus_filename']
-	sep = args['csv_sep']
+def process_chunk(chunk):
+	"""Links of a chunk and their partial (url, user_screen_name) sums, run in a worker process with --workers"""
+	links = get_links(chunk)
+	return links, prep_for_reanalyze(links)
 
-	print(f'Reading corpus from {file_name}...')
-	corpus_df = pd.read_csv(file_name, encoding='utf-8', sep=sep)
 
-	print(f'Getting links from tweets...')
-	tweet_data_df = get_data_per_tweet(corpus_df)
+def merge_partials(partials):
+	return pd.concat(partials).groupby(level=['url', 'user_screen_name']).sum()
 
-	save_file_name = file_name.removesuffix('.csv') + '_tweet_links' + '.csv'
-	print(f'Saving links from tweets to {save_file_name}...')
-	tweet_data_df.reset_index(drop=True, inplace=True)
-	tweet_data_df.to_csv(save_file_name, mode='w+',index=True, encoding='utf-8', quoting=csv.QUOTE_NONNUMERIC)
 
-	reanalyze_save_file_name = file_name.removesuffix('.csv') + '_dictionary' + '.csv'
+def process_data_df(args):
+	file_name = args['corpus_filename']
+	sep = args['csv_sep']
+	chunksize = args['chunk_size']
+	workers = args['workers']
+	store = open_link_store(args)
+	if store is not None:
+		store.drop('tweet_links')
+
+	save_file_name = get_base_name(file_name) + '_tweet_links' + '.csv'
+	print(f'Getting links from tweets of {file_name}, saving them to {save_file_name}...')
+	reader = iter_corpus(file_name, chunksize, sep, columns=LINK_COLUMNS + ['text'])
+	partials = []
+	with open(save_file_name, 'w', encoding='utf-8', newline='') as file, tqdm(unit='tweets') as progress:
+		pd.DataFrame(columns=LINK_COLUMNS + ['url']).to_csv(file, index=True, quoting=csv.QUOTE_NONNUMERIC)
+		link_count = 0
+
+		def save_links(links, partial, tweet_count):
+			# appended as they come, the index keeps counting across chunks like a single DataFrame's
+			nonlocal link_count
+			links.index += link_count
+			links.to_csv(file, header=False, index=True, quoting=csv.QUOTE_NONNUMERIC)
+			link_count += len(links)
+			if store is not None:
+				store.append('tweet_links', links)
+			partials.append(partial)
+			if len(partials) >= 16:
+				partials[:] = [merge_partials(partials)]
+			progress.update(tweet_count)
+
+		if workers > 1:
+			# chunks are extracted in parallel, their links are saved in file order
+			with ProcessPoolExecutor(max_workers=workers) as executor:
+				pending = deque()
+				for chunk in reader:
+					pending.append((executor.submit(process_chunk, chunk), len(chunk)))
+					if len(pending) >= 2 * workers:
+						future, tweet_count = pending.popleft()
+						save_links(*future.result(), tweet_count)
+				while pending:
+					future, tweet_count = pending.popleft()
+					save_links(*future.result(), tweet_count)
+		else:
+			for chunk in reader:
+				save_links(*process_chunk(chunk), len(chunk))
+	print(f'Saved {link_count} links from tweets to {save_file_name}')
+	if store is not None:
+		store.index('tweet_links')
+
+	reanalyze_save_file_name = get_base_name(file_name) + '_dictionary' + '.csv'
 	print(f'Saving url dictionary data (for reanalyze) {reanalyze_save_file_name}...')
-	reanalyze_df = prep_for_reanalyze(tweet_data_df)
+	reanalyze_df = merge_partials(partials).reset_index()
+	reanalyze_df = reanalyze_df.assign(expanded_url='', domain='', error_expanding=True)
 	reanalyze_df.to_csv(reanalyze_save_file_name, mode='w+',index=False, encoding='utf-8', quoting=csv.QUOTE_NONNUMERIC)
+	if store is not None:
+		print(f'Saving tweet links and url dictionary to {store.path}...')
+		store.replace('dictionary', [reanalyze_df])
+		store.close()
 
 	print('Done!')
 
 
-
 if __name__ == '__main__':
 	pd.options.mode.chained_assignment = None
 	p = argparse.ArgumentParser(description='Get and aggregate data for Media URL metrics (more granular than get_metrics.py)')
@@ -78,7 +128,7 @@ if __name__ == '__main__':
 		'--corpus-filename',
 		type=str,
 		required=True,
-		help='Full or relative path to the corpus csv file. E.g. results/my_data.csv',
+		help='Full or relative path to the corpus csv file (or parquet directory). E.g. results/my_data.csv',
 	)
 	p.add_argument(
 		'--csv-sep',
@@ -87,5 +137,20 @@ if __name__ == '__main__':
 		choices=[',', ';', '\\t', '|'],
 		help='Separator for your csv files. Default: ","',
 	)
+	p.add_argument(
+		'-c',
+		'--chunk-size',
+		type=int,
+		default=100000,
+		help='Size of processing chunk, the corpus is read and its links are saved chunk by chunk. Default: 100K rows',
+	)
+	p.add_argument(
+		'-w',
+		'--workers',
+		type=int,
+		default=1,
+		help='Number of processes extracting links from chunks in parallel. Default: 1',
+	)
+	add_link_store_arguments(p)
 	args = vars(p.parse_args())
 	process_data_df(args)
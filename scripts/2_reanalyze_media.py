@@ -4,104 +4,281 @@ STEP 2 IN MEDIA PIPELINE
 import asyncio
 import argparse
 import csv
+import json
+import os
+from pathlib import Path
 import re
 import requests
+import shutil
+import sys
+import time
 from urllib.parse import urlparse
 
-import aiohttp
 import pandas as pd
 
+from link_store import add_link_store_arguments, open_link_store
+from url_cache import add_url_cache_arguments, open_url_cache
+from url_expander import add_url_expander_arguments, get_url_expander
+
 
 async def reanalyze(args):
 
 	file_name = args['filename']
 	max_redirect_depth = args['max_redirect_depth']
 	chunksize = args['chunk_size']
+	parts_dir = file_name + '.parts'
+	manifest = load_manifest(parts_dir, file_name, chunksize)
+	url_cache = open_url_cache(args)
+	expander = await get_url_expander(args).open()
+	hop_stats = HopStats(args['max_bytes_per_hop'])
 
-	df = pd.read_csv(file_name, encoding='utf-8')
-
-	if 'url' not in df:
-		print('URL column is required to re-analyze. Aborting.')
-		return
-
-	df_records = df.to_dict(orient='records')
 	print('Re-analyzing media URLs for error_expanding == True')
+	part_count = 0
+	for index, chunk in enumerate(pd.read_csv(file_name, encoding='utf-8', chunksize=chunksize)):
+		if 'url' not in chunk:
+			print('URL column is required to re-analyze. Aborting.')
+			await expander.close()
+			if url_cache is not None:
+				url_cache.close()
+			return
+		i = index * chunksize
+		part_count = index + 1
+		if str(index) in manifest['parts']:
+			print(f'Rows from {i} to {i+chunksize} were re-analyzed before, skipping')
+			continue
 
-	tmp_file_name = file_name + '.tmp'
-	mode = 'w+'
-	expanded_df_records = []
-	for i in range(0, len(df_records), chunksize):
 		print(f'Analyzing rows from {i} to {i+chunksize}')
-		chunk = df_records[i:i+chunksize]
-		expanded_chunk = await expand_media_urls(chunk, max_redirect_depth)
-		expanded_df_records.extend(expanded_chunk)
-		print('--> writing tmp data...')
-		tmp_df = pd.DataFrame.from_records(expanded_chunk)
-		header = True if mode != 'a' else False
-		tmp_df.to_csv(tmp_file_name, mode=mode, index=False, header=header, encoding='utf-8', errors='backslashreplace', quoting=csv.QUOTE_NONNUMERIC)
-		mode = 'a'
-	print('Done processing!')
-	print('Overwriting original file..')
-	result_df = pd.DataFrame.from_records(expanded_df_records)
-	print(f'Writing raw data to {file_name}...')
-	result_df.to_csv(file_name, mode='w+',index=False, encoding='utf-8', errors='backslashreplace', quoting=csv.QUOTE_NONNUMERIC)
+		expanded_chunk, saved = await expand_media_urls(chunk.to_dict(orient='records'), max_redirect_depth, expander, url_cache, hop_stats)
+		result_df = pd.DataFrame.from_records(expanded_chunk)
+		print('--> checkpointing...')
+		write_part(parts_dir, index, result_df)
+		manifest['parts'][str(index)] = {
+			'errors_before': int((chunk.error_expanding == True).sum()),
+			'errors_after': int((result_df.error_expanding == True).sum()),
+			'saved_requests': saved,
+		}
+		save_manifest(parts_dir, manifest)
+
+	saved_requests = sum(x['saved_requests'] for x in manifest['parts'].values())
+	print(f'Done processing! Deduplicating URLs saved {saved_requests} expansions.')
+	await expander.close()
+	expander.report()
+	hop_stats.report()
+	if url_cache is not None:
+		url_cache.close()
+		url_cache.report()
+
+	print(f'Overwriting original file {file_name} with {part_count} re-analyzed parts...')
+	merge_parts(parts_dir, part_count, file_name)
+	store = open_link_store(args)
+	if store is not None:
+		print(f'Replacing the url dictionary of {store.path}...')
+		store.replace('dictionary', pd.read_csv(file_name, encoding='utf-8', chunksize=chunksize))
+		store.close()
 
 	# grouped_filename = file_name.removesuffix('.csv') + '_grouped' + '.csv'
 	# print(f'Writing grouped data by URL to {grouped_filename}...')
 	# result_df.groupby("expanded_url").sum().reset_index().to_csv(f'{grouped_filename}', mode='w+',index=False, errors='backslashreplace', encoding='utf-8', quoting=csv.QUOTE_NONNUMERIC)
 
-	errors_before = len(df[df.error_expanding == True])
-	errors_after = len(result_df[result_df.error_expanding == True])
+	errors_before = sum(x['errors_before'] for x in manifest['parts'].values())
+	errors_after = sum(x['errors_after'] for x in manifest['parts'].values())
 	print(f'Done! Errors before: {errors_before} & errors after: {errors_after}.')
 
 
-async def expand_media_urls(df_records, max_redirect_depth):
+def get_file_fingerprint(file_name):
+	stat = os.stat(file_name)
+	return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_manifest(parts_dir, file_name, chunksize):
+	"""Checkpoint of a previous (interrupted) run on the same, unchanged file with the same chunk size, or a new one"""
+	manifest = {'source': get_file_fingerprint(file_name), 'chunk_size': chunksize, 'parts': {}}
+	manifest_file_name = os.path.join(parts_dir, 'manifest.json')
+	if os.path.isfile(manifest_file_name):
+		with open(manifest_file_name, encoding='utf-8') as file:
+			saved = json.load(file)
+		if saved['source'] == manifest['source'] and saved['chunk_size'] == chunksize:
+			print(f'Resuming: {len(saved["parts"])} chunks were already re-analyzed (checkpoints in {parts_dir})')
+			return saved
+		print(f'WARNING: {file_name} or --chunk-size changed since the checkpoints in {parts_dir} were made. Starting over.')
+		shutil.rmtree(parts_dir)
+	Path(parts_dir).mkdir(parents=True, exist_ok=True)
+	return manifest
+
+
+def write_atomic(file_name, write):
+	tmp_file_name = file_name + '.tmp'
+	write(tmp_file_name)
+	os.replace(tmp_file_name, file_name)
+
+
+def save_manifest(parts_dir, manifest):
+	def write(tmp_file_name):
+		with open(tmp_file_name, 'w', encoding='utf-8') as file:
+			json.dump(manifest, file)
+	write_atomic(os.path.join(parts_dir, 'manifest.json'), write)
+
+
+def get_part_file_name(parts_dir, index):
+	return os.path.join(parts_dir, f'part_{index:06d}.csv')
+
+
+def write_part(parts_dir, index, df):
+	write_atomic(get_part_file_name(parts_dir, index), lambda tmp_file_name: df.to_csv(
+		tmp_file_name, mode='w+', index=False, encoding='utf-8', errors='backslashreplace', quoting=csv.QUOTE_NONNUMERIC))
+
+
+def merge_parts(parts_dir, part_count, file_name):
+	def write(tmp_file_name):
+		with open(tmp_file_name, 'w', encoding='utf-8', newline='') as file:
+			for index in range(part_count):
+				with open(get_part_file_name(parts_dir, index), encoding='utf-8', newline='') as part:
+					header = part.readline()
+					if index == 0:
+						file.write(header)
+					shutil.copyfileobj(part, file)
+	write_atomic(file_name, write)
+	shutil.rmtree(parts_dir)
+
+
+async def expand_media_urls(df_records, max_redirect_depth, expander, url_cache=None, hop_stats=None):
 	result_records = []
-	async with aiohttp.ClientSession() as session:
-		tasks = []
-		for row in df_records:
-			if str(row['error_expanding']).lower() == 'true':
-				tasks.append(asyncio.ensure_future(expand_url(session, row, max_redirect_depth)))
-			else:
-				result_records.append(row)
-		skipped = len(result_records)
-		print(f'Skipped re-analysis for {skipped} rows as error_expanding == False')
-		expanded_rows = await asyncio.gather(*tasks)
-	result_records.extend(expanded_rows)
-	return result_records
+	to_expand = []
+	for row in df_records:
+		if str(row['error_expanding']).lower() == 'true':
+			to_expand.append(row)
+		else:
+			result_records.append(row)
+	skipped = len(result_records)
+	print(f'Skipped re-analysis for {skipped} rows as error_expanding == False')
+
+	# the dictionary has a row per (url, user), so resolve every distinct url once and copy the result to all its rows
+	rows_by_url = {}
+	for row in to_expand:
+		rows_by_url.setdefault(row['url'], []).append(row)
+	saved = len(to_expand) - len(rows_by_url)
+	print(f'Expanding {len(rows_by_url)} distinct URLs for {len(to_expand)} rows (saved {saved} requests by deduplication)')
+
+	expanded_urls = []
+	cached = url_cache.get_many(list(rows_by_url), max_redirect_depth) if url_cache is not None else {}
+	tasks = []
+	for url in rows_by_url:
+		if url in cached:
+			expanded_urls.append((url,) + cached[url])
+		else:
+			tasks.append(asyncio.ensure_future(expand_url(expander, url, max_redirect_depth, url_cache, hop_stats)))
+	expanded_urls.extend(await asyncio.gather(*tasks))
+	if url_cache is not None:
+		url_cache.flush()
+	for url, expanded, error, domain in expanded_urls:
+		for row in rows_by_url[url]:
+			row['error_expanding'] = error
+			row['expanded_url'] = expanded
+			row['domain'] = domain
+			result_records.append(row)
+	return result_records, saved
+
+
+T_CO_TARGET = re.compile(rb'(?P<url>https?://[^\s]+)"')
+WHITESPACE = re.compile(rb'\s')
+
 
+class HopStats:
+	"""Hop latency of expand_url, and bytes read/skipped when resolving t.co pages"""
+	def __init__(self, max_bytes_per_hop=65536):
+		self.max_bytes_per_hop = max_bytes_per_hop
+		self.hops = 0
+		self.hop_time = 0.0
+		self.pages = 0
+		self.from_header = 0
+		self.cut_short = 0
+		self.bytes_read = 0
+		self.bytes_saved = 0
 
-async def expand_url(session, row, max_redirect_depth):
-	url = row['url']
+	def add_hop(self, latency):
+		self.hops += 1
+		self.hop_time += latency
+
+	async def read_t_co_target(self, response):
+		"""
+		Target of a t.co link, from the Location header or else the first URL of the page (meta refresh)
+		The page is read in small pieces and only until that URL shows up, or max_bytes_per_hop is reached
+		"""
+		self.pages += 1
+		location = response.headers.get('location')
+		if location:
+			self.from_header += 1
+			return location
+		body = b''
+		searched = 0  # only search up to the last whitespace, so a match can't change as the page keeps coming
+		async for data in response.content.iter_chunked(4096):
+			body += data
+			last_whitespace = max((m.start() for m in WHITESPACE.finditer(body, searched)), default=-1)
+			if last_whitespace >= 0:
+				match = T_CO_TARGET.search(body, 0, last_whitespace)
+				searched = last_whitespace
+				if match is not None:
+					return self.stop_reading(response, body, match)
+			if len(body) >= self.max_bytes_per_hop:
+				return self.stop_reading(response, body, T_CO_TARGET.search(body))
+		self.bytes_read += len(body)
+		match = T_CO_TARGET.search(body)
+		return match.group('url').decode('utf-8', errors='replace') if match is not None else None
+
+	def stop_reading(self, response, body, match):
+		self.bytes_read += len(body)
+		if not response.content.at_eof():
+			self.cut_short += 1
+			if response.content_length is not None:
+				self.bytes_saved += max(0, response.content_length - len(body))
+		return match.group('url').decode('utf-8', errors='replace') if match is not None else None
+
+	def report(self):
+		if not self.hops:
+			return
+		print(f'Redirect hops: {self.hops}, avg hop latency {self.hop_time / self.hops:.2f}s')
+		if self.pages:
+			print(f't.co pages: {self.pages} ({self.from_header} answered by Location header, {self.cut_short} read partially), '
+				f'{self.bytes_read} bytes read, {self.bytes_saved} bytes not downloaded')
+
+
+async def expand_url(expander, url, max_redirect_depth, url_cache=None, hop_stats=None):
+	hop_stats = hop_stats or HopStats()
 	expanded = ''
 	domain = ''
 	redirect = 0
 	next_url = url
+	chain = []
+	complete = False
+	start = time.perf_counter()
 	headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
 	try:
 		while redirect < max_redirect_depth:
+			hop_start = time.perf_counter()
 			if next_url.startswith('https://t.co/'):
-				async with session.get(next_url, allow_redirects=False, headers=headers) as response:
-					body = await response.text()
-					next_url = re.search("(?P<url>https?://[^\s]+)\"", body).group('url')
+				status, _, next_url = await expander.fetch('GET', next_url, read=hop_stats.read_t_co_target, allow_redirects=False, headers=headers)
+				hop_stats.add_hop(time.perf_counter() - hop_start)
+				if next_url is None:
+					break
 			else:
-				async with session.head(next_url, allow_redirects=False, headers=headers) as res:
-					next_url = res.headers.get('location', res.headers.get('X-Redirect-To',''))
+				status, response_headers, _ = await expander.fetch('HEAD', next_url, allow_redirects=False, headers=headers)
+				hop_stats.add_hop(time.perf_counter() - hop_start)
+				next_url = response_headers.get('location', response_headers.get('X-Redirect-To',''))
 			if next_url == '':
+				complete = True
 				break
 			if next_url.startswith('/'):
 				next_url =  'https://' + domain + next_url
 			expanded = next_url
 			domain = urlparse(expanded).netloc or domain  # if no domain, keep last known domain
+			chain.append(expanded)
 			redirect += 1
 	except Exception:
 		pass
 	error = expanded == ''
-	expanded_row = row
-	expanded_row['error_expanding'] = error
-	expanded_row['expanded_url'] = expanded
-	expanded_row['domain'] = domain
-	return expanded_row
+	if url_cache is not None:
+		url_cache.add(url, chain, complete, time.perf_counter() - start)
+	return url, expanded, error, domain
 
 
 if __name__ == '__main__':
@@ -118,7 +295,7 @@ if __name__ == '__main__':
 		'--chunk-size',
 		type=int,
 		default=10000,
-		help='Size of processing chunk. Default: 10K rows'
+		help='Size of processing chunk, every finished chunk is checkpointed so an interrupted run can be resumed. Default: 10K rows'
 	)
 	p.add_argument(
 		'--max-redirect-depth',
@@ -126,7 +303,17 @@ if __name__ == '__main__':
 		default=1,
 		help='Max depth to follow redirects when analyzing URLs. Default is the minimum: 1 (get link after t.co). WARNING: exponentially slower with each added layer of depth'
 	)
+	p.add_argument(
+		'--max-bytes-per-hop',
+		type=int,
+		default=65536,
+		help='Max bytes read from a t.co page while looking for its target URL. Default: 64KB'
+	)
+	add_url_cache_arguments(p)
+	add_url_expander_arguments(p)
+	add_link_store_arguments(p)
 
 	args = vars(p.parse_args())
-	asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+	if sys.platform == 'win32':
+		asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 	asyncio.run(reanalyze(args))
@@ -3,161 +3,76 @@ STEP THREE IN MEDIA PIPELINE
 """
 import argparse
 import csv
-from urllib.parse import urlparse, parse_qs, urljoin, urlencode
+from urllib.parse import urlparse, parse_qs
 
 import pandas as pd
-import tldextract
 from tqdm import tqdm
 import requests
 
-UNWANTED_QUERIES = [
-	'utm_source',
-	'utm_medium',
-	'utm_campaign',
-	'utm_term',
-	'utm_content',
-	'utm_int',
-	'_utm_source',
-	'_utm_medium',
-	'_utm_campaign',
-	'_utm_term',
-	'_utm_content',
-	'_utm_int',
-	'fbclid',
-	'gclid',
-	'ocid',
-	'ref',
-	'language',
-	'from',
-	'device',
-	'_gl',
-	'iref',
-	'locale',
-	'reflink',
-	'cx_fm',
-	'cx_ml',
-	'cx_mdate',
-	'source',
-	'display',
-	'fm',
-	'tag',
-	'recruiter',
-	'sns',
-	'igshid',
-	'dicbo',
-	'vlang',
-	'share_id',
-	'feature',
-	'highlight',
-]
-
-REDIRECTS = [
-	('https://approach.yahoo.co.jp', 'src'),
-	('https://pt.afl.rakuten.co.jp/c/', 'pc'),
-	('https://hb.afl.rakuten.co.jp', 'pc'),
-	('https://al.dmm.com/', 'lurl'),
-	('https://mixi.jp/redirect_with_owner_id.pl', 'b'),
-]
-
-QUERYLESS_URLS = ['twitcasting.tv','nikkei.com','sankei.com', 'tiktok.com', 'tumblr.com', 'change.org', 'dailyshincho.jp']
-
-def get_domain(url):
-	extracted = tldextract.extract(url)
-	return f'{extracted.domain}.{extracted.suffix}'
-
-
-def get_subdomain(url):
-	subdomain = tldextract.extract(url).subdomain
-	return subdomain if subdomain != 'www' else ''
-
-
-def get_suffix(url):
-	extracted = tldextract.extract(url)
-	return extracted.suffix
-
-
-def follow_google(url):
-	parsed_url = urlparse(url)
-	query = parse_qs(parsed_url.query)
-	domain = get_domain(url)
+from link_store import add_link_store_arguments, open_link_store
+from public_suffix import add_public_suffix_arguments, open_public_suffix_list
+from url_rules import DEFAULT_RULES_FILE, URLRules
+
 
-	if domain.startswith('google.com') and (parsed_url.path == '/url' or parsed_url.path == '/news/url') and 'url' in query:
-		return query['url'][0]
+def get_url_parts(url, public_suffixes):
+	"""(root_domain, sub_domain, suffix) of url"""
+	subdomain, domain, suffix = public_suffixes.extract(url)
+	return f'{domain}.{suffix}', subdomain if subdomain != 'www' else '', suffix
 
-	return url
 
-def clean_queries(row):
-	url = row['expanded_url']
+def follow_google(parsed_url, root_domain):
+	"""Target of a Google redirect URL, or None"""
+	if root_domain.startswith('google.com') and (parsed_url.path == '/url' or parsed_url.path == '/news/url'):
+		query = parse_qs(parsed_url.query)
+		if 'url' in query:
+			return query['url'][0]
+	return None
+
+
+def decompose_url(url, rules, public_suffixes):
+	"""(canonical url, root_domain, sub_domain, suffix) of an expanded URL"""
 	parsed_url = urlparse(url)
-	query = parse_qs(parsed_url.query)
-
-	# 1. youtube
-	if 'youtube' in row['root_domain'] and 'v' in query:
-		v_id = query['v'][0]
-		return f'https://youtube.com/watch?v={v_id}'
-	if row['root_domain'] == 'youtu.be':
-		v_id = parsed_url.path[1:]
-		return f'https://youtube.com/watch?v={v_id}'
-
-	# 2. direct redirect from URL
-	if row['root_domain'] == 'ampshare.org' and 'ampshare' in query:
-		url = query['ampshare'][0]
+	parts = get_url_parts(url, public_suffixes)
+	google_target = follow_google(parsed_url, parts[0])
+	if google_target is not None:
+		url = google_target
 		parsed_url = urlparse(url)
-		query = parse_qs(parsed_url.query)
-	for prefix, query_keyword in REDIRECTS:
-		if url.startswith(prefix) and query_keyword in query:
-			url = query[query_keyword][0]
-			parsed_url = urlparse(url)
-			query = parse_qs(parsed_url.query)
-			break
-
-	# 3. Remove Campaign info
-	if url == parsed_url.path:
-		queryless_url = url
-	else:
-		queryless_url = urljoin(url, parsed_url.path)
-	if not queryless_url.endswith('/'):
-		queryless_url += '/'
-	if row['root_domain'].startswith('amazon.') or row['root_domain'] in QUERYLESS_URLS:
-		return queryless_url
-	if query:
-		for unwanted_query in UNWANTED_QUERIES:
-			if unwanted_query in query:
-				query.pop(unwanted_query)
-		if 'page' in query and query['page'][0] == '1':
-			query.pop('page')
-		if query:
-			querystring = urlencode(query, doseq=True)
-			return queryless_url + f'?{querystring}'
-	return queryless_url
+		parts = get_url_parts(url, public_suffixes)
+	return (requests.utils.unquote(rules.canonicalize(url, parsed_url, parts[0])),) + parts
 
 
 def process_expanded_df(args):
 	file_name = args['dictionary_filename']
+	rules = URLRules.load(args['rules'])
+	public_suffixes = open_public_suffix_list(args)
 
 	print(f'Reading expanded URL data from {file_name}...')
 	expanded_df = pd.read_csv(file_name, encoding='utf-8')
 
-	print(f'Following Google redirect URLs...')
-	expanded_df['expanded_url'] = expanded_df['expanded_url'].apply(follow_google)
-
-	print(f'Getting root domains...')
-	expanded_df['root_domain'] = expanded_df['expanded_url'].apply(get_domain)
-
-	print(f'Getting subdomains...')
-	expanded_df['sub_domain'] = expanded_df['expanded_url'].apply(get_subdomain)
-
-	print(f'Getting suffixes...')
-	expanded_df['suffix'] = expanded_df['expanded_url'].apply(get_suffix)
-
-	print(f'Cleaning links...')
-	expanded_df['expanded_url'] = expanded_df.apply(clean_queries, axis=1)
-	expanded_df['expanded_url'] = expanded_df['expanded_url'].apply(requests.utils.unquote)
+	# the dictionary has a row per (url, user): decompose every distinct expanded URL once and map it back to its rows
+	codes, unique_urls = pd.factorize(expanded_df['expanded_url'])
+	unique_urls = list(unique_urls)
+	missing = codes == -1
+	if missing.any():  # missing URLs are decomposed (and fail) like any other, instead of being dropped
+		codes[missing] = len(unique_urls)
+		unique_urls.append(expanded_df['expanded_url'][missing].iloc[0])
+	print(f'Following Google redirects, getting domains and cleaning links for {len(unique_urls)} distinct URLs ({len(expanded_df)} rows)...')
+	decomposed = pd.DataFrame.from_records(
+		[decompose_url(url, rules, public_suffixes) for url in tqdm(unique_urls)],
+		columns=['expanded_url', 'root_domain', 'sub_domain', 'suffix'],
+	)
+	for column in decomposed:
+		expanded_df[column] = decomposed[column].values[codes]
 	expanded_df = expanded_df[['url', 'expanded_url',  'user_screen_name', 'domain', 'root_domain', 'sub_domain', 'suffix', 'total_tweets_in_set']]
 	
 	save_file_name = file_name.removesuffix('.csv') + '_processed' + '.csv'
 	print(f'Saving URL dictionary data to {save_file_name}...')
 	expanded_df.to_csv(save_file_name, mode='w+',index=False, encoding='utf-8', quoting=csv.QUOTE_NONNUMERIC)
+	store = open_link_store(args)
+	if store is not None:
+		print(f'Saving processed URL dictionary to {store.path}...')
+		store.replace('processed', [expanded_df])
+		store.close()
 
 	print('Done!')
 
@@ -173,5 +88,14 @@ if __name__ == '__main__':
 		required=True,
 		help='Full or relative path to the dictionary csv file. E.g. results/my_data.csv',
 	)
+	p.add_argument(
+		'-r',
+		'--rules',
+		type=str,
+		default=DEFAULT_RULES_FILE,
+		help='Path to JSON file with URL cleaning rules (redirects, tracking queries, per-domain rules). Default: url_rules.json next to this script',
+	)
+	add_public_suffix_arguments(p)
+	add_link_store_arguments(p)
 	args = vars(p.parse_args())
 	process_expanded_df(args)
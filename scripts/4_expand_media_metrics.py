@@ -4,8 +4,13 @@ STEP FOUR IN MEDIA PIPELINE
 import argparse
 import csv
 
+import numpy as np
 import pandas as pd
 
+from link_store import add_link_store_arguments, open_link_store
+from rollup import Cells, combine_keys, encode_key, split_keys
+from time_buckets import GRANULARITIES, PERIOD_NAMES, format_buckets, get_date_levels
+
 
 def add_archive_links(merged_df):
 	print('Adding archive.org links...')
@@ -23,13 +28,36 @@ def add_archive_links(merged_df):
 
 	print('> generating column')
 	# generate column
-	unique_df['archive_url'] = unique_df.apply(
-		lambda x: 'https://web.archive.org/web/' + str(x['created_at'].year) + '%02d' % x['created_at'].month + '%02d' % x['created_at'].day + '/' + str(x['expanded_url']),
-		axis=1,
-	)
+	archive_dates = format_buckets(unique_df['created_at'], 'D', lambda days: days.strftime('%Y%m%d'))
+	unique_df['archive_url'] = 'https://web.archive.org/web/' + archive_dates + '/' + unique_df['expanded_url'].astype(str)
 	return unique_df
 
 
+def aggregate_rows(keys, users, retweet_counts):
+	"""Cells (see rollup.py) of the rows per combined keys, with retweet and tweet sums and distinct users"""
+	valid, combined = combine_keys(keys)
+	user_codes, user_uniques = users
+	return Cells.from_rows(
+		combined[valid],
+		{'tweet_retweet_count': retweet_counts.fillna(0).values[valid], 'total_tweets_in_set': np.ones(valid.sum())},
+		{'user_screen_name': (user_codes[valid], user_uniques)},
+	)
+
+
+def get_group_df(columns, values, cells, retweet_dtype):
+	"""
+	Same frame as grouping by columns and aggregating
+	{'user_screen_name': 'nunique', 'tweet_retweet_count': sum, 'total_tweets_in_set': sum} (1 per row)
+	"""
+	group_df = dict(zip(columns, values))
+	group_df['user_screen_name'] = cells.count_distinct('user_screen_name')
+	group_df['tweet_retweet_count'] = cells.sums['tweet_retweet_count']
+	if pd.api.types.is_integer_dtype(retweet_dtype):
+		group_df['tweet_retweet_count'] = group_df['tweet_retweet_count'].astype(retweet_dtype)
+	group_df['total_tweets_in_set'] = cells.sums['total_tweets_in_set'].astype(np.int64)
+	return pd.DataFrame(group_df)
+
+
 def save_df(df, file_name, suffix, index=False):
 	save_file_name = file_name.removesuffix('.csv') + suffix + '.csv'
 	print(f'Saving data to {save_file_name}...')
@@ -41,72 +69,67 @@ def expand_media_metrics(args):
 	processed_expanded_file_name = args['dictionary_filename']
 	output_filename = args['output_filename']
 
-	print(f'Reading tweet links csv from {data_per_tweet_file_name}...')
-	tweet_data_df = pd.read_csv(data_per_tweet_file_name, encoding='utf-8')
-	tweet_data_df.created_at = pd.to_datetime(tweet_data_df.created_at)
+	store = open_link_store(args)
+	if store is not None:
+		print(f'Joining tweet links with the processed URL dictionary in {store.path}...')
+		merged_df = store.join_links('processed')
+		store.close()
+		merged_df = merged_df.rename(columns={'row_id': 'Unnamed: 0'})  # the index column of the _tweet_links csv
+		merged_df.created_at = pd.to_datetime(merged_df.created_at)
+	else:
+		print(f'Reading tweet links csv from {data_per_tweet_file_name}...')
+		tweet_data_df = pd.read_csv(data_per_tweet_file_name, encoding='utf-8')
+		tweet_data_df.created_at = pd.to_datetime(tweet_data_df.created_at)
 
-	print(f'Reading URL dictionary data from {processed_expanded_file_name}...')
-	expanded_df = pd.read_csv(processed_expanded_file_name, encoding='utf-8')
+		print(f'Reading URL dictionary data from {processed_expanded_file_name}...')
+		expanded_df = pd.read_csv(processed_expanded_file_name, encoding='utf-8')
 
-	merged_df = tweet_data_df.merge(expanded_df, how='left', on=['url', 'user_screen_name'])
+		merged_df = tweet_data_df.merge(expanded_df, how='left', on=['url', 'user_screen_name'])
 	if 'total_tweets_in_set' in merged_df:
 		merged_df = merged_df.drop(columns=['total_tweets_in_set'])
 
 	archived_df = add_archive_links(merged_df)
 	save_df(archived_df, output_filename, '_with_archived_links')
 
-	if args['split_by_hour']:
-		merged_df['date'] = merged_df.apply(lambda x: str(x.created_at.month) + '/' + str(x.created_at.day) + '/' + str(x.created_at.year) + ' ' + str(x.created_at.hour) + ':00:00', axis=1)
-	elif args['split_by_day']:
-		merged_df['date'] = merged_df.apply(lambda x: str(x.created_at.month) + '/' + str(x.created_at.day) + '/' + str(x.created_at.year), axis=1)
-	else:
-		merged_df['date'] = merged_df.apply(lambda x: str(x.created_at.month) + '/' + str(x.created_at.year), axis=1)
-
-	merged_df = merged_df.assign(total_tweets_in_set=1)
 	print('Excluding all twitter.com data...')
 	merged_df = merged_df[merged_df['root_domain'] != 'twitter.com']
 
+	# keys are encoded once, then every grouping set is aggregated from the codes
+	merged_df['sub_domain'] = merged_df['sub_domain'] + '.' + merged_df['root_domain']
+	keys = {column: encode_key(merged_df[column]) for column in ['expanded_url', 'root_domain', 'sub_domain']}
+	users = encode_key(merged_df['user_screen_name'])
+	retweet_counts = merged_df['tweet_retweet_count']
+
 	## ALL TIME
 	# 1. group by URL, all time stats
-	group_df = merged_df[['user_screen_name', 'tweet_retweet_count', 'total_tweets_in_set', 'expanded_url']]
-	group_df = group_df.groupby('expanded_url').agg({'user_screen_name': 'nunique', 'tweet_retweet_count': sum, 'total_tweets_in_set': sum}).reset_index()
-	save_df(group_df, output_filename, '_group_by_url_all_time')
-
 	# 2. group by root domain, all time stats
-	group_df = merged_df[['user_screen_name', 'tweet_retweet_count', 'total_tweets_in_set', 'root_domain']]
-	group_df = group_df.groupby('root_domain').agg({'user_screen_name': 'nunique', 'tweet_retweet_count': sum, 'total_tweets_in_set': sum}).reset_index()
-	save_df(group_df, output_filename, '_group_by_root_domain_all_time')
-
 	# 3. group by sub domain, all time stats
-	group_df = merged_df[['user_screen_name', 'tweet_retweet_count', 'total_tweets_in_set', 'sub_domain', 'root_domain']]
-	group_df = group_df[group_df['sub_domain'].notna()]
-	group_df['sub_domain'] = group_df.apply(lambda x: x['sub_domain'] + '.' +  x['root_domain'], axis=1)
-	group_df = group_df.drop(columns=['root_domain'])
-	group_df = group_df.groupby('sub_domain').agg({'user_screen_name': 'nunique', 'tweet_retweet_count': sum, 'total_tweets_in_set': sum}).reset_index()
-	save_df(group_df, output_filename, '_group_by_subdomain_all_time')
-
-	# ------------
-
-	## BY MONTH
-
+	for column, suffix in [('expanded_url', '_group_by_url_all_time'), ('root_domain', '_group_by_root_domain_all_time'), ('sub_domain', '_group_by_subdomain_all_time')]:
+		cells = aggregate_rows([keys[column]], users, retweet_counts)
+		save_df(get_group_df([column], split_keys(cells.keys, [keys[column]]), cells, retweet_counts.dtype), output_filename, suffix)
 
+	## BY MONTH (or day/hour)
 	# 4. group by root domain, over time stats
-	group_df = merged_df[['user_screen_name', 'tweet_retweet_count', 'total_tweets_in_set', 'root_domain', 'date']]
-	group_df = group_df.groupby(['root_domain', 'date']).agg({'user_screen_name': 'nunique', 'tweet_retweet_count': sum, 'total_tweets_in_set': sum}).reset_index()
-	save_df(group_df, output_filename, '_group_by_root_domain_by_month_year')
-
-	# 5. group by sub domain, all time stats
-	group_df = merged_df[['user_screen_name', 'tweet_retweet_count', 'total_tweets_in_set', 'sub_domain', 'root_domain', 'date']]
-	group_df = group_df[group_df['sub_domain'].notna()]
-	group_df['sub_domain'] = group_df.apply(lambda x: x['sub_domain'] + '.' +  x['root_domain'], axis=1)
-	group_df = group_df.drop(columns=['root_domain'])
-	group_df = group_df.groupby(['sub_domain', 'date']).agg({'user_screen_name': 'nunique', 'tweet_retweet_count': sum, 'total_tweets_in_set': sum}).reset_index()
-	save_df(group_df, output_filename, '_group_by_subdomain_by_month_year')
-
-	# 6. group by URL, all time stats
-	group_df = merged_df[['user_screen_name', 'tweet_retweet_count', 'total_tweets_in_set', 'expanded_url', 'date']]
-	group_df = group_df.groupby(['expanded_url', 'date']).agg({'user_screen_name': 'nunique', 'tweet_retweet_count': sum, 'total_tweets_in_set': sum}).reset_index()
-	save_df(group_df, output_filename, '_group_by_url_by_month_year')
+	# 5. group by sub domain, over time stats
+	# 6. group by URL, over time stats
+	# rows are aggregated per hour once, then hours are rolled up to every requested granularity
+	if args['all_granularities']:
+		granularities = GRANULARITIES
+	else:
+		granularities = ['hour' if args['split_by_hour'] else 'day' if args['split_by_day'] else 'month']
+	hours, hour_codes, date_levels = get_date_levels(merged_df.created_at, granularities, args['timezone'])
+	for column, suffix in [('root_domain', '_group_by_root_domain_by_month_year'), ('sub_domain', '_group_by_subdomain_by_month_year'), ('expanded_url', '_group_by_url_by_month_year')]:
+		hour_cells = aggregate_rows([keys[column], (hour_codes, hours)], users, retweet_counts)
+		groups, hour = np.divmod(hour_cells.keys, max(len(hours), 1))
+		for granularity in granularities:
+			label_codes, labels = date_levels[granularity]
+			cells = hour_cells.rollup(groups * len(labels) + label_codes[hour])
+			values = split_keys(cells.keys // len(labels), [keys[column]]) + [labels.take(cells.keys % len(labels))]
+			group_df = get_group_df([column, 'date'], values, cells, retweet_counts.dtype)
+			if len(granularities) > 1:
+				save_df(group_df, output_filename, '_' + PERIOD_NAMES[granularity] + suffix)
+			else:
+				save_df(group_df, output_filename, suffix)
 
 	print('Done!')
 
@@ -119,15 +142,13 @@ if __name__ == '__main__':
 		'-lf',
 		'--tweet-links-filename',
 		type=str,
-		required=True,
-		help='Full or relative path to the tweet links csv file from extract_media.py. E.g. results/my_data.csv',
+		help='Full or relative path to the tweet links csv file from extract_media.py (required without --store). E.g. results/my_data.csv',
 	)
 	p.add_argument(
 		'-df',
 		'--dictionary-filename',
 		type=str,
-		required=True,
-		help='Full or relative path to the processed URL dictionary csv file from process_url_dictionary.py. E.g. results/my_data.csv',
+		help='Full or relative path to the processed URL dictionary csv file from process_url_dictionary.py (required without --store). E.g. results/my_data.csv',
 	)
 	p.add_argument(
 		'-of',
@@ -146,5 +167,19 @@ if __name__ == '__main__':
 		action='store_true',
 		help='Use this to group dates by hour (month/day/year HH:00:00).',
 	)
+	p.add_argument(
+		'--all-granularities',
+		action='store_true',
+		help='Use this to group dates by month, day and hour in a single run (files get a _monthly/_daily/_hourly suffix).',
+	)
+	p.add_argument(
+		'-tz',
+		'--timezone',
+		type=str,
+		help='Timezone to convert dates to before grouping them (archive.org links stay in UTC) e.g. Asia/Tokyo (Optional)',
+	)
+	add_link_store_arguments(p)
 	args = vars(p.parse_args())
+	if args['store'] is None and (args['tweet_links_filename'] is None or args['dictionary_filename'] is None):
+		p.error('--tweet-links-filename and --dictionary-filename are required without --store')
 	expand_media_metrics(args)
@@ -1,16 +1,102 @@
 import argparse
+import numpy as np
 import pandas as pd
 import csv
 
-import tldextract
+from link_store import add_link_store_arguments, open_link_store
+from public_suffix import add_public_suffix_arguments, open_public_suffix_list
+from rollup import Cells, combine_keys, encode_key
+from tweet_files import read_corpus
+from time_buckets import GRANULARITIES, PERIOD_NAMES, get_date_levels
 
 
-def get_domain(url):
+def get_domain(url, public_suffixes):
 	if type(url) is str:
-		return tldextract.extract(url).domain
+		return public_suffixes.extract(url)[1]
 	return ''
 
 
+def aggregate_by_date(final_df, granularities, timezone=None):
+	"""
+	{granularity: (frame grouped by date and has_external_link, frame grouped by date)}, both aggregated with
+	{'tweet_id': 'nunique', 'user_screen_name': 'nunique', 'tweet_retweet_count': 'sum'} and rolled up from hourly cells
+	"""
+	hours, hour_codes, date_levels = get_date_levels(final_df.created_at, granularities, timezone)
+	links = encode_key(final_df['has_external_link'])
+	link_count = max(len(links[1]), 1)
+	retweet_counts = final_df['tweet_retweet_count']
+	hour_cells = Cells.from_rows(
+		combine_keys([(hour_codes, hours), links])[1],
+		{'tweet_retweet_count': retweet_counts.fillna(0).values},
+		{'tweet_id': encode_key(final_df['tweet_id']), 'user_screen_name': encode_key(final_df['user_screen_name'])},
+	)
+	hour, link = np.divmod(hour_cells.keys, link_count)
+
+	def get_grouped(cells, keys):
+		grouped = dict(keys)
+		grouped['tweet_id'] = cells.count_distinct('tweet_id')
+		grouped['user_screen_name'] = cells.count_distinct('user_screen_name')
+		grouped['tweet_retweet_count'] = cells.sums['tweet_retweet_count']
+		if pd.api.types.is_integer_dtype(retweet_counts):
+			grouped['tweet_retweet_count'] = grouped['tweet_retweet_count'].astype(retweet_counts.dtype)
+		return pd.DataFrame(grouped)
+
+	result = {}
+	for granularity in granularities:
+		label_codes, labels = date_levels[granularity]
+		cells = hour_cells.rollup(label_codes[hour] * link_count + link)
+		date_codes = cells.keys // link_count
+		grouped = get_grouped(cells, [('date', labels.take(date_codes)), ('has_external_link', links[1].take(cells.keys % link_count))])
+		total_cells = cells.rollup(date_codes)
+		result[granularity] = (grouped, get_grouped(total_cells, [('date', labels.take(total_cells.keys))]))
+	return result
+
+
+USER_PROFILE_COLUMNS = ['user_screen_name', 'user_description', 'user_following_count', 'user_followers_count']
+
+
+def get_user_stats(corpus):
+	"""
+	Tweets and retweets of every user_id with/without external links and in total, with their latest profile fields
+	(taken from the tweets without external links, unless that value is missing or 0)
+	"""
+	user_df = corpus[['tweet_id', 'user_screen_name', 'tweet_retweet_count', 'has_external_link', 'user_description', 'user_following_count', 'user_followers_count', 'user_id', 'created_at']]
+	user_df.created_at = pd.to_datetime(user_df.created_at)
+	user_df = user_df.sort_values('created_at')
+	user_df = user_df.drop(columns=['created_at'])
+
+	grouped = user_df.groupby(['user_id', 'has_external_link']).agg({
+		'tweet_id': 'nunique',
+		'tweet_retweet_count': 'sum',
+		'user_screen_name': 'last',
+		'user_description': 'last',
+		'user_following_count': 'last',
+		'user_followers_count': 'last',
+	})
+	grouped = grouped.rename(columns={'tweet_id': 'tweets_in_set'})
+	has_external_link = grouped.index.get_level_values('has_external_link').values.astype(bool)
+	# users with external links first, then the users without any (the order of an outer merge of the two sides)
+	with_ids = grouped.index.get_level_values('user_id')[has_external_link]
+	without_ids = grouped.index.get_level_values('user_id')[~has_external_link]
+	user_ids = with_ids.append(without_ids[~without_ids.isin(with_ids)])
+	with_external = grouped[has_external_link].droplevel('has_external_link').reindex(user_ids).fillna(0)
+	without_external = grouped[~has_external_link].droplevel('has_external_link').reindex(user_ids).fillna(0)
+
+	user_stats = pd.DataFrame({'user_id': user_ids})
+	for side, suffix in [(with_external, '_with_external'), (without_external, '_without_external')]:
+		for column in ['tweets_in_set', 'tweet_retweet_count']:
+			user_stats[column + suffix] = side[column].values
+	for column in USER_PROFILE_COLUMNS:
+		# values are boxed like in a row-wise apply, so the column gets the same dtype
+		with_values = with_external[column].values.astype(object)
+		without_values = without_external[column].values.astype(object)
+		user_stats[column] = pd.Series(np.where(without_values == 0, with_values, without_values).tolist())
+	totals = grouped.groupby(level='user_id')[['tweet_retweet_count', 'tweets_in_set']].sum().reindex(user_ids)
+	user_stats['tweet_retweet_count_total'] = totals['tweet_retweet_count'].values
+	user_stats['tweets_in_set_total'] = totals['tweets_in_set'].values
+	return user_stats
+
+
 def get_all_tweet_stats(args):
 	corpus_filename = args['corpus_filename']
 	dictionary_filename = args['dictionary_filename']
@@ -18,8 +104,8 @@ def get_all_tweet_stats(args):
 	output_filename = args['output_filename']
 	csv_sep = args['csv_sep']
 
-	print(f'Reading corpus csv from {corpus_filename}...')
-	corpus = pd.read_csv(corpus_filename, sep=csv_sep)
+	print(f'Reading corpus from {corpus_filename}...')
+	corpus = read_corpus(corpus_filename, sep=csv_sep)
 
 	# drop accidental duplicates in corpus
 	before = len(corpus)
@@ -29,22 +115,38 @@ def get_all_tweet_stats(args):
 	if diff > 0:
 		print(f'> found {diff} duplicates in corpus, dropped them in-memory (input file was not affected).')
 
-	print(f'Reading dictionary csv from {dictionary_filename}...')
-	dictionary_df = pd.read_csv(dictionary_filename)
+	store = open_link_store(args)
+	if store is not None:
+		print(f'Reading url dictionary from {store.path}...')
+		dictionary_df = store.read('dictionary', ['url', 'expanded_url'])
+	else:
+		print(f'Reading dictionary csv from {dictionary_filename}...')
+		dictionary_df = pd.read_csv(dictionary_filename)
 
 	print(f'> getting domains without suffixes for all dictionary expanded URLs...')
-	dictionary_df['_domain'] = dictionary_df['expanded_url'].apply(get_domain)
+	public_suffixes = open_public_suffix_list(args)
+	dictionary_df['_domain'] = dictionary_df['expanded_url'].apply(get_domain, args=(public_suffixes,))
 
-	print(f'Reading tweet links csv from {tweet_links_filename}...')
-	tweet_links_df = pd.read_csv(tweet_links_filename)
+	if store is not None:
+		print(f'> getting tweet_ids for all tweets linking to external media (excluding twitter links) from {store.path}...')
+		# a link is external unless every dictionary row of its url is a twitter one, like in the left merge below
+		is_twitter = (dictionary_df['_domain'] == 'twitter').groupby(dictionary_df['url']).all()
+		external_tweet_ids = store.get_tweet_ids_without_urls(is_twitter.index[is_twitter])
+		store.close()
+	else:
+		print(f'Reading tweet links csv from {tweet_links_filename}...')
+		tweet_links_df = pd.read_csv(tweet_links_filename)
 
-	print(f'> getting tweet_ids for all tweets linking to external media...')
-	merged_df = tweet_links_df.merge(dictionary_df[['url', '_domain']], on='url', how='left')
+		print(f'> getting tweet_ids for all tweets linking to external media...')
+		merged_df = tweet_links_df.merge(dictionary_df[['url', '_domain']], on='url', how='left')
 
-	print(f'> excluding all twitter links from analysis..')
-	merged_df = merged_df[merged_df['_domain'] != 'twitter']
+		print(f'> excluding all twitter links from analysis..')
+		merged_df = merged_df[merged_df['_domain'] != 'twitter']
+		external_tweet_ids = merged_df.tweet_id
 
-	corpus['has_external_link'] = corpus['tweet_id'].isin(merged_df.tweet_id)
+	if corpus['tweet_id'].dtype == object:  # string ids of a parquet corpus, the tweet links csv has numbers
+		external_tweet_ids = external_tweet_ids.astype(str)
+	corpus['has_external_link'] = corpus['tweet_id'].isin(external_tweet_ids)
 	
 	print(f'Constructing final dataframe...')
 	final_df = corpus[['tweet_id', 'user_screen_name', 'tweet_retweet_count', 'created_at', 'has_external_link']]
@@ -55,31 +157,31 @@ def get_all_tweet_stats(args):
 
 	print(f'Constructing grouped dataframe...')
 	final_df.created_at = pd.to_datetime(final_df.created_at)
-	if args['split_by_hour']:
-		final_df['date'] = final_df.apply(lambda x: str(x.created_at.month) + '/' + str(x.created_at.day) + '/' + str(x.created_at.year) + ' ' + str(x.created_at.hour) + ':00:00', axis=1)
-	elif args['split_by_day']:
-		final_df['date'] = final_df.apply(lambda x: str(x.created_at.month) + '/' + str(x.created_at.day) + '/' + str(x.created_at.year), axis=1)
+	# rows are aggregated per hour once, then hours are rolled up to every requested granularity
+	if args['all_granularities']:
+		granularities = GRANULARITIES
 	else:
-		final_df['date'] = final_df.apply(lambda x: str(x.created_at.month) + '/' + str(x.created_at.year), axis=1)
-
-	grouped = final_df.groupby(['date', 'has_external_link']).agg({'tweet_id': 'nunique', 'user_screen_name': 'nunique', 'tweet_retweet_count': 'sum'}).reset_index()
-	grouped = grouped.rename(columns={'tweet_id': 'tweets_in_set'})
-	grouped_split = grouped[grouped.has_external_link].drop(
-		columns=['has_external_link'],
-	).merge(
-		grouped[~grouped.has_external_link].drop(columns=['has_external_link']),
-		on='date',
-		suffixes=('_with_external', '_without_external'),
-		how='outer',
-	).fillna(0)
-	grouped = final_df.drop(columns=['has_external_link']).groupby(['date']).agg({'tweet_id': 'nunique', 'user_screen_name': 'nunique', 'tweet_retweet_count': 'sum'}).reset_index()
-	grouped = grouped.rename(columns={'tweet_id': 'tweets_in_set'})
-	grouped = grouped.add_suffix('_total').rename(columns={'date_total': 'date'})
-	grouped = grouped_split.merge(grouped, on='date', how='outer').fillna(0)
+		granularities = ['hour' if args['split_by_hour'] else 'day' if args['split_by_day'] else 'month']
+	for granularity, (grouped, grouped_total) in aggregate_by_date(final_df, granularities, args['timezone']).items():
+		grouped = grouped.rename(columns={'tweet_id': 'tweets_in_set'})
+		grouped_split = grouped[grouped.has_external_link].drop(
+			columns=['has_external_link'],
+		).merge(
+			grouped[~grouped.has_external_link].drop(columns=['has_external_link']),
+			on='date',
+			suffixes=('_with_external', '_without_external'),
+			how='outer',
+		).fillna(0)
+		grouped = grouped_total.rename(columns={'tweet_id': 'tweets_in_set'})
+		grouped = grouped.add_suffix('_total').rename(columns={'date_total': 'date'})
+		grouped = grouped_split.merge(grouped, on='date', how='outer').fillna(0)
 
-	save_file_name = output_filename.removesuffix('.csv') + '_grouped' + '.csv'
-	print(f'Saving dataframe to {save_file_name}...')
-	grouped.to_csv(save_file_name, mode='w+', index=False, encoding='utf-8', quoting=csv.QUOTE_NONNUMERIC)
+		if len(granularities) > 1:
+			save_file_name = output_filename.removesuffix('.csv') + '_' + PERIOD_NAMES[granularity] + '_grouped' + '.csv'
+		else:
+			save_file_name = output_filename.removesuffix('.csv') + '_grouped' + '.csv'
+		print(f'Saving dataframe to {save_file_name}...')
+		grouped.to_csv(save_file_name, mode='w+', index=False, encoding='utf-8', quoting=csv.QUOTE_NONNUMERIC)
 
 
 	print(f'Extracting stats...')
@@ -104,48 +206,7 @@ def get_all_tweet_stats(args):
 
 
 	print('Getting user stats...')
-	user_df = corpus[['tweet_id', 'user_screen_name', 'tweet_retweet_count', 'has_external_link', 'user_description', 'user_following_count', 'user_followers_count', 'user_id', 'created_at']]
-	user_df.created_at = pd.to_datetime(user_df.created_at)
-	user_df = user_df.sort_values('created_at')
-	user_df = user_df.drop(columns=['created_at'])
-
-	user_df = user_df.groupby(['user_id', 'has_external_link']).agg({
-		'tweet_id': 'nunique',
-		'tweet_retweet_count': 'sum',
-		'user_screen_name': 'last',
-		'user_description': 'last',
-		'user_following_count': 'last',
-		'user_followers_count': 'last',
-	}).reset_index()
-	user_df = user_df.rename(columns={'tweet_id': 'tweets_in_set'})
-	user_df_split = user_df[user_df.has_external_link].drop(
-		columns=['has_external_link'],
-	).merge(
-		user_df[~user_df.has_external_link].drop(columns=['has_external_link']),
-		on=['user_id'],
-		how='outer',
-		suffixes=('_with_external', '_without_external'),
-	).fillna(0)
-
-	def get_values(column):
-		def curried(row):
-			return row[f'{column}_with_external'] if row[f'{column}_without_external'] == 0 else row[f'{column}_without_external']
-		return curried
-
-	for column in ['user_screen_name', 'user_description', 'user_following_count', 'user_followers_count']:
-		user_df_split[column] = user_df_split.apply(get_values(column), axis=1)
-		user_df_split = user_df_split.drop(columns=[f'{column}_with_external', f'{column}_without_external'])
-
-	user_df = user_df.drop(columns=['has_external_link']).groupby(['user_id']).agg({
-		'tweets_in_set': 'sum',
-		'tweet_retweet_count': 'sum',
-		'user_screen_name': 'last',
-		'user_description': 'last',
-		'user_following_count': 'last',
-		'user_followers_count': 'last',
-	}).reset_index()
-	user_df = user_df.rename(columns={'tweets_in_set': 'tweets_in_set_total', 'tweet_retweet_count': 'tweet_retweet_count_total'})
-	user_df = user_df_split.merge(user_df[['user_id', 'tweet_retweet_count_total', 'tweets_in_set_total']], on=['user_id'], how='inner')
+	user_df = get_user_stats(corpus)
 	save_file_name = output_filename.removesuffix('.csv') + '_grouped_user' + '.csv'
 	print(f'Saving dataframe to {save_file_name}...')
 	user_df.to_csv(save_file_name, mode='w+', index=False, encoding='utf-8', quoting=csv.QUOTE_NONNUMERIC)
@@ -161,21 +222,19 @@ if __name__ == '__main__':
 		'--corpus-filename',
 		type=str,
 		required=True,
-		help='Full or relative path to the full corpus csv file from twitter_search.py. E.g. results/my_data.csv',
+		help='Full or relative path to the full corpus csv file (or parquet directory) from twitter_search.py. E.g. results/my_data.csv',
 	)
 	p.add_argument(
 		'-df',
 		'--dictionary-filename',
 		type=str,
-		required=True,
-		help='Full or relative path to the URL dictionary csv file from reanalyze_media.py (UNEDITED). E.g. results/my_data.csv',
+		help='Full or relative path to the URL dictionary csv file from reanalyze_media.py (UNEDITED, required without --store). E.g. results/my_data.csv',
 	)
 	p.add_argument(
 		'-lf',
 		'--tweet-links-filename',
 		type=str,
-		required=True,
-		help='Full or relative path to the tweet links csv file from extract_media.py. E.g. results/my_data.csv',
+		help='Full or relative path to the tweet links csv file from extract_media.py (required without --store). E.g. results/my_data.csv',
 	)
 	p.add_argument(
 		'-of',
@@ -201,5 +260,20 @@ if __name__ == '__main__':
 		action='store_true',
 		help='Use this to group dates by hour (month/day/year HH:00:00).',
 	)
+	p.add_argument(
+		'--all-granularities',
+		action='store_true',
+		help='Use this to group dates by month, day and hour in a single run (files get a _monthly/_daily/_hourly suffix).',
+	)
+	p.add_argument(
+		'-tz',
+		'--timezone',
+		type=str,
+		help='Timezone to convert dates to before grouping them e.g. Asia/Tokyo (Optional)',
+	)
+	add_public_suffix_arguments(p)
+	add_link_store_arguments(p)
 	args = vars(p.parse_args())
+	if args['store'] is None and (args['tweet_links_filename'] is None or args['dictionary_filename'] is None):
+		p.error('--tweet-links-filename and --dictionary-filename are required without --store')
 	get_all_tweet_stats(args)
@@ -0,0 +1,173 @@
+"""
+Benchmark reading the csv and parquet corpus formats of the collectors (tweet_files.py), and check that the analysis
+scripts write byte-identical outputs from both
+
+The same synthetic API pages (retweets, quotes, replies, missing values, 'N/A' descriptions) are written as a csv
+and as a parquet corpus with CorpusWriter, like twitter_search.py --format does. Both are read whole and chunk by
+chunk, then filter.py, 1_extract_media.py and get_metrics.py are run on both and all their outputs are compared.
+
+Run (from the scripts directory):
+- `$ python benchmarks/bench_corpus_formats.py --tweets 200000`
+"""
+import argparse
+import asyncio
+import filecmp
+import importlib.util
+import os
+from pathlib import Path
+import random
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SCRIPTS_DIR))
+spec = importlib.util.spec_from_file_location('extract_media', SCRIPTS_DIR / '1_extract_media.py')
+extract_media = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(extract_media)
+import filter as corpus_filter
+import get_metrics
+from tweet_files import CorpusWriter, get_tweet_rows, iter_corpus, read_corpus
+
+DESCRIPTIONS = ['', 'N/A', 'null', '42']
+
+
+def make_user(i, rng):
+	return {
+		'id': str(1000 + i), 'username': f'user{i}', 'description': DESCRIPTIONS[i] if i < len(DESCRIPTIONS) else f'description of user{i}',
+		'created_at': f'20{10 + i % 12}-0{1 + i % 9}-01T00:00:00.000Z', 'verified': i % 10 == 0,
+		'public_metrics': {'following_count': i % 1000, 'followers_count': rng.randrange(5000), 'tweet_count': rng.randrange(20000)},
+	}
+
+
+def make_pages(tweets, users, hashtags, per_page, seed=0):
+	"""Raw API pages of tweets tweets, newest first like a search"""
+	rng = random.Random(seed)
+	user_list = [make_user(i, rng) for i in range(users)]
+	tags = [f'tag{i}' for i in range(hashtags)]
+	start = pd.Timestamp('2021-01-01', tz='UTC').value // 10 ** 9
+	pages = []
+	for first in range(tweets, 0, -per_page):
+		data, page_users, referenced = [], {}, []
+		for i in range(first, max(first - per_page, 0), -1):
+			user = user_list[rng.randrange(users)]
+			page_users[user['id']] = user
+			created_at = pd.Timestamp(start + i * 60, unit='s', tz='UTC').strftime('%Y-%m-%dT%H:%M:%S.000Z')
+			tweet = {
+				'id': str(10 ** 18 + i), 'text': f'tweet {i} https://t.co/{rng.randrange(tweets // 10 + 1):x}', 'created_at': created_at,
+				'lang': 'en', 'author_id': user['id'], 'conversation_id': str(10 ** 18 + i),
+				'public_metrics': {'like_count': rng.randrange(50), 'retweet_count': rng.randrange(20), 'reply_count': 0, 'quote_count': 0},
+			}
+			picked = rng.sample(tags, rng.randrange(4))
+			if picked:
+				tweet['entities'] = {'hashtags': [{'tag': tag} for tag in picked]}
+			if i % 7 == 0:
+				tweet['text'] = str(i)  # numeric text
+			if i % 3 == 0:
+				tweet['possibly_sensitive'] = i % 2 == 0
+			kind = rng.random()
+			if kind < 0.5:
+				author = user_list[rng.randrange(users)]
+				page_users[author['id']] = author
+				referenced.append({'id': str(i), 'text': f'original {i}', 'created_at': created_at, 'author_id': author['id']})
+				tweet['referenced_tweets'] = [{'type': 'retweeted', 'id': str(i)}]
+			elif kind < 0.6:
+				tweet['referenced_tweets'] = [{'type': 'quoted', 'id': str(10 ** 17 + i)}]
+			elif kind < 0.7:
+				tweet['referenced_tweets'] = [{'type': 'replied_to', 'id': str(10 ** 17 + i)}]
+				tweet['in_reply_to_user_id'] = user_list[rng.randrange(users)]['id']
+			data.append(tweet)
+		pages.append({'data': data, 'includes': {'users': list(page_users.values()), 'tweets': referenced}})
+	return pages
+
+
+def write_corpus(file_name, file_format, pages, pages_per_row_group):
+	writer = CorpusWriter(file_name, file_format, False, pages_per_row_group)
+	for page in pages:
+		writer.write_page(get_tweet_rows(page))
+	writer.close()
+
+
+def timed(function, *args):
+	start = time.perf_counter()
+	function(*args)
+	return time.perf_counter() - start
+
+
+def run_analysis(work_dir, corpus_file_name, args):
+	"""Outputs of filter.py, 1_extract_media.py and get_metrics.py, in work_dir"""
+	cwd = os.getcwd()
+	os.chdir(work_dir)
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+	try:
+		corpus_filter.filter_data({
+			'filename': corpus_file_name, 'output_filename': 'filtered.csv', 'from_date': None, 'to_date': None,
+			'timezone': None, 'no_keep_rt': False, 'remove_media_urls': False, 'query': None, 'col': None,
+			'date_col': 'created_at', 'text_col': 'text',
+		})
+		extract_media.process_data_df({
+			'corpus_filename': corpus_file_name, 'csv_sep': ',', 'chunk_size': args['chunk_size'], 'workers': 1, 'store': None,
+		})
+		asyncio.run(get_metrics.parse_tweets({
+			'filename': corpus_file_name, 'timezone': None, 'no_keep_rt': False, 'no_analyze_date': False,
+			'no_analyze_time': False, 'no_analyze_users': False, 'no_analyze_hashtags': False, 'analyze_urls': False,
+			'exclude_twitter_urls': False, 'chunk_size': args['chunk_size'], 'max_redirect_depth': 1, 'from_date': None,
+			'to_date': None, 'csv_sep': ',', 'engine': 'columnar', 'workers': 1, 'incremental': False,
+			'approximate_unique_users': False, 'hll_precision': 12,
+		}))
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+		os.chdir(cwd)
+
+
+def compare_outputs(first_dir, second_dir):
+	first_files = sorted(path for path in Path(first_dir).rglob('*.csv') if path.name != 'corpus.csv')
+	differences = []
+	for first_file in first_files:
+		second_file = Path(second_dir) / first_file.relative_to(first_dir)
+		if not second_file.exists() or not filecmp.cmp(first_file, second_file, shallow=False):
+			differences.append(str(first_file.relative_to(first_dir)))
+	return len(first_files), differences
+
+
+def benchmark(args):
+	pages = make_pages(args['tweets'], args['users'], args['hashtags'], args['per_page'])
+	print(f'{args["tweets"]} tweets in {len(pages)} pages')
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		timings = {}
+		for file_format in ['csv', 'parquet']:
+			work_dir = os.path.join(tmp_dir, file_format)
+			Path(work_dir, 'results').mkdir(parents=True)
+			corpus_file_name = os.path.join(work_dir, 'results', f'corpus.{file_format}')
+			write_corpus(corpus_file_name, file_format, pages, args['pages_per_row_group'])
+			timings[file_format] = [
+				timed(read_corpus, corpus_file_name),
+				timed(read_corpus, corpus_file_name, ',', extract_media.LINK_COLUMNS),
+				timed(lambda: [len(chunk) for chunk in iter_corpus(corpus_file_name, args['chunk_size'])]),
+			]
+			run_analysis(work_dir, corpus_file_name, args)
+		compared, differences = compare_outputs(os.path.join(tmp_dir, 'csv'), os.path.join(tmp_dir, 'parquet'))
+
+	print(f'{"":>8}  {"whole":>8}  {"4 cols":>8}  {"chunks":>8}')
+	for file_format, (whole, columns, chunks) in timings.items():
+		print(f'{file_format:>8}: {whole:7.2f}s  {columns:7.2f}s  {chunks:7.2f}s')
+	if differences:
+		print(f'MISMATCH in {len(differences)}/{compared} output files: {", ".join(differences)}')
+		sys.exit(1)
+	print(f'All {compared} output files are byte-identical.')
+
+
+if __name__ == '__main__':
+	p = argparse.ArgumentParser(description='Benchmark the csv and parquet corpus formats and compare the analysis outputs of both')
+	p.add_argument('--tweets', type=int, default=100000, help='Number of tweets in the synthetic corpus. Default: 100K')
+	p.add_argument('--users', type=int, default=5000, help='Number of distinct users. Default: 5K')
+	p.add_argument('--hashtags', type=int, default=500, help='Number of distinct hashtags. Default: 500')
+	p.add_argument('--per-page', type=int, default=500, help='Tweets per page of results. Default: 500')
+	p.add_argument('--pages-per-row-group', type=int, default=7, help='Pages per parquet part file. Default: 7')
+	p.add_argument('-c', '--chunk-size', type=int, default=10000, help='Size of processing chunk of the analysis scripts. Default: 10K rows')
+	args = vars(p.parse_args())
+	benchmark(args)
@@ -0,0 +1,122 @@
+"""
+Benchmark the row-wise and columnar engines of get_metrics.py on a synthetic corpus
+and check that both produce byte-identical metrics csv files
+
+Run (from the scripts directory):
+- `$ python benchmarks/bench_get_metrics.py --rows 200000`
+"""
+import argparse
+import asyncio
+import csv
+import filecmp
+import os
+from pathlib import Path
+import random
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import get_metrics
+
+
+def make_corpus(file_name, rows, users, hashtags, seed=0):
+	rng = random.Random(seed)
+	tags = [f'tag{i}' for i in range(hashtags)]
+	start = pd.Timestamp('2021-01-01', tz='UTC').value // 10 ** 9
+	data = []
+	for i in range(rows):
+		user = rng.randrange(users)
+		picked = rng.sample(tags, rng.randrange(4))
+		data.append({
+			'tweet_id': str(10 ** 18 + i),
+			'text': f'tweet {i} https://t.co/{rng.randrange(rows // 10 + 1):x}',
+			'created_at': pd.Timestamp(start + rng.randrange(2 * 365 * 24 * 3600), unit='s', tz='UTC').isoformat(),
+			'hashtags': ','.join(picked),
+			'user_screen_name': f'user{user}',
+			'user_description': f'description of user{user}',
+			'user_following_count': user % 1000,
+			'user_followers_count': user % 5000,
+			'user_total_tweets': user % 20000,
+			'user_created_at': '2010-01-01T00:00:00.000Z',
+			'is_retweet': rng.random() < 0.6,
+		})
+	pd.DataFrame(data).to_csv(file_name, index=False, encoding='utf-8', quoting=csv.QUOTE_NONNUMERIC)
+
+
+def run_engine(engine, corpus_file_name, work_dir, args):
+	Path(work_dir).mkdir(parents=True, exist_ok=True)
+	cwd = os.getcwd()
+	os.chdir(work_dir)
+	try:
+		start = time.perf_counter()
+		asyncio.run(get_metrics.parse_tweets({
+			'filename': corpus_file_name,
+			'timezone': args['timezone'],
+			'no_keep_rt': False,
+			'no_analyze_date': False,
+			'no_analyze_time': False,
+			'no_analyze_users': False,
+			'no_analyze_hashtags': False,
+			'analyze_urls': False,
+			'exclude_twitter_urls': False,
+			'chunk_size': args['chunk_size'],
+			'max_redirect_depth': 1,
+			'from_date': None,
+			'to_date': None,
+			'csv_sep': ',',
+			'engine': engine,
+			'workers': args['workers'] if engine == 'columnar' else 1,
+			'incremental': False,
+			'approximate_unique_users': False,
+			'hll_precision': 12,
+		}))
+		return time.perf_counter() - start
+	finally:
+		os.chdir(cwd)
+
+
+def compare_results(first_dir, second_dir):
+	first_files = sorted(Path(first_dir).glob('results/*/*.csv'))
+	differences = []
+	for first_file in first_files:
+		second_file = Path(second_dir) / first_file.relative_to(first_dir)
+		if not second_file.exists() or not filecmp.cmp(first_file, second_file, shallow=False):
+			differences.append(first_file.name)
+	return len(first_files), differences
+
+
+def benchmark(args):
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		corpus_file_name = os.path.join(tmp_dir, 'bench_corpus.csv')
+		print(f'Generating corpus of {args["rows"]} rows...')
+		make_corpus(corpus_file_name, args['rows'], args['users'], args['hashtags'])
+
+		timings = {}
+		for engine in ['rows', 'columnar']:
+			timings[engine] = run_engine(engine, corpus_file_name, os.path.join(tmp_dir, engine), args)
+
+		compared, differences = compare_results(os.path.join(tmp_dir, 'rows'), os.path.join(tmp_dir, 'columnar'))
+
+	print()
+	for engine, elapsed in timings.items():
+		print(f'{engine:>10}: {elapsed:8.2f}s ({args["rows"] / elapsed:,.0f} rows/s)')
+	print(f'   speedup: {timings["rows"] / timings["columnar"]:.1f}x')
+	if differences:
+		print(f'MISMATCH in {len(differences)}/{compared} files: {", ".join(differences)}')
+		sys.exit(1)
+	print(f'All {compared} metrics files are byte-identical.')
+
+
+if __name__ == '__main__':
+	p = argparse.ArgumentParser(description='Benchmark get_metrics.py engines on a synthetic corpus')
+	p.add_argument('--rows', type=int, default=100000, help='Number of tweets in the synthetic corpus. Default: 100K')
+	p.add_argument('--users', type=int, default=10000, help='Number of distinct users. Default: 10K')
+	p.add_argument('--hashtags', type=int, default=500, help='Number of distinct hashtags. Default: 500')
+	p.add_argument('-c', '--chunk-size', type=int, default=100000, help='Size of processing chunk. Default: 100K rows')
+	p.add_argument('-w', '--workers', type=int, default=1, help='Number of processes for the columnar engine. Default: 1')
+	p.add_argument('-tz', '--timezone', type=str, help='Timezone to convert time data to before analysis e.g. Asia/Tokyo (Optional)')
+	args = vars(p.parse_args())
+	benchmark(args)
@@ -0,0 +1,201 @@
+"""
+Benchmark the sharded search of twitter_search.py (search_shards.py) against a local mock of the v2 full-archive
+search and counts endpoints, and check that every run gives the same corpus
+
+The mock holds --tweets synthetic tweets, more of them towards the end of its date range (so equal-duration shards
+are unbalanced), answers every page after --latency seconds and with a 429 above --server-rate requests a second.
+- sequential: one shard, one worker (the page by page walk of the sequential search)
+- sharded: --shards equal-duration windows, --shard-workers at a time
+- sharded by counts: --shards windows sized from the counts endpoint
+The shards of every run are also replayed (replay_journal.py), which must give the merged corpus.
+
+Run (from the scripts directory):
+- `$ python benchmarks/bench_search_shards.py --tweets 20000 --shards 8`
+"""
+import argparse
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from pathlib import Path
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SCRIPTS_DIR))
+from replay_journal import replay_journal
+from search_shards import DATE_FORMAT, get_shards_dir, search_sharded
+
+TWITTER_EPOCH_MS = 1288834974657
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+END = datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+
+def make_tweets(count, seed=0):
+	"""(epoch seconds, tweets) sorted by descending id, more tweets towards END"""
+	rng = np.random.default_rng(seed)
+	span = (END - START).total_seconds()
+	seconds = np.sort(START.timestamp() + span * np.sqrt(rng.random(count)))[::-1].astype(int)
+	tweets = []
+	for i, second in enumerate(seconds):
+		tweet_id = str(((int(second) * 1000 - TWITTER_EPOCH_MS) << 22) + count - i)
+		author_id = str(rng.integers(1, 200))
+		tweets.append({
+			'id': tweet_id,
+			'text': f'tweet {i} https://t.co/{i:x}',
+			'created_at': datetime.fromtimestamp(second, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+			'lang': 'en',
+			'author_id': author_id,
+			'conversation_id': tweet_id,
+			'public_metrics': {'like_count': i % 7, 'retweet_count': i % 3, 'reply_count': 0, 'quote_count': 0},
+			'entities': {'hashtags': [{'tag': f'tag{i % 5}'}], 'urls': [{'url': f'https://t.co/{i:x}', 'expanded_url': f'https://example.com/{i % 50}'}]},
+		})
+	return seconds, tweets
+
+
+def get_user(author_id):
+	return {
+		'id': author_id, 'username': f'user{author_id}', 'description': f'user {author_id}', 'created_at': '2015-01-01T00:00:00.000Z',
+		'verified': False, 'public_metrics': {'following_count': 1, 'followers_count': int(author_id), 'tweet_count': 10},
+	}
+
+
+def start_server(port, tweet_count, latency, server_rate):
+	seconds, tweets = make_tweets(tweet_count)
+	requests_times = deque()
+	lock = threading.Lock()
+
+	def parse_time(value):
+		return datetime.strptime(value, DATE_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+
+	def search(params):
+		# seconds is descending: tweets of [start, end) are seconds[first:last]
+		first = np.searchsorted(-seconds, -parse_time(params['end_time']), side='right')
+		last = np.searchsorted(-seconds, -parse_time(params['start_time']), side='right')
+		offset = first + int(params.get('next_token', 0))
+		page = tweets[offset:min(offset + int(params['max_results']), last)]
+		meta = {'result_count': len(page)}
+		if offset + len(page) < last:
+			meta['next_token'] = str(offset + len(page) - first)
+		users = sorted({tweet['author_id'] for tweet in page})
+		return {'data': page, 'includes': {'users': [get_user(x) for x in users]}, 'meta': meta} if page else {'meta': meta}
+
+	def counts(params):
+		step = 86400 if params['granularity'] == 'day' else 3600
+		start, end = parse_time(params['start_time']), parse_time(params['end_time'])
+		bounds = np.append(np.arange(start, end, step), end)
+		histogram = np.histogram(seconds, bins=bounds)[0]
+		offset = int(params.get('next_token', 0))
+		data = [
+			{'start': datetime.fromtimestamp(a, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'), 'end': datetime.fromtimestamp(b, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'), 'tweet_count': int(c)}
+			for a, b, c in list(zip(bounds[:-1], bounds[1:], histogram))[offset:offset + 31]
+		]
+		meta = {'total_tweet_count': sum(x['tweet_count'] for x in data)}
+		if offset + 31 < len(histogram):
+			meta['next_token'] = str(offset + 31)
+		return {'data': data, 'meta': meta}
+
+	class Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			url = urlparse(self.path)
+			params = {key: values[0] for key, values in parse_qs(url.query).items()}
+			with lock:
+				now = time.time()
+				while requests_times and requests_times[0] < now - 1:
+					requests_times.popleft()
+				limited = len(requests_times) >= server_rate
+				if not limited:
+					requests_times.append(now)
+			if limited:
+				self.answer(429, {'title': 'Too Many Requests'}, {'x-rate-limit-reset': str(int(now) + 1)})
+				return
+			time.sleep(latency)
+			if url.path == '/2/tweets/search/all':
+				self.answer(200, search(params))
+			elif url.path == '/2/tweets/counts/all':
+				self.answer(200, counts(params))
+			else:
+				self.answer(404, {})
+
+		def answer(self, status, body, headers={}):
+			content = json.dumps(body).encode('utf-8')
+			self.send_response(status)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(content)))
+			for key, value in headers.items():
+				self.send_header(key, value)
+			self.end_headers()
+			self.wfile.write(content)
+
+		def log_message(self, *args):
+			pass
+
+	server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+
+def run(args, name, shards, workers, by_counts):
+	search_args = {
+		'query': 'x', 'filename': name, 'from_date': START.strftime(DATE_FORMAT), 'to_date': END.strftime(DATE_FORMAT),
+		'from_id': None, 'until_id': None, 'max_per_page': args['max_per_page'], 'keep_rt': True, 'format': 'csv',
+		'pages_per_row_group': 10, 'no_journal': False, 'journal': None, 'journal_pages_per_segment': 100, 'shards': shards,
+		'size_shards_by_counts': by_counts, 'shard_workers': workers, 'requests_per_second': args['requests_per_second'], 'api_url': f'http://127.0.0.1:{args["port"]}/2',
+	}
+	start = time.perf_counter()
+	tweet_count, _, _ = search_sharded(search_args, 'token')
+	elapsed = time.perf_counter() - start
+	replay_journal({'journal': get_shards_dir(name), 'filename': name + '_replayed', 'keep_rt': True, 'workers': 1, 'format': 'csv', 'pages_per_row_group': 10})
+	corpora = []
+	for file_name in [name, name + '_replayed']:
+		with open(f'./results/{file_name}.csv', 'rb') as file:
+			corpora.append(file.read())
+	return elapsed, tweet_count, *corpora
+
+
+def benchmark(args):
+	server = start_server(args['port'], args['tweets'], args['latency'], args['server_rate'])
+	os.chdir(tempfile.mkdtemp())
+	stdout = sys.stdout
+	results = {}
+	try:
+		for name, shards, workers, by_counts in [
+			('sequential', 1, 1, False),
+			('sharded', args['shards'], args['shard_workers'], False),
+			('sharded_by_counts', args['shards'], args['shard_workers'], True),
+		]:
+			sys.stdout = open(os.devnull, 'w')
+			try:
+				results[name] = run(args, name, shards, workers, by_counts)
+			finally:
+				sys.stdout.close()
+				sys.stdout = stdout
+			elapsed, tweet_count, _, _ = results[name]
+			print(f'{name:>17}: {elapsed:7.2f}s, {tweet_count} tweets, {tweet_count / elapsed:8.1f} tweets/s')
+	finally:
+		server.shutdown()
+	corpora = {corpus for _, _, *run_corpora in results.values() for corpus in run_corpora}
+	if len(corpora) != 1 or results['sequential'][1] != args['tweets']:
+		print('MISMATCH between the corpora')
+		sys.exit(1)
+	print(f'All corpora and their replays are identical ({os.getcwd()}/results).')
+
+
+if __name__ == '__main__':
+	p = argparse.ArgumentParser(description='Benchmark the sharded search against a local mock of the v2 search endpoint')
+	p.add_argument('--tweets', type=int, default=20000, help='Number of tweets of the mock. Default: 20000')
+	p.add_argument('--shards', type=int, default=8, help='Number of shards. Default: 8')
+	p.add_argument('--shard-workers', type=int, default=8, help='Shards fetched at the same time. Default: 8')
+	p.add_argument('-m', '--max-per-page', type=int, default=100, help='Tweets per page. Default: 100')
+	p.add_argument('--latency', type=float, default=0.1, help='Mock latency in seconds. Default: 0.1')
+	p.add_argument('--server-rate', type=int, default=50, help='Requests a second before the mock answers 429. Default: 50')
+	p.add_argument('--requests-per-second', type=float, default=40, help='Client token bucket rate. Default: 40')
+	p.add_argument('--port', type=int, default=8643, help='Port of the mock API. Default: 8643')
+	args = vars(p.parse_args())
+	benchmark(args)
@@ -0,0 +1,249 @@
+"""
+Benchmark the concurrent timeline collection of twitter_timeline.py (timeline_collector.py) against a local mock of
+the v2 user tweet timeline endpoint, and check that every run collects the same tweets
+
+The mock serves --users timelines of 0 to --max-tweets synthetic tweets, answers every page after --latency seconds
+and with a 429 above --server-rate requests a second. Timelines are collected with 1 worker, then --workers. Then
+--new-tweets tweets are added to 10% of the timelines and the --workers run is synced (--sync): every timeline takes
+one request, plus the pages of its new tweets.
+Last, a parquet collection is killed (SIGKILL) midway and resumed, and its journal is replayed (replay_journal.py):
+the pages the resumed run fetched again are in the journal twice, the replay must still hold the corpus' tweets.
+
+Run (from the scripts directory):
+- `$ python benchmarks/bench_timelines.py --users 200 --workers 16`
+"""
+import argparse
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from pathlib import Path
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SCRIPTS_DIR))
+from replay_journal import replay_journal, replay_segment
+from timeline_collector import collect_timelines, get_users_state_file_name
+from tweet_files import read_corpus
+from tweet_journal import get_journal_dir, get_segments
+
+TWITTER_EPOCH_MS = 1288834974657
+
+
+def make_tweet(user_id, i, second, sequence=0):
+	return {
+		'id': str(((int(second) * 1000 - TWITTER_EPOCH_MS) << 22) + sequence),
+		'text': f'tweet {i} of {user_id}',
+		'created_at': datetime.fromtimestamp(second, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+		'lang': 'en',
+		'author_id': user_id,
+		'conversation_id': '1',
+		'public_metrics': {'like_count': i % 7, 'retweet_count': i % 3, 'reply_count': 0, 'quote_count': 0},
+	}
+
+
+def make_timelines(users, max_tweets, seed=0):
+	"""{user_id: tweets sorted by descending id}"""
+	rng = np.random.default_rng(seed)
+	start = datetime(2021, 1, 1, tzinfo=timezone.utc).timestamp()
+	timelines = {}
+	for user in range(users):
+		user_id = str(1000 + user)
+		seconds = np.sort(start + rng.integers(0, 365 * 86400, rng.integers(0, max_tweets + 1)))[::-1]
+		timelines[user_id] = [make_tweet(user_id, i, second, user * 1000 + i % 1000) for i, second in enumerate(seconds)]
+	return timelines
+
+
+def start_server(port, users, max_tweets, latency, server_rate):
+	timelines = make_timelines(users, max_tweets)
+	requests_times = deque()
+	lock = threading.Lock()
+	served = [0]
+
+	def add_tweets(count, seed=1):
+		"""count new tweets at the top of 10% of the timelines"""
+		rng = np.random.default_rng(seed)
+		for user_id in rng.choice(list(timelines), len(timelines) // 10, replace=False):
+			newest = int(timelines[user_id][0]['id']) if timelines[user_id] else TWITTER_EPOCH_MS << 22
+			timelines[user_id][:0] = [
+				{**make_tweet(user_id, i, datetime.now(timezone.utc).timestamp()), 'id': str(newest + ((count - i) << 22))}
+				for i in range(count)
+			]
+
+	def timeline(user_id, params):
+		tweets = [
+			tweet for tweet in timelines[user_id]
+			if int(tweet['id']) > int(params.get('since_id', 0)) and int(tweet['id']) < int(params.get('until_id', 2 ** 63))
+		]
+		offset = int(params.get('pagination_token', 0))
+		page = tweets[offset:offset + int(params['max_results'])]
+		meta = {'result_count': len(page)}
+		if page:
+			meta.update(newest_id=page[0]['id'], oldest_id=page[-1]['id'])
+		if offset + len(page) < len(tweets):
+			meta['next_token'] = str(offset + len(page))
+		user = {
+			'id': user_id, 'username': f'user{user_id}', 'description': '', 'created_at': '2015-01-01T00:00:00.000Z',
+			'verified': False, 'public_metrics': {'following_count': 1, 'followers_count': 2, 'tweet_count': len(timelines[user_id])},
+		}
+		return {'data': page, 'includes': {'users': [user]}, 'meta': meta} if page else {'meta': meta}
+
+	class Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			url = urlparse(self.path)
+			params = {key: values[0] for key, values in parse_qs(url.query).items()}
+			with lock:
+				now = time.time()
+				while requests_times and requests_times[0] < now - 1:
+					requests_times.popleft()
+				limited = len(requests_times) >= server_rate
+				if not limited:
+					requests_times.append(now)
+					served[0] += 1
+			if limited:
+				self.answer(429, {'title': 'Too Many Requests'}, {'x-rate-limit-reset': str(int(now) + 1)})
+				return
+			time.sleep(latency)
+			match = re.fullmatch(r'/2/users/(\d+)/tweets', url.path)
+			if match and match.group(1) in timelines:
+				self.answer(200, timeline(match.group(1), params))
+			else:
+				self.answer(404, {})
+
+		def answer(self, status, body, headers={}):
+			content = json.dumps(body).encode('utf-8')
+			self.send_response(status)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(content)))
+			for key, value in headers.items():
+				self.send_header(key, value)
+			self.end_headers()
+			try:
+				self.wfile.write(content)
+			except (BrokenPipeError, ConnectionResetError):
+				pass  # the collection killed by run_resumed
+
+		def log_message(self, *args):
+			pass
+
+	server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+
+	def count_tweets():
+		return sum(len(tweets) for tweets in timelines.values())
+
+	return server, count_tweets, list(timelines), add_tweets, served
+
+
+def get_collector_args(args, name, workers, user_ids, sync=False, file_format='csv'):
+	return {
+		'user_ids': ','.join(user_ids), 'filename': name, 'from_id': None, 'until_id': None, 'from_date': None, 'to_date': None,
+		'max_per_page': 100, 'keep_rt': True, 'format': file_format, 'pages_per_row_group': 10, 'no_journal': False, 'journal': None,
+		'journal_pages_per_segment': 100, 'workers': workers, 'requests_per_second': args['requests_per_second'],
+		'api_url': f'http://127.0.0.1:{args["port"]}/2', 'sync': sync,
+	}
+
+
+def quiet(function, *args):
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+	try:
+		return function(*args)
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+
+
+def run(args, name, workers, user_ids, sync=False):
+	start = time.perf_counter()
+	quiet(collect_timelines, get_collector_args(args, name, workers, user_ids, sync), 'token')
+	elapsed = time.perf_counter() - start
+	with open(f'./results/{name}.csv', encoding='utf-8') as file:
+		header, *rows = file.read().splitlines()
+	return elapsed, header, sorted(rows)
+
+
+def run_resumed(args, name, user_ids, kill_after):
+	"""(tweets fetched, corpus, replayed corpus) of a parquet collection killed once its state counts kill_after tweets, then resumed"""
+	collector_args = get_collector_args(args, name, args['workers'], user_ids, file_format='parquet')
+	script = f'import sys; sys.path.insert(0, {str(SCRIPTS_DIR)!r}); from timeline_collector import collect_timelines; collect_timelines({collector_args!r}, "token")'
+	process = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.DEVNULL)
+	state_file_name = get_users_state_file_name(name)
+	while process.poll() is None:
+		if os.path.isfile(state_file_name):
+			with open(state_file_name) as file:
+				if sum(user['tweets'] for user in json.load(file)['users'].values()) >= kill_after:
+					process.kill()
+					break
+		time.sleep(0.05)
+	process.wait()
+
+	quiet(collect_timelines, collector_args, 'token')
+	quiet(replay_journal, {
+		'journal': get_journal_dir(name), 'filename': name + '_replayed', 'keep_rt': True, 'workers': 1, 'format': 'parquet',
+		'pages_per_row_group': 10,
+	})
+	fetched = sum(len(tweet_list) for segment in get_segments(get_journal_dir(name)) for tweet_list in replay_segment(segment, True))
+	corpus, replayed = [
+		read_corpus(f'./results/{file_name}.parquet').sort_values('tweet_id').reset_index(drop=True)
+		for file_name in [name, name + '_replayed']
+	]
+	return fetched, corpus, replayed
+
+
+def benchmark(args):
+	server, count_tweets, user_ids, add_tweets, served = start_server(args['port'], args['users'], args['max_tweets'], args['latency'], args['server_rate'])
+	os.chdir(tempfile.mkdtemp())
+	tweet_count = count_tweets()
+	print(f'{args["users"]} timelines, {tweet_count} tweets')
+	results = {}
+	try:
+		for name, workers in [('sequential', 1), ('concurrent', args['workers'])]:
+			results[name] = run(args, name, workers, user_ids)
+			elapsed, _, rows = results[name]
+			print(f'{name:>10}: {elapsed:7.2f}s, {len(rows)} tweets, {len(user_ids) / elapsed:6.1f} timelines/s')
+		if results['sequential'][1:] != results['concurrent'][1:] or len(results['sequential'][2]) != tweet_count:
+			print('MISMATCH between the collected tweets')
+			sys.exit(1)
+		print('Both runs collected the same tweets.')
+
+		add_tweets(args['new_tweets'])
+		requests_before = served[0]
+		elapsed, _, rows = run(args, 'concurrent', args['workers'], user_ids, sync=True)
+		print(f'      sync: {elapsed:7.2f}s, {len(rows) - tweet_count} new tweets, {served[0] - requests_before} requests for {len(user_ids)} timelines')
+		if len(rows) != len(set(rows)) or len(rows) != count_tweets():
+			print('MISMATCH between the synced tweets and the timelines')
+			sys.exit(1)
+		print('The synced corpus has every tweet once.')
+
+		fetched, corpus, replayed = run_resumed(args, 'resumed', user_ids, count_tweets() // 3)
+		print(f'   resumed: {len(corpus)} tweets, {fetched - len(corpus)} fetched again after the kill, {len(replayed)} replayed')
+	finally:
+		server.shutdown()
+	if len(corpus) != count_tweets() or not corpus.equals(replayed):
+		print('MISMATCH between the replayed journal and the resumed corpus')
+		sys.exit(1)
+	print(f'The replayed journal holds the resumed corpus ({os.getcwd()}/results).')
+
+
+if __name__ == '__main__':
+	p = argparse.ArgumentParser(description='Benchmark the concurrent timeline collection against a local mock of the v2 timeline endpoint')
+	p.add_argument('--users', type=int, default=200, help='Number of timelines. Default: 200')
+	p.add_argument('--max-tweets', type=int, default=400, help='Maximum number of tweets of a timeline. Default: 400')
+	p.add_argument('-w', '--workers', type=int, default=16, help='Timelines fetched at the same time. Default: 16')
+	p.add_argument('--new-tweets', type=int, default=150, help='New tweets of the timelines that get some before the sync. Default: 150')
+	p.add_argument('--latency', type=float, default=0.1, help='Mock latency in seconds. Default: 0.1')
+	p.add_argument('--server-rate', type=int, default=100, help='Requests a second before the mock answers 429. Default: 100')
+	p.add_argument('--requests-per-second', type=float, default=80, help='Client token bucket rate. Default: 80')
+	p.add_argument('--port', type=int, default=8644, help='Port of the mock API. Default: 8644')
+	args = vars(p.parse_args())
+	benchmark(args)
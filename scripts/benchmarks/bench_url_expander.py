@@ -0,0 +1,99 @@
+"""
+Throughput benchmark of URL expansion against a local redirect server:
+- old: one ClientSession per chunk, every URL of the chunk gathered at once
+- new: get_metrics.expand_media_urls through one shared URLExpander (global AIMD limit + per host limit)
+
+The server answers with a redirect after --latency seconds, but starts failing (503, no location)
+when more than --capacity requests are in flight, like an overloaded shortener.
+
+Run (from the scripts directory):
+- `$ python benchmarks/bench_url_expander.py --urls 5000 --chunk-size 1000`
+"""
+import argparse
+import asyncio
+from pathlib import Path
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import get_metrics
+from url_expander import URLExpander
+
+
+async def start_server(port, capacity, latency):
+	in_flight = 0
+
+	async def redirect(request):
+		nonlocal in_flight
+		in_flight += 1
+		try:
+			await asyncio.sleep(latency)
+			if in_flight > capacity:
+				return web.Response(status=503)
+			raise web.HTTPFound('https://example.com/' + request.match_info['key'])
+		finally:
+			in_flight -= 1
+
+	app = web.Application()
+	app.router.add_route('*', '/{key}', redirect)
+	runner = web.AppRunner(app, access_log=None)
+	await runner.setup()
+	await web.TCPSite(runner, '127.0.0.1', port).start()
+	return runner
+
+
+async def expand_old(urls, chunksize):
+	# the pre-scheduler implementation: a new session per chunk, all urls of the chunk at once
+	async def expand(session, url):
+		try:
+			async with session.head(url, allow_redirects=False) as res:
+				return res.headers.get('location', '') != ''
+		except Exception:
+			return False
+
+	results = []
+	for i in range(0, len(urls), chunksize):
+		async with aiohttp.ClientSession() as session:
+			results.extend(await asyncio.gather(*[expand(session, url) for url in urls[i:i + chunksize]]))
+	return sum(not x for x in results)
+
+
+async def expand_new(urls, chunksize, args):
+	errors = 0
+	async with URLExpander(args['max_concurrency'], args['max_per_host'], latency_target=args['latency'] * 4) as expander:
+		for i in range(0, len(urls), chunksize):
+			media_set = {url: {'metrics': [1, 0]} for url in urls[i:i + chunksize]}
+			await get_metrics.expand_media_urls(media_set, False, 1, expander)
+			errors += sum(x['error_expanding'] for x in media_set.values())
+		expander.report()
+	return errors
+
+
+async def benchmark(args):
+	runner = await start_server(args['port'], args['capacity'], args['latency'])
+	urls = [f'http://127.0.0.1:{args["port"]}/{i:x}' for i in range(args['urls'])]
+	try:
+		for name, run in [('old', lambda: expand_old(urls, args['chunk_size'])), ('new', lambda: expand_new(urls, args['chunk_size'], args))]:
+			start = time.perf_counter()
+			errors = await run()
+			elapsed = time.perf_counter() - start
+			resolved = len(urls) - errors
+			print(f'{name:>4}: {elapsed:7.2f}s, {resolved / elapsed:8.1f} resolved urls/s, {errors} errors ({errors / len(urls) * 100:.1f}%)')
+	finally:
+		await runner.cleanup()
+
+
+if __name__ == '__main__':
+	p = argparse.ArgumentParser(description='Benchmark URL expansion against a local redirect server')
+	p.add_argument('--urls', type=int, default=5000, help='Number of URLs to expand. Default: 5000')
+	p.add_argument('-c', '--chunk-size', type=int, default=1000, help='URLs per chunk. Default: 1000')
+	p.add_argument('--capacity', type=int, default=40, help='Requests in flight before the server starts failing. Default: 40')
+	p.add_argument('--latency', type=float, default=0.05, help='Server latency in seconds. Default: 0.05')
+	p.add_argument('--max-concurrency', type=int, default=100, help='URLExpander global limit. Default: 100')
+	p.add_argument('--max-per-host', type=int, default=100, help='URLExpander per host limit. Default: 100')
+	p.add_argument('--port', type=int, default=8642, help='Port of the local redirect server. Default: 8642')
+	args = vars(p.parse_args())
+	asyncio.run(benchmark(args))
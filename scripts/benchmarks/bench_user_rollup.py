@@ -0,0 +1,127 @@
+"""
+Benchmark the user stats of 5_get_all_tweet_external_link_stats.py on a synthetic corpus: the columnar
+get_user_stats against the previous merge + row-wise apply version, and check that both give the same csv
+
+Run (from the scripts directory):
+- `$ python benchmarks/bench_user_rollup.py --users 5000000`
+- `$ python benchmarks/bench_user_rollup.py --users 5000000 --no-baseline` (the baseline takes minutes at that size)
+"""
+import argparse
+import csv
+import importlib.util
+import io
+from pathlib import Path
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SCRIPTS_DIR))
+spec = importlib.util.spec_from_file_location('link_stats', SCRIPTS_DIR / '5_get_all_tweet_external_link_stats.py')
+link_stats = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(link_stats)
+
+
+def make_corpus(users, tweets_per_user, seed=0):
+	rng = np.random.default_rng(seed)
+	rows = users * tweets_per_user
+	user_ids = rng.integers(0, users, rows)
+	names = pd.Series(user_ids).astype(str)
+	start = pd.Timestamp('2021-01-01', tz='UTC').value
+	return pd.DataFrame({
+		'tweet_id': np.arange(rows) + 10 ** 18,
+		'user_screen_name': 'user' + names,
+		'tweet_retweet_count': rng.integers(0, 100, rows),
+		'created_at': pd.to_datetime(start + rng.integers(0, 365 * 24 * 3600, rows) * 10 ** 9, utc=True),
+		'has_external_link': rng.random(rows) < 0.3,
+		'user_description': np.where(rng.random(rows) < 0.2, None, 'description of user' + names),
+		'user_following_count': rng.integers(0, 3, rows) * (user_ids % 1000),
+		'user_followers_count': user_ids % 5000,
+		'user_id': user_ids,
+	})
+
+
+def get_user_stats_baseline(corpus):
+	"""User stats as computed before get_user_stats (outer merge of the two sides + row-wise apply)"""
+	user_df = corpus[['tweet_id', 'user_screen_name', 'tweet_retweet_count', 'has_external_link', 'user_description', 'user_following_count', 'user_followers_count', 'user_id', 'created_at']]
+	user_df.created_at = pd.to_datetime(user_df.created_at)
+	user_df = user_df.sort_values('created_at')
+	user_df = user_df.drop(columns=['created_at'])
+
+	user_df = user_df.groupby(['user_id', 'has_external_link']).agg({
+		'tweet_id': 'nunique',
+		'tweet_retweet_count': 'sum',
+		'user_screen_name': 'last',
+		'user_description': 'last',
+		'user_following_count': 'last',
+		'user_followers_count': 'last',
+	}).reset_index()
+	user_df = user_df.rename(columns={'tweet_id': 'tweets_in_set'})
+	user_df_split = user_df[user_df.has_external_link].drop(
+		columns=['has_external_link'],
+	).merge(
+		user_df[~user_df.has_external_link].drop(columns=['has_external_link']),
+		on=['user_id'],
+		how='outer',
+		suffixes=('_with_external', '_without_external'),
+	).fillna(0)
+
+	def get_values(column):
+		def curried(row):
+			return row[f'{column}_with_external'] if row[f'{column}_without_external'] == 0 else row[f'{column}_without_external']
+		return curried
+
+	for column in ['user_screen_name', 'user_description', 'user_following_count', 'user_followers_count']:
+		user_df_split[column] = user_df_split.apply(get_values(column), axis=1)
+		user_df_split = user_df_split.drop(columns=[f'{column}_with_external', f'{column}_without_external'])
+
+	user_df = user_df.drop(columns=['has_external_link']).groupby(['user_id']).agg({
+		'tweets_in_set': 'sum',
+		'tweet_retweet_count': 'sum',
+		'user_screen_name': 'last',
+		'user_description': 'last',
+		'user_following_count': 'last',
+		'user_followers_count': 'last',
+	}).reset_index()
+	user_df = user_df.rename(columns={'tweets_in_set': 'tweets_in_set_total', 'tweet_retweet_count': 'tweet_retweet_count_total'})
+	return user_df_split.merge(user_df[['user_id', 'tweet_retweet_count_total', 'tweets_in_set_total']], on=['user_id'], how='inner')
+
+
+def to_csv(df):
+	output = io.StringIO()
+	df.to_csv(output, index=False, quoting=csv.QUOTE_NONNUMERIC)
+	return output.getvalue()
+
+
+def benchmark(args):
+	print(f'Generating corpus of {args["users"]} users x {args["tweets_per_user"]} tweets...')
+	corpus = make_corpus(args['users'], args['tweets_per_user'])
+
+	start = time.perf_counter()
+	user_stats = link_stats.get_user_stats(corpus)
+	elapsed = time.perf_counter() - start
+	print(f'  columnar: {elapsed:8.2f}s ({len(user_stats):,} users)')
+	if args['no_baseline']:
+		return
+
+	start = time.perf_counter()
+	baseline = get_user_stats_baseline(corpus)
+	baseline_elapsed = time.perf_counter() - start
+	print(f'  baseline: {baseline_elapsed:8.2f}s')
+	print(f'   speedup: {baseline_elapsed / elapsed:.1f}x')
+	if to_csv(user_stats) != to_csv(baseline):
+		print('MISMATCH between columnar and baseline user stats')
+		sys.exit(1)
+	print('User stats csv are identical.')
+
+
+if __name__ == '__main__':
+	pd.options.mode.chained_assignment = None
+	p = argparse.ArgumentParser(description='Benchmark the user stats of 5_get_all_tweet_external_link_stats.py')
+	p.add_argument('--users', type=int, default=5000000, help='Number of distinct users. Default: 5M')
+	p.add_argument('--tweets-per-user', type=int, default=2, help='Average number of tweets per user. Default: 2')
+	p.add_argument('--no-baseline', action='store_true', help='Use this to only time the columnar version')
+	args = vars(p.parse_args())
+	benchmark(args)
@@ -22,6 +22,8 @@ from csv import QUOTE_NONNUMERIC
 
 import pandas as pd
 
+from tweet_files import read_corpus
+
 
 def clean_keywords(categories):
     for category in categories:
@@ -74,7 +76,7 @@ if __name__ == '__main__':
         '--input-data',
         type=str,
         required=True,
-        help='Path to input data csv file with rows',
+        help='Path to input data csv file with rows (or parquet corpus directory)',
     )
     parser.add_argument(
         '-o',
@@ -109,7 +111,7 @@ if __name__ == '__main__':
     with open(args['categories'], encoding='utf-8') as f:
         categories = json.loads(f.read())['categories']
 
-    df = pd.read_csv(args['input_data'])
+    df = read_corpus(args['input_data'])
     print('Categorizing...')
     df, freq_df = categorize(categories=categories, df=df, args=args)
     df.to_csv(args['output_data'], mode='w+', encoding='utf-8', index=False, quoting=QUOTE_NONNUMERIC)
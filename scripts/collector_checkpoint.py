@@ -0,0 +1,71 @@
+"""
+Per-page checkpoint of the sequential collectors (twitter_search.py, and twitter_timeline.py without --workers)
+
+./results/<filename>_checkpoint.json is rewritten atomically (temp file, fsync, rename) every time the corpus durably
+holds every page fetched so far: after every page with csv, every --pages-per-row-group pages with parquet. It has:
+- args: the arguments of the collection, only a run with the same ones resumes it
+- position: what the corpus held then (CorpusWriter.get_position), what was written after it is dropped on resume
+- streams: for the search query or every user timeline, the pagination token of its next page, the oldest/newest
+  tweet ids and tweet count so far, and whether it was walked to the end
+
+After a crash or ctrl-c, running the same command again continues every stream from its next page, without
+fetching or writing a page twice. The checkpoint is removed once the collection is finished.
+"""
+import json
+import os
+
+
+def get_checkpoint_file_name(filename):
+	return f'./results/{filename}_checkpoint.json'
+
+
+def save_checkpoint(file_name, checkpoint):
+	with open(file_name + '.tmp', 'w') as file:
+		json.dump(checkpoint, file, indent=1)
+		file.flush()
+		os.fsync(file.fileno())
+	os.replace(file_name + '.tmp', file_name)
+
+
+def load_checkpoint(file_name, checkpoint_args):
+	"""Checkpoint of an unfinished collection with the same arguments, or None"""
+	if not os.path.isfile(file_name):
+		return None
+	with open(file_name) as file:
+		checkpoint = json.load(file)
+	if checkpoint['args'] != checkpoint_args:
+		print(f'{file_name} is the checkpoint of a collection with other arguments, starting a new one')
+		return None
+	return checkpoint
+
+
+def open_checkpoint(file_name, checkpoint_args, writer):
+	"""Checkpoint to resume (the corpus of writer restored to its position), or a new one at the current position"""
+	checkpoint = load_checkpoint(file_name, checkpoint_args)
+	if checkpoint is not None:
+		writer.restore(checkpoint['position'])
+		return checkpoint
+	checkpoint = {'args': checkpoint_args, 'position': writer.get_position(), 'streams': {}}
+	save_checkpoint(file_name, checkpoint)
+	return checkpoint
+
+
+def get_stream(checkpoint, key):
+	return checkpoint['streams'].setdefault(key, {'next_token': None, 'earliest_id': None, 'most_recent_id': None, 'tweet_count': 0, 'done': False})
+
+
+def update_checkpoint(file_name, checkpoint, writer):
+	"""Save the checkpoint if the corpus durably holds every page written to writer"""
+	if not writer.pages:
+		checkpoint['position'] = writer.get_position()
+		save_checkpoint(file_name, checkpoint)
+
+
+def remove_finished_checkpoint(file_name):
+	"""Remove the checkpoint once every stream of the collection was walked to the end"""
+	if not os.path.isfile(file_name):
+		return
+	with open(file_name) as file:
+		checkpoint = json.load(file)
+	if all(stream['done'] for stream in checkpoint['streams'].values()):
+		os.remove(file_name)
@@ -5,6 +5,8 @@ import re
 
 import pandas as pd
 
+from tweet_files import read_corpus
+
 
 pd.options.mode.chained_assignment = None
 
@@ -98,8 +100,8 @@ def filter_by_text_query(df, args):
 
 
 def filter_data(args):
-    print('Reading csv into dataframe..')
-    df = pd.read_csv(args['filename'])
+    print('Reading corpus into dataframe..')
+    df = read_corpus(args['filename'])
 
     if args['from_date'] or args['to_date'] or args['timezone']:
         df = filter_by_date(df, args)
@@ -130,7 +132,7 @@ if __name__ == '__main__':
         '--filename',
         type=str,
         required=True,
-        help='Full or relative path to the csv file. E.g. results/my_data.csv',
+        help='Full or relative path to the csv file (or parquet corpus directory). E.g. results/my_data.csv',
     )
     p.add_argument(
         '-o',
@@ -12,48 +12,78 @@ Run:
 """
 import asyncio
 import argparse
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 import csv
 from datetime import date, datetime
+import hashlib
 import json
+import os
 from pathlib import Path
+import pickle
 import re
 import sys
 import time
 from urllib.parse import urlparse
 
-import aiohttp
 from dateutil import parser
+import numpy as np
 import pandas as pd
 
+from time_buckets import format_buckets
+from tweet_files import is_parquet, iter_corpus
+from unique_users import UserKeys
+from url_cache import add_url_cache_arguments, open_url_cache
+from url_expander import add_url_expander_arguments, get_url_expander
+
+STATE_VERSION = 1
+
 
 async def parse_tweets(args):
 
 	file_path = args['filename']
-	timezone = args['timezone']  # example: 'Asia/Tokyo', 'UTC'
-	keep_rt = not args['no_keep_rt']
-	analyze_date = not args['no_analyze_date']
-	analyze_time = not args['no_analyze_time']
-	analyze_users = not args['no_analyze_users']
-	analyze_hashtags = not args['no_analyze_hashtags']
-	analyze_hashtag_dates = analyze_hashtags
-	analyze_urls = args['analyze_urls']
+	options = {
+		'timezone': args['timezone'],  # example: 'Asia/Tokyo', 'UTC'
+		'keep_rt': not args['no_keep_rt'],
+		'analyze_date': not args['no_analyze_date'],
+		'analyze_time': not args['no_analyze_time'],
+		'analyze_users': not args['no_analyze_users'],
+		'analyze_hashtags': not args['no_analyze_hashtags'],
+		'analyze_hashtag_dates': not args['no_analyze_hashtags'],
+		'analyze_urls': args['analyze_urls'],
+		'from_date': args['from_date'],
+		'to_date': args['to_date'],
+		'approximate_unique_users': args['approximate_unique_users'],
+		'hll_precision': args['hll_precision'],
+	}
 	exclude_twitter_urls = args['exclude_twitter_urls']
 	chunksize = args['chunk_size']
 	max_redirect_depth = args['max_redirect_depth']
 	from_date = args['from_date']
 	to_date = args['to_date']
 	sep = args['csv_sep']
-	hashtags = {}
-	hashtag_dates = {}
-	date_set = {}
-	time_set = {}
-	user_set = {}
-	media_set = {}
-	line_count = 0
-	skipped_tweets = {}  # reason: count
+	columnar = args['engine'] == 'columnar'
+	workers = args['workers']
+	incremental = args['incremental']
+	tweeters = UserKeys(args['approximate_unique_users'], args['hll_precision'])
+	state = get_empty_metrics_state()
 	warnings = set()
+	offset = 0  # bytes of the csv file already processed
+	columns = None
+	url_cache = open_url_cache(args) if args['analyze_urls'] else None
+	expander = await get_url_expander(args).open() if args['analyze_urls'] else None
+
+	parquet = is_parquet(file_path)
+	if incremental and parquet:
+		incremental = False
+		warnings.add('--incremental finds appended rows by byte offset, it only works on csv files. Processed the whole parquet corpus.')
+
+	if workers > 1 and not columnar:
+		columnar = True
+		warnings.add('--workers requires the columnar engine. Using --engine columnar.')
 
-	file_name = file_path.split('/')[-1].replace('.csv', '')
+	file_name = file_path.rstrip('/').split('/')[-1].replace('.csv', '').removesuffix('.parquet')
 
 	save_file_name = file_name
 	if from_date:
@@ -63,96 +93,298 @@ async def parse_tweets(args):
 	
 	Path("./results/metrics_%s/" % save_file_name).mkdir(parents=True, exist_ok=True)
 
-	for chunk in pd.read_csv(file_path, encoding="utf-8", chunksize=chunksize, iterator=True, sep=sep):
-		if 'created_at' in chunk:
-			# time filtering and timezone conversion
-			chunk.created_at = pd.to_datetime(chunk.created_at, utc=True)
-			if timezone is not None:
-				chunk.created_at = chunk.created_at.dt.tz_convert(tz=timezone)
-			if from_date is not None:
-				chunk = chunk[chunk.created_at >= from_date]
-			if to_date is not None:
-				chunk = chunk[chunk.created_at <= to_date]
-			chunk.created_at = chunk.created_at.apply(str)
-
-		# warnings
-		if 'hashtags' not in chunk and analyze_hashtags:
-			analyze_hashtags = False
-			analyze_hashtag_dates = False
-			warnings.add('"hashtags" column is required to analyze hashtags. Skipping.')
-		if 'created_at' not in chunk:
-			if timezone is not None:
-				warnings.add('"created_at" column is required for timezone conversion. Skipping.')
-			if from_date is not None or to_date is not None:
-				warnings.add('"created_at" column is required for filtering by --to-date or --from-date. Skipping.')
-			if analyze_hashtag_dates:
-				analyze_hashtag_dates = False
-				warnings.add('"created_at" column is required to analyze hashtags by date. Skipping.')
-			if analyze_date or analyze_time:
-				analyze_time = False
-				analyze_date = False
-				warnings.add('"created_at" column is required to analyze date and time metrics. Skipping.')
-		if 'text' not in chunk and analyze_urls:
-			analyze_urls = False
-			warnings.add('"text" column is required to analyze media URLs. Skipping.')	
-		if 'user_screen_name' not in chunk and analyze_users:
-			analyze_users = False
-			warnings.add('"user_screen_name" column is required to analyze user metrics. Skipping.')
-
-		for index, tweet in chunk.iterrows():
-			line_count += 1
-			is_retweet = 1 if tweet.get('is_retweet', False) == True else 0
-
-			if is_retweet and not keep_rt:
-				reason = 'Retweets while keep-rt is set to False'
-				skipped_tweets[reason] = skipped_tweets.get(reason, 0) + 1
-				continue
-
-			if analyze_hashtags:
-				hashtag_metrics(tweet, hashtags, is_retweet)
-			if analyze_hashtag_dates:
-				hashtag_date_metrics(tweet, hashtag_dates, is_retweet)
-			if analyze_date:
-				date_metrics(tweet, date_set, is_retweet)
-			if analyze_time:
-				time_metrics(tweet, time_set, is_retweet)
-			if analyze_users:
-				user_metrics(tweet, user_set, is_retweet)
-			if analyze_urls:
-				media_metrics(tweet, media_set, is_retweet)
-		if analyze_urls:
-			await expand_media_urls(media_set, exclude_twitter_urls, max_redirect_depth)
-		print('Processed %s lines.' % line_count)
+	state_file_name = './results/metrics_%s/%s_state.pickle' % (save_file_name, save_file_name)
+	settings = get_state_settings(args)
+	if incremental:
+		saved = load_metrics_state(state_file_name, file_path, settings)
+		if saved is not None:
+			options, tweeters, state, warnings, offset, columns = (
+				saved['options'], saved['tweeters'], saved['state'], saved['warnings'], saved['offset'], saved['columns'])
+			print('Resuming from %s (%s lines processed before, starting at byte %s)' % (state_file_name, state['line_count'], offset))
+
+	async def chunk_done():
+		if options['analyze_urls']:
+			await expand_media_urls(state['media_set'], exclude_twitter_urls, max_redirect_depth, expander, url_cache)
+		print('Processed %s lines.' % state['line_count'])
+
+	with nullcontext() if parquet else open(file_path, 'rb') as file:
+		if parquet:
+			reader = iter_corpus(file_path, chunksize)
+		elif offset and offset >= os.path.getsize(file_path):
+			print('No new lines since the last run.')
+			reader = []
+		elif offset:
+			# only the rows appended since the last run, the header was read back then
+			file.seek(offset)
+			reader = pd.read_csv(file, encoding="utf-8", chunksize=chunksize, iterator=True, sep=sep, header=None, names=columns)
+		else:
+			reader = pd.read_csv(file, encoding="utf-8", chunksize=chunksize, iterator=True, sep=sep)
+		if workers > 1:
+			# chunks are aggregated in parallel, partial states are merged back in file order
+			with ProcessPoolExecutor(max_workers=workers) as executor:
+				pending = deque()
+				for chunk in reader:
+					columns = columns or list(chunk.columns)
+					check_columns(chunk, options, warnings)
+					pending.append(executor.submit(aggregate_partial_state, chunk, dict(options)))
+					if len(pending) >= 2 * workers:
+						merge_metrics_state(state, tweeters, *(await asyncio.wrap_future(pending.popleft())))
+						await chunk_done()
+				while pending:
+					merge_metrics_state(state, tweeters, *(await asyncio.wrap_future(pending.popleft())))
+					await chunk_done()
+		else:
+			for chunk in reader:
+				columns = columns or list(chunk.columns)
+				check_columns(chunk, options, warnings)
+				chunk = prepare_chunk(chunk, options)
+				if columnar:
+					aggregate_chunk(chunk, options, tweeters, state)
+				else:
+					aggregate_chunk_rows(chunk, options, tweeters, state)
+				await chunk_done()
+		if not parquet:
+			offset = max(offset, file.tell())
+
+	if incremental:
+		save_metrics_state(state_file_name, file_path, settings, {
+			'options': options,
+			'tweeters': tweeters,
+			'state': state,
+			'warnings': warnings,
+			'offset': offset,
+			'columns': columns,
+		})
 		
-	print('Processed total of %s lines.' % line_count)
-	if skipped_tweets:
-		for reason, number in skipped_tweets.items():
+	print('Processed total of %s lines.' % state['line_count'])
+	if expander is not None:
+		await expander.close()
+		expander.report()
+	if url_cache is not None:
+		url_cache.close()
+		url_cache.report()
+	if state['skipped_tweets']:
+		for reason, number in state['skipped_tweets'].items():
 			warnings.add(f'Skipped {number} tweet(s). Reason: "{reason}"')
 	for warning in warnings:
 		print(f'WARNING: {warning}')
 
-	if analyze_hashtags:
-		save_hashtag_metrics(hashtags, save_file_name)
-	if analyze_hashtag_dates:
-		save_hashtag_date_metrics(hashtag_dates, save_file_name)
-	if analyze_date:
-		save_date_metrics(date_set, save_file_name)
-	if analyze_time:
-		save_time_metrics(time_set, save_file_name)
-	if analyze_users:
-		save_user_metrics(user_set, save_file_name)
-	if analyze_urls:
-		save_media_metrics(media_set, save_file_name)
-
-
-def get_initial_retweet_stat_matrix(is_retweet):
-	retweet_stats = [0, 0, [[],[]]]  # [number of og tweets, number of retweets, [list_of_og_tweeters, list_of_retweeters]]
+	if options['analyze_hashtags']:
+		save_hashtag_metrics(state['hashtags'], save_file_name)
+	if options['analyze_hashtag_dates']:
+		save_hashtag_date_metrics(state['hashtag_dates'], save_file_name)
+	if options['analyze_date']:
+		save_date_metrics(state['date_set'], save_file_name)
+	if options['analyze_time']:
+		save_time_metrics(state['time_set'], save_file_name)
+	if options['analyze_users']:
+		save_user_metrics(state['user_set'], save_file_name)
+	if options['analyze_urls']:
+		save_media_metrics(state['media_set'], save_file_name)
+
+
+def get_state_settings(args):
+	"""Arguments that change the aggregates: a saved state is only reused when these are the same"""
+	names = ['timezone', 'no_keep_rt', 'no_analyze_date', 'no_analyze_time', 'no_analyze_users', 'no_analyze_hashtags',
+		'analyze_urls', 'exclude_twitter_urls', 'max_redirect_depth', 'from_date', 'to_date', 'csv_sep',
+		'approximate_unique_users', 'hll_precision']
+	return {name: args[name] for name in names}
+
+
+def get_file_fingerprint(file_path, offset):
+	# hash of the already processed head of the file, to detect files that were rewritten instead of appended to
+	with open(file_path, 'rb') as file:
+		return hashlib.sha1(file.read(min(offset, 1024 * 1024))).hexdigest()
+
+
+def load_metrics_state(state_file_name, file_path, settings):
+	if not os.path.isfile(state_file_name):
+		return None
+	with open(state_file_name, 'rb') as file:
+		saved = pickle.load(file)
+	if saved.get('version') != STATE_VERSION or saved['settings'] != settings:
+		print(f'WARNING: {state_file_name} was made with different arguments. Processing the whole file.')
+		return None
+	if os.path.getsize(file_path) < saved['offset'] or get_file_fingerprint(file_path, saved['offset']) != saved['fingerprint']:
+		print(f'WARNING: {file_path} changed since {state_file_name} was saved. Processing the whole file.')
+		return None
+	return saved
+
+
+def save_metrics_state(state_file_name, file_path, settings, saved):
+	saved.update({
+		'version': STATE_VERSION,
+		'settings': settings,
+		'fingerprint': get_file_fingerprint(file_path, saved['offset']),
+	})
+	tmp_file_name = state_file_name + '.tmp'
+	with open(tmp_file_name, 'wb') as file:
+		pickle.dump(saved, file, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(tmp_file_name, state_file_name)
+	print(f'Saved aggregate state to {state_file_name}')
+
+
+def check_columns(chunk, options, warnings):
+	if 'hashtags' not in chunk and options['analyze_hashtags']:
+		options['analyze_hashtags'] = False
+		options['analyze_hashtag_dates'] = False
+		warnings.add('"hashtags" column is required to analyze hashtags. Skipping.')
+	if 'created_at' not in chunk:
+		if options['timezone'] is not None:
+			warnings.add('"created_at" column is required for timezone conversion. Skipping.')
+		if options['from_date'] is not None or options['to_date'] is not None:
+			warnings.add('"created_at" column is required for filtering by --to-date or --from-date. Skipping.')
+		if options['analyze_hashtag_dates']:
+			options['analyze_hashtag_dates'] = False
+			warnings.add('"created_at" column is required to analyze hashtags by date. Skipping.')
+		if options['analyze_date'] or options['analyze_time']:
+			options['analyze_time'] = False
+			options['analyze_date'] = False
+			warnings.add('"created_at" column is required to analyze date and time metrics. Skipping.')
+	if 'text' not in chunk and options['analyze_urls']:
+		options['analyze_urls'] = False
+		warnings.add('"text" column is required to analyze media URLs. Skipping.')	
+	if 'user_screen_name' not in chunk and options['analyze_users']:
+		options['analyze_users'] = False
+		warnings.add('"user_screen_name" column is required to analyze user metrics. Skipping.')
+
+
+def prepare_chunk(chunk, options):
+	if 'created_at' in chunk:
+		# time filtering and timezone conversion
+		chunk.created_at = pd.to_datetime(chunk.created_at, utc=True)
+		if options['timezone'] is not None:
+			chunk.created_at = chunk.created_at.dt.tz_convert(tz=options['timezone'])
+		if options['from_date'] is not None:
+			chunk = chunk[chunk.created_at >= options['from_date']]
+		if options['to_date'] is not None:
+			chunk = chunk[chunk.created_at <= options['to_date']]
+	return chunk
+
+
+def get_empty_metrics_state():
+	return {
+		'hashtags': {},
+		'hashtag_dates': {},
+		'date_set': {},
+		'time_set': {},
+		'user_set': {},
+		'media_set': {},
+		'line_count': 0,
+		'skipped_tweets': {},  # reason: count
+	}
+
+
+def aggregate_chunk_rows(chunk, options, tweeters, state):
+	if 'created_at' in chunk:
+		chunk.created_at = chunk.created_at.apply(str)
+
+	for index, tweet in chunk.iterrows():
+		state['line_count'] += 1
+		is_retweet = 1 if tweet.get('is_retweet', False) == True else 0
+
+		if is_retweet and not options['keep_rt']:
+			reason = 'Retweets while keep-rt is set to False'
+			state['skipped_tweets'][reason] = state['skipped_tweets'].get(reason, 0) + 1
+			continue
+
+		if options['analyze_hashtags']:
+			hashtag_metrics(tweet, tweeters, state['hashtags'], is_retweet)
+		if options['analyze_hashtag_dates']:
+			hashtag_date_metrics(tweet, tweeters, state['hashtag_dates'], is_retweet)
+		if options['analyze_date']:
+			date_metrics(tweet, tweeters, state['date_set'], is_retweet)
+		if options['analyze_time']:
+			time_metrics(tweet, tweeters, state['time_set'], is_retweet)
+		if options['analyze_users']:
+			user_metrics(tweet, state['user_set'], is_retweet)
+		if options['analyze_urls']:
+			media_metrics(tweet, state['media_set'], is_retweet)
+
+
+def aggregate_chunk(chunk, options, tweeters, state):
+	state['line_count'] += len(chunk)
+	is_retweet = get_is_retweet_column(chunk)
+	if not options['keep_rt'] and is_retweet.any():
+		reason = 'Retweets while keep-rt is set to False'
+		state['skipped_tweets'][reason] = state['skipped_tweets'].get(reason, 0) + int(is_retweet.sum())
+		chunk, is_retweet = chunk[is_retweet == 0], is_retweet[is_retweet == 0]
+	chunk = chunk.assign(_is_retweet=is_retweet)
+	if 'user_screen_name' in chunk:
+		chunk = chunk.assign(_user=tweeters.keys(chunk['user_screen_name']))
+
+	if options['analyze_hashtags']:
+		hashtag_metrics_columnar(chunk, tweeters, state['hashtags'])
+	if options['analyze_hashtag_dates']:
+		hashtag_date_metrics_columnar(chunk, tweeters, state['hashtag_dates'])
+	if options['analyze_date']:
+		date_metrics_columnar(chunk, tweeters, state['date_set'])
+	if options['analyze_time']:
+		time_metrics_columnar(chunk, tweeters, state['time_set'])
+	if options['analyze_users']:
+		user_metrics_columnar(chunk, state['user_set'])
+	if options['analyze_urls']:
+		media_metrics_columnar(chunk, state['media_set'])
+
+
+def aggregate_partial_state(chunk, options):
+	"""Worker side of --workers: aggregate one chunk into a fresh state, along with the screen names behind its user keys"""
+	tweeters = UserKeys(options['approximate_unique_users'], options['hll_precision'])
+	state = get_empty_metrics_state()
+	aggregate_chunk(prepare_chunk(chunk, options), options, tweeters, state)
+	return state, tweeters.screen_names()
+
+
+def merge_retweet_stats(retweet_stats, partial_stats, user_keys):
+	retweet_stats[0] += partial_stats[0]
+	retweet_stats[1] += partial_stats[1]
+	retweet_stats[2][0].merge(partial_stats[2][0], user_keys)
+	retweet_stats[2][1].merge(partial_stats[2][1], user_keys)
+
+
+def merge_metrics_state(state, tweeters, partial, partial_screen_names):
+	"""Merge a partial state (from aggregate_partial_state) into state, keeping the first-appearance order of keys"""
+	user_keys = tweeters.remap(partial_screen_names)
+	for name in ['hashtags', 'date_set', 'time_set']:
+		for key, partial_stats in partial[name].items():
+			if key not in state[name]:
+				state[name][key] = get_empty_retweet_stat_matrix(tweeters)
+			merge_retweet_stats(state[name][key], partial_stats, user_keys)
+	for hashtag, months in partial['hashtag_dates'].items():
+		state_months = state['hashtag_dates'].setdefault(hashtag, {})
+		for month, partial_stats in months.items():
+			if month not in state_months:
+				state_months[month] = get_empty_retweet_stat_matrix(tweeters)
+			merge_retweet_stats(state_months[month], partial_stats, user_keys)
+	for screen_name, user in partial['user_set'].items():
+		if screen_name not in state['user_set']:
+			state['user_set'][screen_name] = user
+		else:
+			state['user_set'][screen_name]['total_in_data_set'][0] += user['total_in_data_set'][0]
+			state['user_set'][screen_name]['total_in_data_set'][1] += user['total_in_data_set'][1]
+	for url, media in partial['media_set'].items():
+		if url not in state['media_set']:
+			state['media_set'][url] = media
+		else:
+			state['media_set'][url]['metrics'][0] += media['metrics'][0]
+			state['media_set'][url]['metrics'][1] += media['metrics'][1]
+	state['line_count'] += partial['line_count']
+	for reason, number in partial['skipped_tweets'].items():
+		state['skipped_tweets'][reason] = state['skipped_tweets'].get(reason, 0) + number
+
+
+def get_empty_retweet_stat_matrix(tweeters):
+	return [0, 0, [tweeters.new_set(), tweeters.new_set()]]  # [number of og tweets, number of retweets, [og_tweeters, retweeters]]
+
+
+def get_initial_retweet_stat_matrix(is_retweet, tweeters):
+	retweet_stats = get_empty_retweet_stat_matrix(tweeters)
 	retweet_stats[is_retweet] = 1
 	retweet_stats[not is_retweet] = 0
 	return retweet_stats
 
 
-def hashtag_metrics(tweet, hashtags, is_retweet):
+def hashtag_metrics(tweet, tweeters, hashtags, is_retweet):
 	if not pd.isna(tweet["hashtags"]):
 		c_hashtags = tweet["hashtags"].replace(",,",",").split(",") # possibility of empty strings joined = two commas
 		for hashtag in c_hashtags:						
@@ -160,13 +392,13 @@ def hashtag_metrics(tweet, hashtags, is_retweet):
 				if hashtag in hashtags:
 					hashtags[hashtag][is_retweet] = hashtags[hashtag][is_retweet] + 1
 				else:
-					retweet_stats = get_initial_retweet_stat_matrix(is_retweet)
+					retweet_stats = get_initial_retweet_stat_matrix(is_retweet, tweeters)
 					hashtags[hashtag] = retweet_stats
 				if 'user_screen_name' in tweet:
-					hashtags[hashtag][2][is_retweet].append(tweet["user_screen_name"])
+					hashtags[hashtag][2][is_retweet].add(tweeters.key(tweet["user_screen_name"]))
 
 
-def hashtag_date_metrics(tweet, hashtag_dates, is_retweet):
+def hashtag_date_metrics(tweet, tweeters, hashtag_dates, is_retweet):
 	tweet_created_month = parser.parse(tweet["created_at"]).strftime("%m/%Y") # month/year
 	if not pd.isna(tweet["hashtags"]):
 		c_hashtags = tweet["hashtags"].replace(",,",",").split(",") # possibility of empty strings joined = two commas
@@ -175,36 +407,36 @@ def hashtag_date_metrics(tweet, hashtag_dates, is_retweet):
 				if hashtag_dates.get(hashtag, {}).get(tweet_created_month) is not None:
 					hashtag_dates[hashtag][tweet_created_month][is_retweet] = hashtag_dates[hashtag][tweet_created_month][is_retweet] + 1
 				else:
-					retweet_stats = get_initial_retweet_stat_matrix(is_retweet)
+					retweet_stats = get_initial_retweet_stat_matrix(is_retweet, tweeters)
 					if hashtag not in hashtag_dates:
 						hashtag_dates[hashtag] = {}
 					hashtag_dates[hashtag][tweet_created_month] = retweet_stats
 				if 'user_screen_name' in tweet:
-					hashtag_dates[hashtag][tweet_created_month][2][is_retweet].append(tweet["user_screen_name"])
+					hashtag_dates[hashtag][tweet_created_month][2][is_retweet].add(tweeters.key(tweet["user_screen_name"]))
 
-def date_metrics(tweet, date_set, is_retweet):
+def date_metrics(tweet, tweeters, date_set, is_retweet):
 	#print(tweet["created_at"])
 	tweet_created_date = parser.parse(tweet["created_at"]).strftime("%m/%d/%Y")
 #	print(tweet_created_date.strftime("%m/%d/%Y"))
 #	tweet_created_date = datetime.fromisoformat(tweet_created_date).strftime("%m/%d/%Y")
 	if not tweet_created_date in date_set:
-		retweet_stats = get_initial_retweet_stat_matrix(is_retweet)
+		retweet_stats = get_initial_retweet_stat_matrix(is_retweet, tweeters)
 		date_set[tweet_created_date] = retweet_stats
 	else:
 		date_set[tweet_created_date][is_retweet] += 1
 	if 'user_screen_name' in tweet:
-		date_set[tweet_created_date][2][is_retweet].append(tweet["user_screen_name"])
+		date_set[tweet_created_date][2][is_retweet].add(tweeters.key(tweet["user_screen_name"]))
 
-def time_metrics(tweet, time_set, is_retweet):
+def time_metrics(tweet, tweeters, time_set, is_retweet):
 	tweet_created_time = parser.parse(tweet["created_at"]).strftime("%H")  #change to %I %p for AM/PM
 
 	if not tweet_created_time in time_set:
-		retweet_stats = get_initial_retweet_stat_matrix(is_retweet)
+		retweet_stats = get_initial_retweet_stat_matrix(is_retweet, tweeters)
 		time_set[tweet_created_time] = retweet_stats
 	else:
 		time_set[tweet_created_time][is_retweet] += 1
 	if 'user_screen_name' in tweet:
-		time_set[tweet_created_time][2][is_retweet].append(tweet["user_screen_name"])
+		time_set[tweet_created_time][2][is_retweet].add(tweeters.key(tweet["user_screen_name"]))
 
 
 def media_metrics(tweet, media_set, is_retweet):
@@ -222,13 +454,17 @@ def media_metrics(tweet, media_set, is_retweet):
 		media_set[url]['metrics'][is_retweet] = 1
 
 
-async def expand_media_urls(media_set, exclude_twitter_urls, max_redirect_depth):
-	async with aiohttp.ClientSession() as session:
-		tasks = []
-		for url in media_set:
-			if 'expanded' not in media_set[url]:
-				tasks.append(asyncio.ensure_future(expand_url(session, url, max_redirect_depth)))
-		expanded_urls = await asyncio.gather(*tasks)
+async def expand_media_urls(media_set, exclude_twitter_urls, max_redirect_depth, expander, url_cache=None):
+	urls = [url for url in media_set if 'expanded' not in media_set[url]]
+	cached = url_cache.get_many(urls, max_redirect_depth) if url_cache is not None else {}
+	expanded_urls = [(url,) + cached[url] for url in urls if url in cached]
+	tasks = []
+	for url in urls:
+		if url not in cached:
+			tasks.append(asyncio.ensure_future(expand_url(expander, url, max_redirect_depth, url_cache)))
+	expanded_urls.extend(await asyncio.gather(*tasks))
+	if url_cache is not None:
+		url_cache.flush()
 	for url, expanded, error, domain in expanded_urls:
 		if expanded.startswith('https://twitter.com/') and exclude_twitter_urls:
 			media_set.pop(url, None)
@@ -238,25 +474,32 @@ async def expand_media_urls(media_set, exclude_twitter_urls, max_redirect_depth)
 		media_set[url]['domain'] = domain
 
 
-async def expand_url(session, url, max_redirect_depth):
+async def expand_url(expander, url, max_redirect_depth, url_cache=None):
 	expanded = ''
 	domain = ''
 	redirect = 0
 	next_url = url
+	chain = []
+	complete = False
+	start = time.perf_counter()
 	try:
 		while redirect < max_redirect_depth:
-			async with session.head(next_url, allow_redirects=False) as res:
-				next_url = res.headers.get('location', res.headers.get('X-Redirect-To', ''))
+			status, headers, _ = await expander.fetch('HEAD', next_url, allow_redirects=False)
+			next_url = headers.get('location', headers.get('X-Redirect-To', ''))
 			if next_url == '':
+				complete = True
 				break
 			if next_url.startswith('/'):
 				next_url =  'https://' + domain + next_url
 			expanded = next_url
 			domain = urlparse(expanded).netloc or domain  # if no domain, keep last known domain
+			chain.append(expanded)
 			redirect += 1
 	except Exception:
 		pass
 	error = expanded == ''
+	if url_cache is not None:
+		url_cache.add(url, chain, complete, time.perf_counter() - start)
 	return url, expanded, error, domain
 
 def user_metrics(tweet, user_set, is_retweet):
@@ -282,6 +525,132 @@ def user_metrics(tweet, user_set, is_retweet):
 			user_set[tweet["user_screen_name"]]["total_tweets"] 
 
 
+def get_is_retweet_column(chunk):
+	if 'is_retweet' not in chunk:
+		return pd.Series(0, index=chunk.index)
+	return (chunk['is_retweet'] == True).astype(int)
+
+
+def format_created_at(created_at, fmt, unit):
+	"""
+	Format the created_at column with strftime, once per distinct `unit` (numpy datetime unit) bucket
+	Uses the local (wall) time, same as parsing the string representation of the converted timestamp
+	"""
+	return format_buckets(created_at, unit, lambda buckets: buckets.strftime(fmt))
+
+
+def explode_hashtags(chunk):
+	hashtags = chunk['hashtags'].dropna().astype(str).str.split(',').explode()
+	hashtags = hashtags[hashtags != '']  # possibility of empty strings joined = two commas
+	return chunk.loc[hashtags.index].assign(_hashtag=hashtags.values)
+
+
+def group_retweet_stats(frame, keys):
+	"""
+	Group frame by keys and get [tweets, retweets] counts and [og_tweeter_keys, retweeter_keys] per group
+	Groups are returned in order of first appearance (same as the insertion order of the row-wise path)
+	"""
+	if frame.empty:
+		return []
+	order = frame[keys].drop_duplicates()
+	order = pd.MultiIndex.from_frame(order) if len(keys) > 1 else pd.Index(order[keys[0]])
+	counts = frame.groupby(keys + ['_is_retweet']).size().unstack(fill_value=0)
+	counts = counts.reindex(index=order, columns=[0, 1], fill_value=0)
+	users, positions = np.array([], dtype=np.int64), {}
+	if '_user' in frame:
+		unique_users = frame[keys + ['_is_retweet', '_user']].drop_duplicates()
+		users = unique_users['_user'].values
+		positions = unique_users.groupby(keys + ['_is_retweet']).indices
+	no_users = np.array([], dtype=int)
+	result = []
+	for key, normal, retweet in zip(counts.index, counts[0], counts[1]):
+		group = key if isinstance(key, tuple) else (key,)
+		group_users = [users[positions.get(group + (0,), no_users)], users[positions.get(group + (1,), no_users)]]
+		result.append((key, int(normal), int(retweet), group_users))
+	return result
+
+
+def update_retweet_stats(retweet_stats, normal, retweet, users):
+	retweet_stats[0] += normal
+	retweet_stats[1] += retweet
+	retweet_stats[2][0].update(users[0])
+	retweet_stats[2][1].update(users[1])
+
+
+def hashtag_metrics_columnar(chunk, tweeters, hashtags):
+	for hashtag, normal, retweet, users in group_retweet_stats(explode_hashtags(chunk), ['_hashtag']):
+		if hashtag not in hashtags:
+			hashtags[hashtag] = get_empty_retweet_stat_matrix(tweeters)
+		update_retweet_stats(hashtags[hashtag], normal, retweet, users)
+
+
+def hashtag_date_metrics_columnar(chunk, tweeters, hashtag_dates):
+	frame = explode_hashtags(chunk)
+	frame = frame.assign(_month=format_created_at(frame.created_at, '%m/%Y', 'M'))  # month/year
+	for (hashtag, month), normal, retweet, users in group_retweet_stats(frame, ['_hashtag', '_month']):
+		months = hashtag_dates.setdefault(hashtag, {})
+		if month not in months:
+			months[month] = get_empty_retweet_stat_matrix(tweeters)
+		update_retweet_stats(months[month], normal, retweet, users)
+
+
+def date_metrics_columnar(chunk, tweeters, date_set):
+	frame = chunk.assign(_date=format_created_at(chunk.created_at, '%m/%d/%Y', 'D'))
+	for day, normal, retweet, users in group_retweet_stats(frame, ['_date']):
+		if day not in date_set:
+			date_set[day] = get_empty_retweet_stat_matrix(tweeters)
+		update_retweet_stats(date_set[day], normal, retweet, users)
+
+
+def time_metrics_columnar(chunk, tweeters, time_set):
+	frame = chunk.assign(_time=format_created_at(chunk.created_at, '%H', 'h'))  #change to %I %p for AM/PM
+	for hour, normal, retweet, users in group_retweet_stats(frame, ['_time']):
+		if hour not in time_set:
+			time_set[hour] = get_empty_retweet_stat_matrix(tweeters)
+		update_retweet_stats(time_set[hour], normal, retweet, users)
+
+
+def media_metrics_columnar(chunk, media_set):
+	urls = chunk['text'].str.extract(r'^.*(https://t.co/[a-zA-Z0-9]+)', expand=False)
+	frame = chunk.assign(_url=urls).dropna(subset=['_url'])
+	for url, normal, retweet, _ in group_retweet_stats(frame[['_url', '_is_retweet']], ['_url']):
+		if url not in media_set:
+			media_set[url] = {'metrics': [0, 0]}  # [tweets, retweets]
+		media_set[url]['metrics'][0] += normal
+		media_set[url]['metrics'][1] += retweet
+
+
+def user_metrics_columnar(chunk, user_set):
+	def column(name, default):
+		return chunk[name] if name in chunk else pd.Series(default, index=chunk.index)
+
+	counts = chunk.groupby(['user_screen_name', '_is_retweet']).size().unstack(fill_value=0)
+	counts = counts.reindex(columns=[0, 1], fill_value=0)
+	firsts = ~chunk['user_screen_name'].duplicated()
+	users = zip(
+		chunk['user_screen_name'][firsts],
+		column('user_description', '')[firsts],
+		column('user_following_count', -1)[firsts],
+		column('user_followers_count', -1)[firsts],
+		column('user_total_tweets', -1)[firsts],
+		column('user_created_at', '')[firsts],
+	)
+	for screen_name, description, following_count, followers_count, total_tweets, created_at in users:
+		if screen_name not in user_set:
+			user_set[screen_name] = {
+				'screen_name': screen_name,
+				'description': description,
+				'following_count': following_count,
+				'followers_count': followers_count,
+				'total_tweets': total_tweets,
+				'created_at': created_at,
+				'total_in_data_set': [0, 0],
+			}
+	for screen_name, normal, retweet in zip(counts.index, counts[0], counts[1]):
+		user_set[screen_name]['total_in_data_set'][0] += int(normal)
+		user_set[screen_name]['total_in_data_set'][1] += int(retweet)
+
+
 def save_hashtag_metrics(hashtags, file_name):
 	with open('./results/metrics_%s/%s_hashtags.csv' % (file_name, file_name), 
 		mode='w', encoding="utf-8",newline='') as file_hashtags:
@@ -290,11 +659,10 @@ def save_hashtag_metrics(hashtags, file_name):
 			"total","unique_tweeters", "re_unique_tweeters", "re_unique_tweeters_filtered", "total"])
 
 		for hashtag, value in hashtags.items():
-			normal = set(value[2][0])
-			retweet = set(value[2][1])
-			unique = [x for x in retweet if x not in normal]
+			normal, retweet = value[2]
+			unique = retweet.count_not_in(normal)
 			writer_hashtags.writerow([hashtag, value[0], value[1], value[0] + value[1], str(len(normal)), 
-				str(len(retweet)), str(len(unique)), str(len(normal) + len(unique))])
+				str(len(retweet)), str(unique), str(len(normal) + unique)])
 	print("Finished. Saved to ./results/metrics_%s/%s_hashtags.csv" % (file_name, file_name))
 
 
@@ -307,11 +675,10 @@ def save_hashtag_date_metrics(hashtag_dates, file_name):
 
 		for hashtag, months in hashtag_dates.items():
 			for month, value in months.items():
-				normal = set(value[2][0])
-				retweet = set(value[2][1])
-				unique = [x for x in retweet if x not in normal]
+				normal, retweet = value[2]
+				unique = retweet.count_not_in(normal)
 				writer_hashtags.writerow([hashtag, month, value[0], value[1], value[0] + value[1], str(len(normal)), 
-					str(len(retweet)), str(len(unique)), str(len(normal) + len(unique))])
+					str(len(retweet)), str(unique), str(len(normal) + unique)])
 	print("Finished. Saved to ./results/metrics_%s/%s_hashtag_dates.csv" % (file_name, file_name))
 
 
@@ -326,12 +693,11 @@ def save_date_metrics(date_set, file_name):
 		for date, value in date_set.items():
 			#unique_users[is_retweet]
 
-			normal = set(value[2][0])
-			retweet = set(value[2][1])
-			unique = [x for x in retweet if x not in normal]
+			normal, retweet = value[2]
+			unique = retweet.count_not_in(normal)
 			writer_date.writerow([date, value[0], value[1], value[0] + value[1], 
-				str(len(normal)), str(len(retweet) - len(unique)), str(len(unique)), str(len(retweet)), 
-				str(len(normal) + len(unique))])
+				str(len(normal)), str(len(retweet) - unique), str(unique), str(len(retweet)), 
+				str(len(normal) + unique)])
 
 	print("Finished. Saved to ./results/metrics_%s/%s_date.csv" % (file_name, file_name))
 
@@ -344,11 +710,10 @@ def save_time_metrics(time_set, file_name):
 			"re_unique_tweeters", "re_unique_tweeters_filtered", "total_tweeters"])
 
 		for hour, value in time_set.items():
-			normal = set(value[2][0])
-			retweet = set(value[2][1])
-			unique = [x for x in retweet if x not in normal]
+			normal, retweet = value[2]
+			unique = retweet.count_not_in(normal)
 			writer_time.writerow([hour, value[0], value[1], value[0] + value[1], 
-				str(len(normal)), str(len(retweet)), str(len(unique)), str(len(normal) + len(retweet))])
+				str(len(normal)), str(len(retweet)), str(unique), str(len(normal) + len(retweet))])
 	print("Finished. Saved to ./results/metrics_%s/%s_time.csv" % (file_name, file_name))
 
 
@@ -389,7 +754,7 @@ if __name__ == '__main__':
 		'--filename',
 		type=str,
 		required=True,
-		help='Full or relative path to the csv file. E.g. results/my_data.csv',
+		help='Full or relative path to the csv file (or parquet corpus directory). E.g. results/my_data.csv',
 	)
 	p.add_argument(
 		'-c',
@@ -445,6 +810,8 @@ if __name__ == '__main__':
 		default=1,
 		help='Max depth to follow redirects when analyzing URLs. Default is the minimum: 1 (get link after t.co). WARNING: exponentially slower with each added layer of depth',
 	)
+	add_url_cache_arguments(p)
+	add_url_expander_arguments(p)
 	p.add_argument(
 		'--from-date',
 		type=str,
@@ -455,6 +822,36 @@ if __name__ == '__main__':
 		type=str,
 		help='Format: YYYY-MM-DD. Use only if you want to limit processing to a certain date (not datetime)',
 	)
+	p.add_argument(
+		'--engine',
+		type=str,
+		default='columnar',
+		choices=['columnar', 'rows'],
+		help='columnar: aggregate every chunk with grouped column operations (fast). rows: process tweet by tweet (legacy). Default: columnar',
+	)
+	p.add_argument(
+		'-w',
+		'--workers',
+		type=int,
+		default=1,
+		help='Number of processes aggregating chunks in parallel (partial results are merged afterwards). Default: 1',
+	)
+	p.add_argument(
+		'--incremental',
+		action='store_true',
+		help='Use this to keep the aggregates in the metrics directory and, on later runs, only process rows appended to the csv file since then',
+	)
+	p.add_argument(
+		'--approximate-unique-users',
+		action='store_true',
+		help='Use this to estimate unique (re)tweeter counts with a HyperLogLog sketch instead of exact sets (less memory on huge corpora)',
+	)
+	p.add_argument(
+		'--hll-precision',
+		type=int,
+		default=12,
+		help='Precision (11-18) of the sketch used by --approximate-unique-users: ~1.04/sqrt(2^precision) error, 2^precision bytes per bucket. Default: 12',
+	)
 	p.add_argument(
 		'--csv-sep',
 		type=str,
@@ -0,0 +1,106 @@
+"""
+Keyed on-disk store for the media pipeline (--store): one SQLite file with the tables of steps 1 to 3
+
+- tweet_links (step 1): one row per link of a tweet, row_id is the row number of the _tweet_links csv
+- dictionary (step 1, replaced by step 2 once its URLs are expanded): one row per (url, user_screen_name)
+- processed (step 3): the processed dictionary
+
+Tables are indexed on tweet_id, url and (url, user_screen_name): step 4 joins the tweet links with the processed
+dictionary and step 5 finds the tweets with external links inside SQLite, instead of parsing both csv files into
+memory and merging them with pandas. The csv files are still written as before.
+"""
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+INDEXES = {
+	'tweet_links': [['tweet_id'], ['url', 'user_screen_name']],
+	'dictionary': [['url', 'user_screen_name']],
+	'processed': [['url', 'user_screen_name']],
+}
+
+
+class LinkStore:
+	def __init__(self, path):
+		Path(path).parent.mkdir(parents=True, exist_ok=True)
+		self.path = path
+		self.connection = sqlite3.connect(path)
+		self.connection.execute('PRAGMA journal_mode=WAL')
+
+	def drop(self, table):
+		with self.connection:
+			self.connection.execute(f'DROP TABLE IF EXISTS {table}')
+
+	def append(self, table, df):
+		"""Add the rows of df to table (created on the first call), the index of df is kept as row_id"""
+		# empty strings are stored as NULL, the way they read back from the csv files
+		text_columns = df.columns[df.dtypes == object]
+		df = df.assign(**{column: df[column].mask(df[column] == '') for column in text_columns})
+		df.to_sql(table, self.connection, if_exists='append', index=True, index_label='row_id', chunksize=50000)
+
+	def replace(self, table, chunks):
+		"""table with the rows of every DataFrame of chunks, indexed"""
+		self.drop(table)
+		for chunk in chunks:
+			self.append(table, chunk)
+		self.index(table)
+
+	def index(self, table):
+		with self.connection:
+			for columns in INDEXES[table]:
+				self.connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_{"_".join(columns)} ON {table} ({", ".join(columns)})')
+
+	def query(self, sql):
+		"""DataFrame of the rows of an SQL query, with NULL as NaN like in the csv files"""
+		df = pd.read_sql_query(sql, self.connection)
+		return df.where(df.notna(), np.nan)
+
+	def columns(self, table):
+		return [row[1] for row in self.connection.execute(f'PRAGMA table_info({table})')]
+
+	def check(self, *tables):
+		missing = [table for table in tables if not self.columns(table)]
+		if missing:
+			raise ValueError(f'Table(s) {", ".join(missing)} missing from {self.path}, run the steps writing them with --store first')
+
+	def join_links(self, table):
+		"""Tweet links left joined with table on (url, user_screen_name), in the order of the _tweet_links csv"""
+		self.check('tweet_links', table)
+		link_columns = [f'l.{column}' for column in self.columns('tweet_links')]
+		joined_columns = [f'j.{column}' for column in self.columns(table) if column not in ('row_id', 'url', 'user_screen_name')]
+		return self.query(
+			f'SELECT {", ".join(link_columns + joined_columns)} FROM tweet_links l '
+			f'LEFT JOIN {table} j ON j.url = l.url AND j.user_screen_name = l.user_screen_name ORDER BY l.row_id'
+		)
+
+	def read(self, table, columns):
+		self.check(table)
+		return self.query(f'SELECT {", ".join(columns)} FROM {table} ORDER BY row_id')
+
+	def get_tweet_ids_without_urls(self, urls):
+		"""Distinct tweet_id of the tweet links, except the links to urls"""
+		self.check('tweet_links')
+		with self.connection:
+			self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS excluded_urls (url TEXT PRIMARY KEY)')
+			self.connection.execute('DELETE FROM excluded_urls')
+			self.connection.executemany('INSERT OR IGNORE INTO excluded_urls (url) VALUES (?)', ((url,) for url in urls))
+		return self.query('SELECT DISTINCT tweet_id FROM tweet_links WHERE url IS NULL OR url NOT IN (SELECT url FROM excluded_urls)')['tweet_id']
+
+	def close(self):
+		self.connection.close()
+
+
+def add_link_store_arguments(p):
+	p.add_argument(
+		'--store',
+		type=str,
+		help='SQLite file shared by the media pipeline steps, e.g. results/my_data_links.sqlite. Steps 1 to 3 write their tables into it, steps 4 and 5 read them from it instead of the csv files (Optional)',
+	)
+
+
+def open_link_store(args):
+	if args['store'] is None:
+		return None
+	return LinkStore(args['store'])
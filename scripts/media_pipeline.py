@@ -0,0 +1,345 @@
+"""
+Run the media analysis pipeline (1_extract_media.py to 5_get_all_tweet_external_link_stats.py) as cached stages
+
+	extract (1) -> reanalyze (2) -> process (3) -> metrics (4)
+	              reanalyze (2) -> stats (5)
+
+Every stage runs in its own directory of --cache-dir (default: ./results/pipeline_cache), named after a hash of:
+- the stage's script and the local modules it imports
+- its arguments (the --<stage>-args of this script)
+- its inputs: the content of the corpus, or the hash of the stage that made them
+A stage whose directory is complete is not run again, so after a change only the stages depending on it are.
+Stages whose inputs are ready run concurrently (up to --jobs), e.g. step 5 alongside steps 3 and 4.
+The files of every stage are then linked next to --output-filename, with the suffixes of the scripts.
+
+Usage: `$ python media_pipeline.py -cf results/my_data.csv -of results/media/my_data.csv --metrics-args="--all-granularities"`
+"""
+import argparse
+import ast
+import asyncio
+import glob
+import hashlib
+import json
+import os
+from pathlib import Path
+import shlex
+import shutil
+import sys
+
+from tweet_files import is_parquet
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+
+
+class StageSkipped(Exception):
+	pass
+
+
+class Stage:
+	def __init__(self, name, script, inputs, args, publish, data_files=()):
+		self.name = name
+		self.script = script
+		self.data_files = data_files  # files of the scripts directory the script reads by default, hashed with its code
+		self.inputs = inputs  # {file name in the stage directory: (stage making it or None for the corpus, its file name there)}
+		self.args = args  # script arguments, paths relative to the stage directory
+		self.publish = publish  # {file name: suffix of the published file}, or the prefix of the files published with their suffix
+
+	def depends_on(self):
+		return sorted({stage for stage, _ in self.inputs.values() if stage is not None})
+
+
+CORPUS_FILE_NAME = 'corpus.csv'  # the corpus in the stage directories, corpus.parquet for a parquet corpus
+STAGES = [
+	Stage(
+		'extract', '1_extract_media.py',
+		inputs={CORPUS_FILE_NAME: (None, None)},
+		args=['-cf', CORPUS_FILE_NAME],
+		publish={'corpus_tweet_links.csv': '_tweet_links'},
+	),
+	Stage(
+		'reanalyze', '2_reanalyze_media.py',
+		inputs={'dictionary.csv': ('extract', 'corpus_dictionary.csv')},
+		args=['-f', 'dictionary.csv'],
+		publish={'dictionary.csv': '_dictionary'},
+	),
+	Stage(
+		'process', '3_process_url_dictionary.py',
+		inputs={'dictionary.csv': ('reanalyze', 'dictionary.csv')},
+		args=['-df', 'dictionary.csv'],
+		publish={'dictionary_processed.csv': '_dictionary_processed'},
+		data_files=['url_rules.json'],
+	),
+	Stage(
+		'metrics', '4_expand_media_metrics.py',
+		inputs={'tweet_links.csv': ('extract', 'corpus_tweet_links.csv'), 'dictionary.csv': ('process', 'dictionary_processed.csv')},
+		args=['-lf', 'tweet_links.csv', '-df', 'dictionary.csv', '-of', 'output.csv'],
+		publish='output',
+	),
+	Stage(
+		'stats', '5_get_all_tweet_external_link_stats.py',
+		inputs={CORPUS_FILE_NAME: (None, None), 'dictionary.csv': ('reanalyze', 'dictionary.csv'), 'tweet_links.csv': ('extract', 'corpus_tweet_links.csv')},
+		args=['-cf', CORPUS_FILE_NAME, '-df', 'dictionary.csv', '-lf', 'tweet_links.csv', '-of', 'output.csv'],
+		publish='output',
+	),
+]
+CORPUS_STAGES = ['extract', 'stats']  # the ones reading the corpus, which get --csv-sep
+
+
+def get_local_modules(script, found=None):
+	"""script and the modules of the scripts directory it imports, recursively"""
+	found = set() if found is None else found
+	found.add(script)
+	tree = ast.parse((SCRIPTS_DIR / script).read_text(encoding='utf-8'))
+	for node in ast.walk(tree):
+		if isinstance(node, ast.Import):
+			names = [alias.name for alias in node.names]
+		elif isinstance(node, ast.ImportFrom) and node.module is not None and not node.level:
+			names = [node.module]
+		else:
+			continue
+		for name in names:
+			module = name.split('.')[0] + '.py'
+			if module not in found and (SCRIPTS_DIR / module).is_file():
+				get_local_modules(module, found)
+	return found
+
+
+def get_code_hash(stage):
+	sha = hashlib.sha256()
+	for file_name in sorted(get_local_modules(stage.script)) + list(stage.data_files):
+		sha.update(file_name.encode('utf-8') + b'\0' + (SCRIPTS_DIR / file_name).read_bytes() + b'\0')
+	return sha.hexdigest()
+
+
+def get_source_files(file_name):
+	"""The files of a source: itself, or the part files of a parquet corpus directory (not the hidden ones being written)"""
+	if not os.path.isdir(file_name):
+		return [Path(file_name)]
+	return sorted(
+		path for path in Path(file_name).rglob('*')
+		if path.is_file() and not any(part.startswith(('.', '_')) for part in path.relative_to(file_name).parts)
+	)
+
+
+def get_file_fingerprint(file_name):
+	fingerprint = []
+	for path in get_source_files(file_name):
+		stat = path.stat()
+		fingerprint.append([path.relative_to(file_name).as_posix() if path != Path(file_name) else '', stat.st_size, stat.st_mtime_ns])
+	return fingerprint
+
+
+def get_source_hash(cache_dir, file_name):
+	"""sha256 of a source's content (its part files, by name, for a directory), remembered in the cache directory as long as its size and mtime don't change"""
+	sources_file_name = os.path.join(cache_dir, 'sources.json')
+	sources = {}
+	if os.path.isfile(sources_file_name):
+		with open(sources_file_name, encoding='utf-8') as file:
+			sources = json.load(file)
+	key = os.path.abspath(file_name)
+	fingerprint = get_file_fingerprint(file_name)
+	if key in sources and sources[key]['fingerprint'] == fingerprint:
+		return sources[key]['sha256']
+
+	print(f'Hashing {file_name}...')
+	sha = hashlib.sha256()
+	for path, _, _ in fingerprint:
+		if path:
+			sha.update(path.encode('utf-8') + b'\0')
+		with open(os.path.join(file_name, path) if path else file_name, 'rb') as file:
+			for block in iter(lambda: file.read(1 << 20), b''):
+				sha.update(block)
+	sources[key] = {'fingerprint': fingerprint, 'sha256': sha.hexdigest()}
+	with open(sources_file_name + '.tmp', 'w', encoding='utf-8') as file:
+		json.dump(sources, file, indent=2)
+	os.replace(sources_file_name + '.tmp', sources_file_name)
+	return sources[key]['sha256']
+
+
+def get_stage_file_name(args, file_name):
+	"""Name of a file in the stage directories, corpus.parquet for a parquet corpus so the scripts read it as one"""
+	if file_name == CORPUS_FILE_NAME and is_parquet(args['corpus_filename']):
+		return 'corpus.parquet'
+	return file_name
+
+
+def get_stage_args(args, stage, work_dir=None):
+	"""Arguments of a stage's script, with the paths of its files in work_dir if given"""
+	stage_args = [arg if arg.startswith('-') else get_stage_file_name(args, arg) for arg in stage.args]
+	stage_args = [
+		os.path.join(work_dir, arg) if work_dir is not None and not arg.startswith('-') else arg
+		for arg in stage_args
+	]
+	stage_args += shlex.split(args[f'{stage.name}_args'] or '')
+	if stage.name in CORPUS_STAGES:
+		stage_args += ['--csv-sep', args['csv_sep']]
+	return stage_args
+
+
+def get_stage_keys(args, corpus_hash):
+	"""{stage name: hash of its script, arguments and inputs}, stages come after the ones they depend on"""
+	keys = {}
+	for stage in STAGES:
+		sha = hashlib.sha256()
+		sha.update(json.dumps({
+			'stage': stage.name,
+			'code': get_code_hash(stage),
+			'args': get_stage_args(args, stage),
+			'inputs': {
+				file_name: corpus_hash if source is None else [keys[source], source_file_name]
+				for file_name, (source, source_file_name) in sorted(stage.inputs.items())
+			},
+		}, sort_keys=True).encode('utf-8'))
+		keys[stage.name] = sha.hexdigest()[:24]
+	return keys
+
+
+def link_file(source, target):
+	"""target as a link to source (hard, or else symbolic, or else a copy): files of finished stages never change"""
+	for link in [lambda: os.link(source, target), lambda: os.symlink(os.path.abspath(source), target)]:
+		try:
+			link()
+			return
+		except (OSError, NotImplementedError):
+			pass
+	if os.path.isdir(source):  # a parquet corpus, which can't be hard linked
+		shutil.copytree(source, target)
+	else:
+		shutil.copyfile(source, target)
+
+
+def get_stage_dir(cache_dir, name, key):
+	return os.path.join(cache_dir, name, key)
+
+
+def get_published_files(stage, stage_dir):
+	"""[(file in the stage directory, suffix)] to link next to --output-filename"""
+	if isinstance(stage.publish, dict):
+		return [(os.path.join(stage_dir, file_name), suffix) for file_name, suffix in stage.publish.items()]
+	files = sorted(glob.glob(os.path.join(glob.escape(stage_dir), stage.publish + '_*.csv')))
+	return [(file_name, os.path.basename(file_name)[len(stage.publish):-len('.csv')]) for file_name in files]
+
+
+async def run_stage(args, stage, stage_dir, corpus_filename):
+	"""Run a stage in stage_dir + '.partial' (kept if it fails, so an interrupted step 2 resumes), then complete it"""
+	work_dir = stage_dir + '.partial'
+	os.makedirs(work_dir, exist_ok=True)
+	for file_name, (source, source_file_name) in stage.inputs.items():
+		target = os.path.join(work_dir, get_stage_file_name(args, file_name))
+		if not os.path.lexists(target):
+			if source is None:
+				link_file(corpus_filename, target)
+			else:
+				link_file(os.path.join(get_stage_dir(args['cache_dir'], source, args['keys'][source]), source_file_name), target)
+
+	log_file_name = os.path.join(work_dir, 'log.txt')
+	command = [sys.executable, str(SCRIPTS_DIR / stage.script)] + get_stage_args(args, stage, work_dir)
+	with open(log_file_name, 'ab') as log:
+		process = await asyncio.create_subprocess_exec(*command, stdout=log, stderr=asyncio.subprocess.STDOUT)
+		return_code = await process.wait()
+	if return_code != 0:
+		with open(log_file_name, encoding='utf-8', errors='replace') as log:
+			tail = log.readlines()[-20:]
+		raise RuntimeError(f'{stage.script} failed with exit code {return_code}, log in {log_file_name}:\n{"".join(tail)}')
+	os.replace(work_dir, stage_dir)
+
+
+async def run_pipeline(args):
+	corpus_filename = args['corpus_filename']
+	output_filename = args['output_filename']
+	cache_dir = args['cache_dir']
+	os.makedirs(cache_dir, exist_ok=True)
+
+	keys = args['keys'] = get_stage_keys(args, get_source_hash(cache_dir, corpus_filename))
+	stale = [stage.name for stage in STAGES if not os.path.isdir(get_stage_dir(cache_dir, stage.name, keys[stage.name]))]
+	for stage in STAGES:
+		print(f'{stage.name:>9} ({stage.script}): {"stale, will run" if stage.name in stale else "up to date"} [{keys[stage.name]}]')
+	if args['dry_run']:
+		return True
+
+	jobs = asyncio.Semaphore(args['jobs'])
+	tasks = {}
+
+	async def run(stage):
+		for dependency in stage.depends_on():
+			try:
+				await tasks[dependency]
+			except Exception:
+				raise StageSkipped(f'{dependency} failed')
+		if stage.name in stale:
+			async with jobs:
+				print(f'Running {stage.name} ({stage.script})...')
+				await run_stage(args, stage, get_stage_dir(cache_dir, stage.name, keys[stage.name]), corpus_filename)
+				print(f'Finished {stage.name}')
+
+	# stages are listed after their dependencies, so every task they await already exists
+	for stage in STAGES:
+		tasks[stage.name] = asyncio.ensure_future(run(stage))
+	results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+	os.makedirs(os.path.dirname(output_filename) or '.', exist_ok=True)
+	failed = False
+	for stage, result in zip(STAGES, results):
+		if isinstance(result, Exception):
+			failed = True
+			print(f'{"Skipped" if isinstance(result, StageSkipped) else "ERROR in"} {stage.name}: {result}')
+			continue
+		for file_name, suffix in get_published_files(stage, get_stage_dir(cache_dir, stage.name, keys[stage.name])):
+			target = output_filename.removesuffix('.csv') + suffix + '.csv'
+			if os.path.lexists(target):
+				os.remove(target)
+			link_file(file_name, target)
+	if not failed:
+		print(f'Done! Results are linked next to {output_filename}')
+	return not failed
+
+
+if __name__ == '__main__':
+	p = argparse.ArgumentParser(description='Run the media analysis pipeline (steps 1 to 5), re-running only the stages whose inputs, arguments or code changed')
+	p.add_argument(
+		'-cf',
+		'--corpus-filename',
+		type=str,
+		required=True,
+		help='Full or relative path to the corpus csv file, or parquet directory (--format parquet of the collectors). E.g. results/my_data.csv',
+	)
+	p.add_argument(
+		'-of',
+		'--output-filename',
+		type=str,
+		required=True,
+		help='Full or relative path to link the resulting csv files to (will be edited with suffixes). E.g. results/media/my_data.csv',
+	)
+	p.add_argument(
+		'--csv-sep',
+		type=str,
+		default=',',
+		choices=[',', ';', '\\t', '|'],
+		help='Separator of the corpus csv file. Default: ","',
+	)
+	p.add_argument(
+		'--cache-dir',
+		type=str,
+		default='./results/pipeline_cache',
+		help='Directory keeping the files of every stage run, by hash. Default: ./results/pipeline_cache',
+	)
+	p.add_argument(
+		'-j',
+		'--jobs',
+		type=int,
+		default=2,
+		help='Max number of stages running at the same time. Default: 2',
+	)
+	p.add_argument(
+		'--dry-run',
+		action='store_true',
+		help='Use this to only show which stages are stale',
+	)
+	for stage in STAGES:
+		p.add_argument(
+			f'--{stage.name}-args',
+			type=str,
+			help=f'Extra arguments for {stage.script}, as one quoted string after an "=", e.g. --{stage.name}-args="--chunk-size 1000"',
+		)
+	args = vars(p.parse_args())
+	if not asyncio.run(run_pipeline(args)):
+		sys.exit(1)
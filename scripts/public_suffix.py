@@ -0,0 +1,163 @@
+"""
+Offline domain splitting for 3_process_url_dictionary.py and 5_get_all_tweet_external_link_stats.py
+
+Gives the same (subdomain, domain, suffix) split as tldextract.extract(url) (public ICANN suffixes only), but the
+Public Suffix List is never fetched over the network:
+- the list is read from a local file (--suffix-list, e.g. a downloaded public_suffix_list.dat),
+  or else the snapshot bundled with tldextract
+- it is compiled into a trie of reversed labels, pickled to --suffix-index (default: ./results/public_suffix_index.pickle)
+  and loaded from there on the next runs, as long as the list didn't change
+"""
+import hashlib
+from ipaddress import AddressValueError, IPv6Address
+import os
+from pathlib import Path
+import pickle
+import pkgutil
+import re
+from urllib.parse import scheme_chars
+
+import idna
+
+SUFFIX_RE = re.compile(r'^(?P<suffix>[.*!]*\w[\S]*)', re.UNICODE | re.MULTILINE)
+PRIVATE_DOMAINS_SEPARATOR = '// ===BEGIN PRIVATE DOMAINS==='
+IP_RE = re.compile(
+	r'^(?:(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}(?:[0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$',
+	re.ASCII,
+)
+SCHEME_CHARS = set(scheme_chars)
+INDEX_VERSION = 1
+
+
+class PublicSuffixList:
+	def __init__(self, trie):
+		self.trie = trie  # reversed labels: {label: node}, a node with a None key ends a suffix
+		self.hosts = {}
+
+	@classmethod
+	def from_text(cls, text):
+		trie = {}
+		for match in SUFFIX_RE.finditer(text.partition(PRIVATE_DOMAINS_SEPARATOR)[0]):
+			node = trie
+			for label in reversed(match.group('suffix').split('.')):
+				node = node.setdefault(label, {})
+			node[None] = True
+		return cls(trie)
+
+	@classmethod
+	def load(cls, suffix_list_file=None, index_file=None):
+		"""Suffix list from suffix_list_file or tldextract's snapshot, compiled once and cached in index_file"""
+		if suffix_list_file is not None:
+			source = Path(suffix_list_file).read_bytes()
+		else:
+			source = pkgutil.get_data('tldextract', '.tld_set_snapshot')
+		source_hash = hashlib.sha1(source).hexdigest()
+		if index_file is not None and os.path.isfile(index_file):
+			with open(index_file, 'rb') as file:
+				index = pickle.load(file)
+			if index['version'] == INDEX_VERSION and index['source_hash'] == source_hash:
+				return cls(index['trie'])
+		suffixes = cls.from_text(source.decode('utf-8'))
+		if index_file is not None:
+			try:
+				Path(index_file).parent.mkdir(parents=True, exist_ok=True)
+				# per process, steps 3 and 5 may build the index at the same time
+				tmp_file = f'{index_file}.{os.getpid()}.tmp'
+				with open(tmp_file, 'wb') as file:
+					pickle.dump({'version': INDEX_VERSION, 'source_hash': source_hash, 'trie': suffixes.trie}, file, pickle.HIGHEST_PROTOCOL)
+				os.replace(tmp_file, index_file)
+			except OSError as e:
+				print(f'WARNING: could not save the public suffix index to {index_file} ({e})')
+		return suffixes
+
+	def extract(self, url):
+		"""(subdomain, domain, suffix) of url, like tldextract.extract"""
+		host = get_host(url)
+		result = self.hosts.get(host)
+		if result is None:
+			result = self.hosts[host] = self.split_host(host)
+		return result
+
+	def split_host(self, host):
+		host = host.replace('。', '.').replace('．', '.').replace('｡', '.')
+		if len(host) >= 4 and host[0] == '[' and host[-1] == ']' and looks_like_ipv6(host[1:-1]):
+			return '', host, ''
+		labels = host.split('.')
+		suffix_index = self.suffix_index(labels)
+		if suffix_index is None:
+			if len(labels) == 4 and host[0].isdecimal() and IP_RE.fullmatch(host):
+				return '', host, ''
+			return '.'.join(labels[:-1]), labels[-1], ''
+		subdomain = '.'.join(labels[:suffix_index - 1]) if suffix_index >= 2 else ''
+		domain = labels[suffix_index - 1] if suffix_index > 0 else ''
+		return subdomain, domain, '.'.join(labels[suffix_index:])
+
+	def suffix_index(self, labels):
+		"""Index of the first label of the public suffix, None if there's none"""
+		node = self.trie
+		suffix_index = label_index = len(labels)
+		for label in reversed(labels):
+			label = decode_punycode(label)
+			child = node.get(label)
+			if child is not None:
+				label_index -= 1
+				node = child
+				if None in node:
+					suffix_index = label_index
+				continue
+			if '*' in node:
+				return label_index if '!' + label in node else label_index - 1
+			break
+		return suffix_index if suffix_index < len(labels) else None
+
+
+def get_host(url):
+	"""Host of a URL-like string, with its case (parses more leniently than urlparse)"""
+	double_slashes = url.find('//')
+	if double_slashes == 0:
+		url = url[2:]
+	elif double_slashes >= 2 and url[double_slashes - 1] == ':' and not set(url[:double_slashes - 1]) - SCHEME_CHARS:
+		url = url[double_slashes + 2:]
+	authority = url.partition('/')[0].partition('?')[0].partition('#')[0]
+	after_userinfo = authority.rpartition('@')[-1]
+	if after_userinfo and after_userinfo[0] == '[':
+		maybe_ipv6 = after_userinfo.partition(']')
+		if maybe_ipv6[1] == ']':
+			return f'{maybe_ipv6[0]}]'
+	return after_userinfo.partition(':')[0].strip().rstrip('.。．｡')
+
+
+def looks_like_ipv6(host):
+	try:
+		IPv6Address(host)
+	except AddressValueError:
+		return False
+	return True
+
+
+def decode_punycode(label):
+	lowered = label.lower()
+	if lowered.startswith('xn--'):
+		try:
+			return idna.decode(lowered)
+		except (UnicodeError, IndexError):
+			pass
+	return lowered
+
+
+def add_public_suffix_arguments(p):
+	p.add_argument(
+		'--suffix-list',
+		type=str,
+		help='Public Suffix List file (public_suffix_list.dat) to split domains with. Default: the snapshot bundled with tldextract (never fetched over the network)',
+	)
+	p.add_argument(
+		'--suffix-index',
+		type=str,
+		default='./results/public_suffix_index.pickle',
+		help='File caching the compiled suffix list across runs. Default: ./results/public_suffix_index.pickle',
+	)
+
+
+def open_public_suffix_list(args):
+	return PublicSuffixList.load(args['suffix_list'], args['suffix_index'])
@@ -0,0 +1,178 @@
+"""
+Rebuild a corpus from the raw API pages journal of twitter_search.py/twitter_timeline.py, without the API
+
+Segments are flattened into corpus rows in parallel (--workers) and written in journal order, to a csv file or a
+parquet directory like the collectors write (./results/<filename>.<format>). Columns added to
+tweet_files.get_tweet_rows later are filled in from the journal the same way.
+
+A run resuming a killed one fetches again the pages its checkpoint didn't count yet (the last page of a csv corpus,
+up to --pages-per-row-group pages of a parquet one), which the journal then holds twice: tweets are written once,
+where the journal has them first, so the replay holds the tweets of the collected corpus.
+
+The journal of a sharded search (--shards, ./results/<filename>_shards/) is replayed the way search_shards.py merges
+it: newest shard first, every shard by descending tweet_id without the tweets fetched again (write_shard).
+
+Run:
+1. Install pandas (`$ pip install pandas`, plus pyarrow for --format parquet)
+2. Get all arguments from `$ python replay_journal.py --help`
+"""
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+from pathlib import Path
+import sys
+
+import pandas as pd
+from tqdm import tqdm
+
+from tweet_files import CorpusWriter, add_corpus_format_arguments, get_corpus_file_name, get_tweet_rows
+from tweet_journal import get_segments, read_segment
+
+
+def replay_segment(segment, keep_rt):
+	"""Corpus rows of every page with tweets of a segment, run in a worker process"""
+	return [get_tweet_rows(page, keep_rt) for page in read_segment(segment) if page['data']]
+
+
+def iter_replayed_pages(segments, keep_rt, workers=1):
+	"""Corpus rows of the pages of every segment (replay_segment), in journal order, segments flattened by workers processes"""
+	if workers <= 1:
+		for segment in segments:
+			yield replay_segment(segment, keep_rt)
+		return
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		pending = deque()
+		for segment in segments:
+			pending.append(executor.submit(replay_segment, segment, keep_rt))
+			if len(pending) >= 2 * workers:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+
+def get_shard_journals(journal):
+	"""shard-NNNN journals of a sharded search (search_shards.py), newest first: shards are numbered in time order"""
+	shard_journals = [path for path in Path(journal).glob('shard-*') if path.is_dir() and path.name[len('shard-'):].isdigit()]
+	return [str(path) for path in sorted(shard_journals, key=lambda path: int(path.name[len('shard-'):]), reverse=True)]
+
+
+def write_sorted_shard(writer, shard_journal, keep_rt):
+	"""(tweet count, earliest id, most recent id) of a shard written whole, sorted in memory"""
+	pages = [tweet_list for segment in get_segments(shard_journal) for tweet_list in replay_segment(segment, keep_rt)]
+	shard_df = pd.DataFrame([tweet for tweet_list in pages for tweet in tweet_list])
+	if shard_df.empty:
+		return 0, None, None
+	shard_df = shard_df.drop_duplicates('tweet_id').sort_values('tweet_id', key=lambda ids: ids.astype('int64'), ascending=False)
+	writer.write_page(shard_df.to_dict('records'))
+	return len(shard_df), shard_df['tweet_id'].iloc[-1], shard_df['tweet_id'].iloc[0]
+
+
+def write_shard(writer, shard_journal, keep_rt, workers=1, progress=None):
+	"""
+	Write the tweets of a shard by descending tweet_id, without the ones fetched again, and return (tweet count,
+	earliest id, most recent id). The search API gives a shard newest first, so its pages are streamed as they are; a
+	shard found out of order is dropped from the corpus (CorpusWriter.restore) and written again by write_sorted_shard
+	"""
+	writer.flush()
+	position = writer.get_position()
+	segments = get_segments(shard_journal)
+	seen = set()
+	tweet_count, earliest_id, most_recent_id = 0, None, None
+	for replayed, pages in enumerate(iter_replayed_pages(segments, keep_rt, workers)):
+		for tweet_list in pages:
+			new_tweets = []
+			for tweet in tweet_list:
+				if tweet['tweet_id'] in seen:
+					continue
+				if earliest_id is not None and int(tweet['tweet_id']) > int(earliest_id):
+					print(f'{shard_journal} is not ordered by descending tweet_id, sorting it in memory')
+					writer.restore(position)
+					if progress is not None:
+						progress.update(len(segments) - replayed)
+					return write_sorted_shard(writer, shard_journal, keep_rt)
+				seen.add(tweet['tweet_id'])
+				new_tweets.append(tweet)
+				earliest_id = tweet['tweet_id']
+				most_recent_id = most_recent_id or tweet['tweet_id']
+			if new_tweets:
+				writer.write_page(new_tweets)
+				tweet_count += len(new_tweets)
+		if progress is not None:
+			progress.update(1)
+	return tweet_count, earliest_id, most_recent_id
+
+
+def replay_journal(args):
+	segments = get_segments(args['journal'])
+	if not segments:
+		sys.exit(f'No journal segments found in {args["journal"]}')
+	shard_journals = get_shard_journals(args['journal'])
+
+	Path('./results/').mkdir(parents=True, exist_ok=True)
+	file_name = get_corpus_file_name(args['filename'], args['format'])
+	if os.path.exists(file_name):
+		sys.exit(f'{file_name} already exists, remove it or pick another --filename')
+
+	print(f'Replaying {len(segments)} journal segments{f" of {len(shard_journals)} shards" if shard_journals else ""} into {file_name}...')
+	writer = CorpusWriter(file_name, args['format'], False, args['pages_per_row_group'])
+	tweet_count = 0
+	seen = set()  # tweet ids written, to drop the ones of pages fetched again
+	try:
+		with tqdm(total=len(segments), unit='segments') as progress:
+			if shard_journals:
+				for shard_journal in shard_journals:
+					tweet_count += write_shard(writer, shard_journal, args['keep_rt'], args['workers'], progress)[0]
+			else:
+				# segments are flattened in parallel, their rows are written in journal order
+				for pages in iter_replayed_pages(segments, args['keep_rt'], args['workers']):
+					for tweet_list in pages:
+						new_tweets = []
+						for tweet in tweet_list:
+							if tweet['tweet_id'] not in seen:
+								seen.add(tweet['tweet_id'])
+								new_tweets.append(tweet)
+						if new_tweets:
+							writer.write_page(new_tweets)
+							tweet_count += len(new_tweets)
+					progress.update(1)
+	finally:
+		writer.close()
+	print(f'Done! Replayed {tweet_count} tweets into {file_name}')
+
+
+if __name__ == '__main__':
+	p = argparse.ArgumentParser(description='Rebuild a csv/parquet corpus from the raw API pages journal of the collectors')
+	p.add_argument(
+		'-j',
+		'--journal',
+		type=str,
+		required=True,
+		help='Journal directory (or a single segment file) written by twitter_search.py/twitter_timeline.py, or the _shards directory '
+			 'of a sharded search. E.g. results/my_data_journal',
+	)
+	p.add_argument(
+		'-f',
+		'--filename',
+		type=str,
+		required=True,
+		help='Name of the rebuilt corpus, saved as ./results/<filename>.<format>. Must not exist yet',
+	)
+	p.add_argument(
+		'--no-keep-rt',
+		action='store_true',
+		help='Use this to NOT store retweet-related data',
+	)
+	p.add_argument(
+		'-w',
+		'--workers',
+		type=int,
+		default=os.cpu_count(),
+		help='Number of processes flattening journal segments in parallel. Default: number of CPUs',
+	)
+	add_corpus_format_arguments(p)
+	args = vars(p.parse_args())
+
+	args['keep_rt'] = not args['no_keep_rt']
+
+	replay_journal(args)
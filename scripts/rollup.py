@@ -0,0 +1,66 @@
+"""
+Grouped aggregation on integer codes, for 4_expand_media_metrics.py and 5_get_all_tweet_external_link_stats.py
+
+Key columns are encoded once (encode_key) and combined into one int64 code per row (combine_keys). Rows with
+the same code are aggregated into cells by rollup(): sums of numeric columns, plus the distinct (cell, value)
+pairs of the columns to count distinct values of. Cells can be rolled up again into coarser cells (e.g. hour ->
+day -> month, or dropping a key), and distinct counts stay exact because the pairs are deduplicated again at
+every level.
+"""
+import numpy as np
+import pandas as pd
+
+
+def encode_key(column):
+	"""(codes, distinct values) of a column, codes follow the sorted values and are -1 for missing values"""
+	return pd.factorize(column, sort=True)
+
+
+def combine_keys(keys):
+	"""(rows without missing keys, one int64 code per row) for encoded keys, codes sort like the tuples of values"""
+	valid = np.ones(len(keys[0][0]), dtype=bool)
+	combined = np.zeros(len(valid), dtype=np.int64)
+	for codes, uniques in keys:
+		valid &= codes >= 0
+		combined = combined * max(len(uniques), 1) + codes
+	return valid, combined
+
+
+def split_keys(groups, keys):
+	"""Values of every key for combined codes (inverse of combine_keys)"""
+	values = []
+	for codes, uniques in reversed(keys):
+		size = max(len(uniques), 1)
+		values.append(uniques.take(groups % size))
+		groups = groups // size
+	return values[::-1]
+
+
+class Cells:
+	def __init__(self, keys, sums, distinct):
+		self.keys = keys  # sorted distinct int64 codes
+		self.sums = sums  # {column: sums per cell}
+		self.distinct = distinct  # {column: (cell indexes, value codes, number of values)}, one per distinct pair
+
+	@classmethod
+	def from_rows(cls, keys, sums, distinct):
+		"""Cells of rows with the int64 codes keys, sums: {column: values}, distinct: {column: (codes, distinct values)}"""
+		rows = np.arange(len(keys))
+		pairs = {}
+		for column, (codes, uniques) in distinct.items():
+			known = codes >= 0
+			pairs[column] = (rows[known], codes[known], max(len(uniques), 1))
+		return cls(keys, sums, pairs).rollup(keys)
+
+	def rollup(self, keys):
+		"""Aggregate the cells sharing the same new int64 code in keys (one per cell)"""
+		groups, index = np.unique(keys, return_inverse=True)
+		sums = {column: np.bincount(index, weights=values, minlength=len(groups)) for column, values in self.sums.items()}
+		distinct = {}
+		for column, (cells, codes, size) in self.distinct.items():
+			pairs = np.unique(index[cells].astype(np.int64) * size + codes)
+			distinct[column] = (pairs // size, pairs % size, size)
+		return Cells(groups, sums, distinct)
+
+	def count_distinct(self, column):
+		return np.bincount(self.distinct[column][0], minlength=len(self.keys))
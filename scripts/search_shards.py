@@ -0,0 +1,311 @@
+"""
+Sharded full-archive search for twitter_search.py (--shards)
+
+The --from-date/--to-date range is split into time windows (shards), of equal length or sized from the counts
+endpoint so they hold about the same number of tweets (--size-shards-by-counts). Shards are fetched concurrently
+(--shard-workers threads), every request of every shard taking a token from one shared bucket
+(--requests-per-second), and every thread waiting out a 429 until the reset time the API gives.
+
+Everything is kept in ./results/<filename>_shards/:
+- state.json: the shards, with the next_token each one is at, rewritten after every page. Running the same command
+  again resumes the unfinished shards where they stopped
+- shard-NNNN/: the raw pages of every shard, as a journal (tweet_journal.py, see replay_journal.py). The corpus is
+  merged from them, so they are written even with --no-journal, which deletes them once merged. With --journal, they
+  are kept in that directory instead (the one the search started with, when it's resumed)
+
+Once every shard is done, shards are merged into the corpus newest first, every shard sorted by tweet_id
+(descending, like the sequential search) without duplicates (pages fetched again after a crash). Tweet ids grow
+with time, so shards being disjoint time windows makes the whole corpus ordered. The merge streams the pages of
+every shard (replay_journal.write_shard, which replay_journal.py also replays the shards with).
+
+The v2 endpoints are called with requests directly, so a local mock can stand in for the API (--api-url).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import json
+import os
+from pathlib import Path
+import shutil
+import sys
+import threading
+import time
+
+import pandas as pd
+import requests
+
+from collector_checkpoint import save_checkpoint
+from replay_journal import get_shard_journals, write_shard
+from tweet_files import CorpusWriter, get_corpus_file_name
+from tweet_journal import JournalWriter
+
+API_URL = 'https://api.twitter.com/2'
+ARCHIVE_START = '2006-03-21T00:00:00Z'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class TokenBucket:
+	"""rate tokens a second, up to capacity saved up, shared by the threads of every shard"""
+	def __init__(self, rate, capacity=1):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+		self.paused_until = 0.0
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if now >= self.paused_until and self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+			time.sleep(wait)
+
+	def pause(self, seconds):
+		"""No token for anyone for seconds (rate limited by the API)"""
+		with self.lock:
+			self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+			self.tokens = 0
+
+
+class SearchAPI:
+	def __init__(self, bearer_token, bucket, api_url=API_URL, retries=5, timeout=60):
+		self.bearer_token = bearer_token
+		self.bucket = bucket
+		self.api_url = api_url.rstrip('/')
+		self.retries = retries
+		self.timeout = timeout
+		self.local = threading.local()  # one requests.Session per thread
+
+	def get_session(self):
+		if not hasattr(self.local, 'session'):
+			self.local.session = requests.Session()
+			self.local.session.headers['Authorization'] = f'Bearer {self.bearer_token}'
+		return self.local.session
+
+	def get(self, path, params):
+		"""JSON answer of the API, waiting out rate limits and retrying server/connection errors"""
+		attempt = 0
+		while True:
+			self.bucket.acquire()
+			try:
+				res = self.get_session().get(self.api_url + path, params=params, timeout=self.timeout)
+			except (requests.ConnectionError, requests.Timeout):
+				if attempt == self.retries:
+					raise
+				attempt += 1
+				time.sleep(2 ** attempt)
+				continue
+			if res.status_code == 429:
+				reset = float(res.headers.get('x-rate-limit-reset', time.time() + 60))
+				self.bucket.pause(max(1.0, reset - time.time()))
+				continue
+			if res.status_code >= 500 and attempt < self.retries:
+				attempt += 1
+				time.sleep(2 ** attempt)
+				continue
+			res.raise_for_status()
+			return res.json()
+
+
+def parse_date(date):
+	"""UTC datetime of an ISO 8601/RFC 3339 date, with or without fractional seconds or an offset (UTC if none)"""
+	date = pd.Timestamp(date)
+	return (date.tz_localize('UTC') if date.tzinfo is None else date.tz_convert('UTC')).to_pydatetime()
+
+
+def format_date(date):
+	if date.microsecond:
+		return date.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+	return date.strftime(DATE_FORMAT)
+
+
+def get_api_params(params):
+	"""API query parameters of tweepy.Client style parameters (user_fields -> user.fields), without the unset ones"""
+	return {key.replace('_fields', '.fields'): value for key, value in params.items() if value is not None}
+
+
+def get_counts(api, query, start, end, granularity):
+	"""[(start, end, tweet_count)] of the counts endpoint between start and end, oldest first"""
+	counts = []
+	params = {'query': query, 'start_time': format_date(start), 'end_time': format_date(end), 'granularity': granularity}
+	while True:
+		answer = api.get('/tweets/counts/all', params)
+		counts.extend((parse_date(x['start']), parse_date(x['end']), x['tweet_count']) for x in answer.get('data', []))
+		next_token = answer.get('meta', {}).get('next_token')
+		if next_token is None:
+			return sorted(counts)
+		params['next_token'] = next_token
+
+
+def plan_shards(api, query, start, end, shard_count, by_counts):
+	"""[(start, end)] windows covering start to end, oldest first"""
+	if not by_counts:
+		step = (end - start) / shard_count
+		bounds = [start + step * i for i in range(shard_count)] + [end]
+	else:
+		granularity = 'day' if end - start >= timedelta(days=2 * shard_count) else 'hour'
+		counts = get_counts(api, query, start, end, granularity)
+		total = sum(count for _, _, count in counts)
+		print(f'Counts endpoint: {total} tweets between {format_date(start)} and {format_date(end)}')
+		bounds = [start]
+		cumulative = 0
+		for _, bucket_end, count in counts:
+			cumulative += count
+			# cut at the end of the bucket that fills the next shard
+			if cumulative >= total * len(bounds) / shard_count and len(bounds) < shard_count and start < bucket_end < end:
+				bounds.append(bucket_end)
+		bounds.append(end)
+	# windows are cut at whole seconds, between the start and end given
+	cuts = sorted(set(bound.replace(microsecond=0) for bound in bounds[1:-1]))
+	bounds = [start] + [cut for cut in cuts if start < cut < end] + [end]
+	return [(format_date(a), format_date(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def get_shards_dir(filename):
+	return f'./results/{filename}_shards'
+
+
+def fetch_shard(api, params, i, state, state_file_name, lock, stop, pages_per_segment):
+	shard = state['shards'][i]
+	journal = JournalWriter(os.path.join(state['journal'], f'shard-{i:04d}'), pages_per_segment)
+	try:
+		while not shard['done'] and not stop.is_set():
+			shard_params = {**params, 'start_time': shard['start'], 'end_time': shard['end']}
+			if shard['next_token'] is not None:
+				shard_params['next_token'] = shard['next_token']
+			answer = api.get('/tweets/search/all', shard_params)
+			page = {key: answer.get(key, default) for key, default in [('data', []), ('includes', {}), ('errors', []), ('meta', {})]}
+			journal.write_page(page, {'endpoint': 'search_all_tweets', 'shard': i, 'params': shard_params})
+			with lock:
+				shard['next_token'] = page['meta'].get('next_token')
+				shard['done'] = shard['next_token'] is None
+				shard['pages'] += 1
+				shard['tweets'] += len(page['data'])
+				save_checkpoint(state_file_name, state)
+				print(f'Shard {i} ({shard["start"]} - {shard["end"]}): downloaded {shard["tweets"]} tweets. Total: {sum(x["tweets"] for x in state["shards"])} tweets')
+	finally:
+		journal.close()
+
+
+def merge_shards(journal, file_name, file_format, keep_rt, pages_per_row_group):
+	"""Write the tweets of every shard to the corpus, newest shard first, every shard sorted by descending tweet_id"""
+	writer = CorpusWriter(file_name, file_format, False, pages_per_row_group)
+	tweet_count, earliest_id, most_recent_id = 0, None, None
+	try:
+		for shard_journal in get_shard_journals(journal):
+			shard_count, shard_earliest_id, shard_most_recent_id = write_shard(writer, shard_journal, keep_rt)
+			if not shard_count:
+				continue
+			tweet_count += shard_count
+			most_recent_id = most_recent_id or shard_most_recent_id
+			earliest_id = shard_earliest_id
+	finally:
+		writer.close()
+	return tweet_count, earliest_id, most_recent_id
+
+
+def search_sharded(args, bearer_token):
+	"""(tweet count, earliest tweet id, most recent tweet id) of a sharded search of args['query'], like process_tweets"""
+	shards_dir = get_shards_dir(args['filename'])
+	state_file_name = os.path.join(shards_dir, 'state.json')
+	file_name = get_corpus_file_name(args['filename'], args['format'])
+	api = SearchAPI(bearer_token, TokenBucket(args['requests_per_second']), args['api_url'])
+	start = parse_date(args['from_date'] or ARCHIVE_START)
+	end = parse_date(args['to_date']) if args['to_date'] else datetime.now(timezone.utc).replace(microsecond=0) - timedelta(seconds=30)
+	search = {key: args[key] for key in ['query', 'from_date', 'to_date', 'from_id', 'until_id']}
+
+	if os.path.isfile(state_file_name):
+		with open(state_file_name) as file:
+			state = json.load(file)
+		if state['search'] != search:
+			sys.exit(f'{state_file_name} is the state of another search, pick another --filename')
+		print(f'Resuming the {sum(not x["done"] for x in state["shards"])} unfinished shards of {state_file_name}')
+	else:
+		if os.path.exists(file_name):
+			sys.exit(f'{file_name} already exists, a sharded search writes a new corpus: pick another --filename')
+		Path(shards_dir).mkdir(parents=True, exist_ok=True)
+		windows = plan_shards(api, args['query'], start, end, args['shards'], args['size_shards_by_counts'])
+		state = {
+			'search': search,
+			'shards': [{'start': a, 'end': b, 'next_token': None, 'done': False, 'pages': 0, 'tweets': 0} for a, b in windows],
+			'journal': args['journal'] if args['journal'] and not args['no_journal'] else shards_dir,
+			'merged': False,
+		}
+		save_checkpoint(state_file_name, state)
+		print(f'Split the search into {len(windows)} shards, saved in {state_file_name}')
+	if state['merged']:
+		sys.exit(f'{state_file_name} is already merged into {file_name}')
+	state.setdefault('journal', shards_dir)  # state of a search started before --journal was used for shards
+
+	params = get_api_params(dict(
+		query=args['query'],
+		user_fields='verified,description,username,created_at,public_metrics',
+		expansions='author_id,referenced_tweets.id,referenced_tweets.id.author_id',
+		tweet_fields='created_at,lang,public_metrics,conversation_id,entities,attachments,referenced_tweets,in_reply_to_user_id',
+		max_results=args['max_per_page'], since_id=args['from_id'], until_id=args['until_id'],
+	))
+	lock = threading.Lock()
+	stop = threading.Event()
+	with ThreadPoolExecutor(max_workers=args['shard_workers']) as executor:
+		futures = [
+			executor.submit(fetch_shard, api, params, i, state, state_file_name, lock, stop, args['journal_pages_per_segment'])
+			for i, shard in enumerate(state['shards']) if not shard['done']
+		]
+		try:
+			for future in futures:
+				future.result()
+		except KeyboardInterrupt:
+			stop.set()
+			print(f'Process terminated. Shards are saved in {shards_dir}, run the same command again to resume them')
+			sys.exit(1)
+		except Exception:
+			stop.set()
+			raise
+
+	print(f'Merging {len(state["shards"])} shards into {file_name}...')
+	counts = merge_shards(state['journal'], file_name, args['format'], args['keep_rt'], args['pages_per_row_group'])
+	state['merged'] = True
+	save_checkpoint(state_file_name, state)
+	if args['no_journal']:
+		print(f'Deleting the raw pages of the shards from {state["journal"]} (--no-journal)')
+		for shard_journal in get_shard_journals(state['journal']):
+			shutil.rmtree(shard_journal)
+	return counts
+
+
+def add_shard_arguments(p):
+	p.add_argument(
+		'--shards',
+		type=int,
+		help='Use this to split the --from-date/--to-date range into this many time windows fetched concurrently (full-archive search only). '
+			 'Run the same command again to resume it. The raw pages of the shards are kept in ./results/<filename>_shards/ or --journal, '
+			 'and deleted once merged with --no-journal. Default: no shards, one sequential search',
+	)
+	p.add_argument(
+		'--size-shards-by-counts',
+		action='store_true',
+		help='With --shards, size the windows from the counts endpoint so they hold about as many tweets each, instead of equal durations',
+	)
+	p.add_argument(
+		'--shard-workers',
+		type=int,
+		default=4,
+		help='With --shards, number of shards fetched at the same time. Default: 4',
+	)
+	p.add_argument(
+		'--requests-per-second',
+		type=float,
+		default=1.0,
+		help='With --shards, requests per second shared by all shards. Default: 1 (the full-archive search limit)',
+	)
+	p.add_argument(
+		'--api-url',
+		type=str,
+		default=API_URL,
+		help=f'With --shards, base URL of the v2 API, e.g. a local mock. Default: {API_URL}',
+	)
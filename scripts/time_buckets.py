@@ -0,0 +1,59 @@
+"""
+Time buckets shared by get_metrics.py, 4_expand_media_metrics.py and 5_get_all_tweet_external_link_stats.py
+
+A created_at column is cut into hour/day/month buckets as integer period codes (numpy datetime64 units) of its
+wall time, optionally after converting it to another timezone, and labels are formatted once per distinct
+bucket instead of once per row.
+"""
+import numpy as np
+import pandas as pd
+
+UNITS = {'hour': 'h', 'day': 'D', 'month': 'M'}
+GRANULARITIES = ['month', 'day', 'hour']
+PERIOD_NAMES = {'hour': 'hourly', 'day': 'daily', 'month': 'monthly'}
+
+
+def to_wall_time(created_at, timezone=None):
+	"""created_at as naive local times, converted to timezone first if given (naive times are taken as UTC)"""
+	if timezone is not None:
+		if created_at.dt.tz is None:
+			created_at = created_at.dt.tz_localize('UTC')
+		created_at = created_at.dt.tz_convert(timezone)
+	if created_at.dt.tz is not None:
+		created_at = created_at.dt.tz_localize(None)
+	return created_at
+
+
+def get_buckets(created_at, unit):
+	"""(distinct buckets as a DatetimeIndex, bucket code of every row) for a numpy datetime unit ('h', 'D', 'M'...)"""
+	buckets, codes = np.unique(to_wall_time(created_at).values.astype(f'datetime64[{unit}]'), return_inverse=True)
+	return pd.DatetimeIndex(buckets), codes
+
+
+def format_buckets(created_at, unit, format_labels):
+	"""Label of every row's bucket, format_labels is called once with the DatetimeIndex of the distinct buckets"""
+	buckets, codes = get_buckets(created_at, unit)
+	labels = np.asarray(format_labels(buckets), dtype=object)
+	return pd.Series(labels[codes], index=created_at.index)
+
+
+def format_date_labels(buckets, granularity):
+	if granularity == 'hour':
+		return [f'{x.month}/{x.day}/{x.year} {x.hour}:00:00' for x in buckets]
+	if granularity == 'day':
+		return [f'{x.month}/{x.day}/{x.year}' for x in buckets]
+	return [f'{x.month}/{x.year}' for x in buckets]
+
+
+def get_date_levels(created_at, granularities, timezone=None):
+	"""
+	(hour buckets, hour bucket code of every row, {granularity: (label code of every hour bucket, sorted labels)}),
+	to aggregate rows per hour once and roll the hours up to the date labels of every granularity
+	"""
+	hours, hour_codes = get_buckets(to_wall_time(created_at, timezone), 'h')
+	levels = {
+		granularity: pd.factorize(np.asarray(format_date_labels(hours, granularity), dtype=object), sort=True)
+		for granularity in granularities
+	}
+	return hours, hour_codes, levels
+
@@ -0,0 +1,213 @@
+"""
+Concurrent timeline collection for twitter_timeline.py (--workers)
+
+--workers threads fetch user timelines at the same time, every request taking a token from one bucket shared by
+all of them (--requests-per-second, the user tweet timeline limit of the app by default) and waiting out 429s.
+Threads only fetch: their pages go through a queue to the main thread, the single writer of the corpus
+(./results/<filename>.<format>), of the journal and of the state of every user, ./results/<filename>_users.json:
+
+- most_recent_id/earliest_id: newest and oldest tweet id collected for the user
+- done: whether the whole timeline was walked. The timelines of an interrupted run are resumed from their
+  earliest_id (until_id) by the next one, done ones are skipped
+- sync: with --sync, done timelines are fetched again since their most_recent_id (the high-water mark), so a
+  user without new tweets takes a single request. The mark only moves once the sync pass reached it, in the
+  meantime sync holds the newest/oldest id fetched by the pass, which an interrupted sync is resumed from
+
+The state is saved (atomically) when the corpus durably holds every page it counts, with the corpus position
+(CorpusWriter.get_position): a run killed after writing a page but before saving the state that counts it has that
+page dropped from the corpus by the next run, which fetches it again.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import queue
+import sys
+import threading
+
+from collector_checkpoint import save_checkpoint
+from search_shards import API_URL, SearchAPI, TokenBucket, get_api_params
+from tweet_files import CorpusWriter, get_corpus_file_name, get_tweet_rows
+from tweet_journal import open_journal
+
+
+def get_users_state_file_name(filename):
+	return f'./results/{filename}_users.json'
+
+
+def load_users_state(state_file_name):
+	if not os.path.isfile(state_file_name):
+		return {'users': {}}
+	with open(state_file_name) as file:
+		return json.load(file)
+
+
+def get_timeline_params(args, user_state):
+	"""
+	API parameters of a user timeline: all of it for a new user, resumed from the user's earliest_id if a previous run
+	didn't finish it, or since its most_recent_id with --sync
+	"""
+	params = dict(
+		user_fields='verified,description,username,created_at,public_metrics',
+		expansions='author_id,referenced_tweets.id,referenced_tweets.id.author_id',
+		tweet_fields='created_at,lang,public_metrics,conversation_id,entities,attachments,referenced_tweets,in_reply_to_user_id',
+		max_results=min(args['max_per_page'], 100), since_id=args['from_id'], until_id=args['until_id'],
+		start_time=args['from_date'], end_time=args['to_date'],
+	)
+	if user_state is not None and not user_state['done'] and user_state['earliest_id'] is not None:
+		params['until_id'] = user_state['earliest_id']
+	elif user_state is not None and user_state['done'] and user_state['most_recent_id'] is not None:
+		params['since_id'] = user_state['most_recent_id']
+		if user_state.get('sync') is not None:
+			params['until_id'] = user_state['sync']['earliest_id']
+	return get_api_params(params)
+
+
+def put(pages, item, stop):
+	while not stop.is_set():
+		try:
+			pages.put(item, timeout=1)
+			return
+		except queue.Full:
+			continue
+
+
+def fetch_timeline(api, user_id, params, pages, stop):
+	"""Put (user_id, raw page, request) on pages for every page of the timeline, then (user_id, None, error or None)"""
+	try:
+		while not stop.is_set():
+			answer = api.get(f'/users/{user_id}/tweets', params)
+			page = {key: answer.get(key, default) for key, default in [('data', []), ('includes', {}), ('errors', []), ('meta', {})]}
+			put(pages, (user_id, page, {'endpoint': 'get_users_tweets', 'args': [user_id], 'params': dict(params)}), stop)
+			next_token = page['meta'].get('next_token')
+			if next_token is None:
+				put(pages, (user_id, None, None), stop)
+				return
+			params['pagination_token'] = next_token
+	except Exception as e:
+		put(pages, (user_id, None, repr(e)), stop)
+
+
+def get_id_range(tweet_list, *ids):
+	"""(oldest, newest) of the ids of tweet_list and the ids given that aren't None, as strings"""
+	ids = [int(tweet['tweet_id']) for tweet in tweet_list] + [int(x) for x in ids if x is not None]
+	return str(min(ids)), str(max(ids))
+
+
+def update_user_state(user_state, tweet_list):
+	if user_state['done']:
+		# sync pass: the high-water mark only moves at the end of it
+		sync = user_state.get('sync') or {'earliest_id': None, 'most_recent_id': None}
+		user_state['sync'] = dict(zip(['earliest_id', 'most_recent_id'], get_id_range(tweet_list, sync['earliest_id'], sync['most_recent_id'])))
+	else:
+		user_state['earliest_id'], user_state['most_recent_id'] = get_id_range(tweet_list, user_state['earliest_id'], user_state['most_recent_id'])
+	user_state['tweets'] += len(tweet_list)
+
+
+def finish_user_state(user_state):
+	if user_state['done'] and user_state.get('sync') is not None:
+		user_state['earliest_id'], user_state['most_recent_id'] = get_id_range([], user_state['earliest_id'], user_state['most_recent_id'], user_state['sync']['most_recent_id'])
+	user_state['sync'] = None
+	user_state['done'] = True
+
+
+def save_users_state(state_file_name, state, writer):
+	"""Save the state if the corpus durably holds every page written to writer"""
+	if not writer.pages:
+		state['position'] = writer.get_position()
+		save_checkpoint(state_file_name, state)
+
+
+def collect_timelines(args, bearer_token):
+	Path('./results/').mkdir(parents=True, exist_ok=True)
+	state_file_name = get_users_state_file_name(args['filename'])
+	state = load_users_state(state_file_name)
+	user_ids = list(dict.fromkeys(user_id.strip() for user_id in args['user_ids'].split(',')))
+	todo = [user_id for user_id in user_ids if args['sync'] or not state['users'].get(user_id, {}).get('done')]
+	if args['sync']:
+		print(f'Syncing {len(todo)} timelines ({sum(user_id in state["users"] for user_id in todo)} since their high-water mark in {state_file_name}) with {args["workers"]} workers')
+	else:
+		print(f'Collecting {len(todo)} timelines ({len(user_ids) - len(todo)} already done in {state_file_name}) with {args["workers"]} workers')
+
+	file_name = get_corpus_file_name(args['filename'], args['format'])
+	writer = CorpusWriter(file_name, args['format'], os.path.exists(file_name), args['pages_per_row_group'])
+	if 'position' in state:
+		writer.restore(state['position'])
+	journal = open_journal(args)
+	api = SearchAPI(bearer_token, TokenBucket(args['requests_per_second']), args['api_url'])
+	pages = queue.Queue(maxsize=4 * args['workers'])
+	stop = threading.Event()
+	tweet_count = 0
+	errors = 0
+	executor = ThreadPoolExecutor(max_workers=args['workers'])
+	try:
+		futures = [
+			executor.submit(fetch_timeline, api, user_id, get_timeline_params(args, state['users'].get(user_id)), pages, stop)
+			for user_id in todo
+		]
+		remaining = len(futures)
+		while remaining:
+			user_id, page, request = pages.get()
+			user_state = state['users'].setdefault(user_id, {'most_recent_id': None, 'earliest_id': None, 'tweets': 0, 'done': False, 'sync': None})
+			if page is None:
+				remaining -= 1
+				if request is None:
+					finish_user_state(user_state)
+				else:
+					errors += 1
+					print(f'User {user_id}: {request}, it will be resumed by the next run')
+				save_users_state(state_file_name, state, writer)
+				continue
+
+			if journal is not None:
+				journal.write_page(page, request)
+			if not page['data']:
+				continue
+			tweet_list = get_tweet_rows(page, args['keep_rt'])
+			writer.write_page(tweet_list)
+			update_user_state(user_state, tweet_list)
+			save_users_state(state_file_name, state, writer)
+			tweet_count += len(tweet_list)
+			print(f'User {user_id}: downloaded {user_state["tweets"]} tweets. Total: {tweet_count} tweets, {len(todo) - remaining}/{len(todo)} timelines')
+	except KeyboardInterrupt:
+		stop.set()
+		print(f'Process terminated. Downloaded {tweet_count} tweets, run the same command again to resume the unfinished timelines')
+		sys.exit(1)
+	finally:
+		stop.set()
+		executor.shutdown(wait=True, cancel_futures=True)
+		buffered = bool(writer.pages)
+		writer.close()
+		if buffered:
+			save_users_state(state_file_name, state, writer)
+		if journal is not None:
+			journal.close()
+	print(f'Finished process. Downloaded {tweet_count} tweets from {len(todo) - errors} timelines ({errors} errors)')
+
+
+def add_timeline_collector_arguments(p):
+	p.add_argument(
+		'-w',
+		'--workers',
+		type=int,
+		help='Use this to fetch this many timelines at the same time, with the state of every user in ./results/<filename>_users.json. '
+			 'Run the same command again to resume the unfinished ones. Default: one user after the other',
+	)
+	p.add_argument(
+		'--requests-per-second',
+		type=float,
+		default=1.6,
+		help='With --workers, requests per second shared by all timelines. Default: 1.6 (1500 requests per 15 minutes)',
+	)
+	p.add_argument(
+		'--api-url',
+		type=str,
+		default=API_URL,
+		help=f'With --workers, base URL of the v2 API, e.g. a local mock. Default: {API_URL}',
+	)
+	p.add_argument(
+		'--sync',
+		action='store_true',
+		help='Use this to also fetch the timelines already collected in ./results/<filename>_users.json, only their tweets newer than the newest one collected '
+			 '(one request for a user without new tweets). Uses 1 worker if --workers is not given',
+	)
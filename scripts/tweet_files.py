@@ -0,0 +1,379 @@
+"""
+Corpus files of twitter_search.py and twitter_timeline.py (--format), read back by the analysis scripts
+
+- csv (default): QUOTE_NONNUMERIC text, one append per page of results
+- parquet: columnar files with an explicit schema (TWEET_COLUMNS: ids as strings, timestamps in UTC, metrics as
+  int64, flags as booleans, empty strings as nulls like a csv reader sees them). Pages are buffered and written as
+  one part file every --pages-per-row-group pages. A parquet file can't be appended to once it's closed (and can't
+  be read before), so the corpus is a directory (<filename>.parquet/) of part-<run>-<n>.parquet files, and readers
+  read all of its parts as one corpus. Needs pyarrow (`$ pip install pyarrow`)
+
+Writes are fsynced, and get_position()/restore() let a collector checkpoint what the corpus durably holds and drop
+what a crashed run wrote after its last checkpoint.
+
+Readers only decode the columns they ask for. They give the values pd.read_csv gives for the same corpus in csv
+(timestamps as the API's strings, numeric ids as numbers, its NA strings as NaN, chunks of the same rows), so the
+analysis scripts write byte-identical outputs from both formats.
+"""
+from csv import QUOTE_NONNUMERIC
+import os
+from pathlib import Path
+import time
+
+import numpy as np
+import pandas as pd
+from pandas._libs.parsers import STR_NA_VALUES
+
+FORMATS = ['csv', 'parquet']
+TWEET_COLUMNS = {
+	'tweet_id': 'string',
+	'text': 'string',
+	'created_at': 'timestamp',
+	'lang': 'string',
+	'hashtags': 'string',
+	'user_mentions': 'string',
+	'urls': 'string',
+	'user_screen_name': 'string',
+	'user_id': 'string',
+	'user_description': 'string',
+	'user_following_count': 'int',
+	'user_followers_count': 'int',
+	'user_total_tweets': 'int',
+	'user_created_at': 'timestamp',
+	'user_verified': 'bool',
+	'tweet_favorite_count': 'int',
+	'tweet_retweet_count': 'int',
+	'tweet_reply_count': 'int',
+	'tweet_quote_count': 'int',
+	'is_retweet': 'bool',
+	'retweet_id': 'string',
+	'retweet_created_at': 'timestamp',
+	'is_quote': 'bool',
+	'quote_id': 'string',
+	'is_reply': 'bool',
+	'replied_to_tweet_id': 'string',
+	'conversation_id': 'string',
+	'in_reply_to_user_id': 'string',
+	'possibly_sensitive': 'bool',
+}
+
+
+def get_tweet_rows(page, keep_rt=True):
+	"""Corpus rows (TWEET_COLUMNS) of the tweets of a raw API page: {'data': [tweet...], 'includes': {'users': [...], 'tweets': [...]}}"""
+	tweet_list = list()
+	users = {str(x['id']): x for x in page['includes'].get('users', [])}
+	referenced_tweets = {str(x['id']): x for x in page['includes'].get('tweets', [])}
+
+	for tweet in page['data']:
+		user = users[tweet['author_id']]
+
+		tweet_row = {}
+
+		# meta
+		tweet_row["tweet_id"] = str(tweet["id"])
+		tweet_row["text"] = tweet["text"]
+		tweet_row["created_at"] = tweet["created_at"]
+		tweet_row["lang"] = tweet["lang"]
+
+		# entities
+		tweet_row["hashtags"] = ""
+		tweet_row["user_mentions"] = ""
+		tweet_row["urls"] = ""
+
+		if "entities" in tweet:
+			if 'hashtags' in tweet["entities"]:
+				tweet_row["hashtags"] = ','.join([x['tag'] for x in tweet["entities"]["hashtags"]])
+			if 'user_mentions' in tweet["entities"]:
+				tweet_row["user_mentions"] = ','.join([x['username'] for x in tweet["entities"]["mentions"]])
+			if 'urls' in tweet["entities"]:
+				for x in tweet["entities"]["urls"]:
+					urls = []
+					if 'unwound_url' in x:
+						urls.append(x['unwound_url'])
+					elif 'expanded_url' in x:
+						urls.append(x['expanded_url'])
+					else:
+						urls.append(x['url'])
+
+				tweet_row["urls"] = ','.join(urls)
+
+		# user data
+		tweet_row["user_screen_name"] = user["username"]
+		tweet_row["user_id"] = user["id"]
+		tweet_row["user_description"] = user["description"]
+		tweet_row["user_following_count"] = user["public_metrics"]["following_count"]
+		tweet_row["user_followers_count"] = user["public_metrics"]["followers_count"]
+		tweet_row["user_total_tweets"] = user["public_metrics"]["tweet_count"]
+		tweet_row["user_created_at"] = user["created_at"]
+		tweet_row["user_verified"] = user["verified"]
+
+		# public metrics per tweet
+		tweet_row["tweet_favorite_count"] = tweet["public_metrics"]["like_count"]
+		tweet_row["tweet_retweet_count"] = tweet["public_metrics"]["retweet_count"]
+		tweet_row["tweet_reply_count"] = tweet["public_metrics"]["reply_count"]
+		tweet_row["tweet_quote_count"] = tweet["public_metrics"]["quote_count"]
+
+		# retweets and replies
+		tweet_row["is_retweet"] = False
+		tweet_row["retweet_id"] = ""
+		tweet_row["retweet_created_at"] = ""
+		tweet_row["is_quote"] = False
+		tweet_row["quote_id"] = ""
+		tweet_row["is_reply"] = False
+		tweet_row["replied_to_tweet_id"] = ""
+		tweet_row["conversation_id"] = str(tweet["conversation_id"])
+		tweet_row["in_reply_to_user_id"] = ""
+		tweet_row["possibly_sensitive"] = ""
+
+		if 'in_reply_to_user_id' in tweet:
+			tweet_row["in_reply_to_user_id"] = str(tweet["in_reply_to_user_id"])
+		if 'possibly_sensitive' in tweet:
+			tweet_row["possibly_sensitive"] = tweet["possibly_sensitive"]
+
+		if "referenced_tweets" in tweet:
+			if keep_rt:
+				retweets = [x for x in tweet["referenced_tweets"] if x["type"] == "retweeted"]
+				if len(retweets) > 0:
+					retweet_id = retweets[0]["id"]  # there can only be 1 retweeted ref tweet
+					retweet = referenced_tweets[retweet_id]
+					retweet_user = users[retweet['author_id']]
+					tweet_row["is_retweet"] = True
+					tweet_row["retweet_id"] = str(retweet_id)
+					tweet_row["retweet_created_at"] = retweet['created_at']
+					tweet_row["text"] = "RT @" + retweet_user['username'] + ": " + retweet['text']
+
+			quotes = [x for x in tweet["referenced_tweets"] if x["type"] == "quoted"]
+			if len(quotes) > 0:
+				tweet_row["quote_id"] = str(quotes[0]["id"])
+				tweet_row["is_quote"] = True
+
+			replied_to = [x for x in tweet["referenced_tweets"] if x["type"] == "replied_to"]
+			if len(replied_to) > 0:
+				tweet_row["replied_to_tweet_id"] = str(replied_to[0]["id"])
+				tweet_row["is_reply"] = True
+
+		tweet_row["text"] = tweet_row["text"].strip()
+		tweet_list.append(tweet_row)
+
+	return tweet_list
+
+
+def import_pyarrow():
+	try:
+		import pyarrow
+		import pyarrow.compute
+		import pyarrow.dataset
+		import pyarrow.parquet
+	except ImportError as e:
+		raise ImportError('Parquet corpus files need pyarrow: `$ pip install pyarrow`') from e
+	return pyarrow
+
+
+def get_tweet_schema():
+	pa = import_pyarrow()
+	types = {'string': pa.string(), 'timestamp': pa.timestamp('us', tz='UTC'), 'int': pa.int64(), 'bool': pa.bool_()}
+	return pa.schema([(column, types[kind]) for column, kind in TWEET_COLUMNS.items()])
+
+
+def is_parquet(file_name):
+	return str(file_name).rstrip('/\\').endswith('.parquet')
+
+
+def get_base_name(file_name):
+	"""File name without its .csv/.parquet extension, to add suffixes to"""
+	return str(file_name).rstrip('/\\').removesuffix('.parquet').removesuffix('.csv')
+
+
+def get_corpus_file_name(filename, file_format):
+	return f'./results/{filename}.{file_format}'
+
+
+class CorpusWriter:
+	def __init__(self, file_name, file_format='csv', append=False, pages_per_row_group=10):
+		self.file_name = file_name
+		self.file_format = file_format
+		self.append = append
+		self.pages_per_row_group = pages_per_row_group
+		self.pages = []  # buffered pages of a parquet corpus, not written yet
+		self.run = time.time_ns()
+		self.part_count = 0
+		if file_format == 'parquet':
+			self.schema = get_tweet_schema()
+			Path(file_name).mkdir(parents=True, exist_ok=True)
+
+	def write_page(self, tweet_list):
+		if self.file_format == 'csv':
+			with open(self.file_name, 'a' if self.append else 'w', encoding='utf-8', newline='') as file:
+				pd.DataFrame(tweet_list).to_csv(file, header=not self.append, index=False, quoting=QUOTE_NONNUMERIC)
+				file.flush()
+				os.fsync(file.fileno())
+			self.append = True
+			return
+		self.pages.append(tweet_list)
+		if len(self.pages) >= self.pages_per_row_group:
+			self.flush()
+
+	def flush(self):
+		"""Write the buffered pages as one part file"""
+		if not self.pages:
+			return
+		pa = import_pyarrow()
+		df = pd.DataFrame([tweet for page in self.pages for tweet in page])
+		for column, kind in TWEET_COLUMNS.items():
+			if kind == 'int':
+				continue
+			values = df[column].astype(object).where(df[column] != '')  # NaN, written as null
+			if kind == 'timestamp':
+				values = pd.to_datetime(values, utc=True)
+			elif kind == 'string':
+				values = values.map(lambda x: x if pd.isna(x) else str(x))
+			df[column] = values
+		table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+		part_name = f'part-{self.run}-{self.part_count:05d}.parquet'
+		tmp_file_name = os.path.join(self.file_name, f'.{part_name}.tmp')  # hidden from the readers until complete
+		with open(tmp_file_name, 'wb') as file:
+			pa.parquet.write_table(table, file)
+			file.flush()
+			os.fsync(file.fileno())
+		os.replace(tmp_file_name, os.path.join(self.file_name, part_name))
+		self.part_count += 1
+		self.pages = []
+
+	def get_position(self):
+		"""What the corpus durably holds (the pages buffered for parquet aren't in it yet), to checkpoint"""
+		if self.file_format == 'csv':
+			# not appending yet: the next page overwrites the file
+			return os.path.getsize(self.file_name) if self.append and os.path.isfile(self.file_name) else 0
+		return {'run': self.run, 'parts': self.part_count}
+
+	def restore(self, position):
+		"""Drop what was written after a checkpointed position (by a run killed before its next checkpoint), and write from there"""
+		if self.file_format == 'csv':
+			if os.path.isfile(self.file_name):
+				os.truncate(self.file_name, position)
+			self.append = position > 0
+			return
+		self.run, self.part_count = position['run'], position['parts']
+		self.pages = []
+		for path in Path(self.file_name).glob(f'*part-{self.run}-*'):
+			if int(path.name.split('-')[2].split('.')[0]) >= self.part_count:
+				path.unlink()
+
+	def close(self):
+		if self.file_format == 'parquet':
+			self.flush()
+
+
+def get_csv_nulls(values):
+	"""Strings with read_csv's NA strings ('', 'NA', 'N/A', 'null'...) as nulls"""
+	pa = import_pyarrow()
+	na_values = pa.array(sorted(STR_NA_VALUES))
+	chunks = []
+	for chunk in values.chunks:  # replace_with_mask takes arrays, not chunked arrays
+		na = pa.compute.is_in(chunk, value_set=na_values)
+		chunks.append(pa.compute.replace_with_mask(chunk, na, pa.nulls(pa.compute.sum(na).as_py() or 0, chunk.type)))
+	return pa.chunked_array(chunks, values.type)
+
+
+def get_csv_numbers(values):
+	"""Strings as int64 (float64 if some are null) if they are all numbers, like read_csv infers them"""
+	pa = import_pyarrow()
+	try:
+		return values.cast(pa.int64() if values.null_count == 0 else pa.float64())
+	except pa.ArrowInvalid:
+		try:
+			return values.cast(pa.float64())
+		except pa.ArrowInvalid:
+			return values
+
+
+def get_csv_times(times):
+	"""API strings ('%Y-%m-%dT%H:%M:%S.000Z') of datetime64[ms] times, NaN for NaT, formatted once per distinct time"""
+	distinct, codes = np.unique(times, return_inverse=True)
+	strings = np.datetime_as_string(distinct, unit='ms').astype(object) + 'Z'
+	strings[np.isnat(distinct)] = np.nan
+	return strings[codes]
+
+
+def get_csv_values(table):
+	"""DataFrame of a table of a parquet corpus, with the values pd.read_csv reads from the same corpus in csv"""
+	pa = import_pyarrow()
+	columns = []
+	times = {}
+	nullable = []
+	for column, values in zip(table.column_names, table.columns):
+		kind = TWEET_COLUMNS.get(column)
+		if kind == 'string':
+			values = get_csv_numbers(get_csv_nulls(values))
+		if kind is not None and values.null_count == len(values):
+			values = pa.chunked_array([pa.nulls(len(values), pa.float64())])  # an empty csv column is read as NaN floats
+		elif kind == 'timestamp':
+			times[column] = values.cast(pa.timestamp('ms')).to_numpy()
+		elif values.null_count:
+			nullable.append(column)
+		columns.append(values)
+	df = pa.Table.from_arrays(columns, names=table.column_names).to_pandas()
+	for column, column_times in times.items():
+		df[column] = get_csv_times(column_times)
+	for column in nullable:
+		if df[column].dtype == object:
+			values = df[column].to_numpy()
+			df[column] = np.where(pd.isna(values), np.nan, values)  # None for pyarrow, NaN for read_csv
+	return df
+
+
+def open_parquet_corpus(file_name, columns=None):
+	"""Dataset of a parquet corpus, and columns in the order of the corpus like pd.read_csv's usecols"""
+	pa = import_pyarrow()
+	dataset = pa.dataset.dataset(file_name, format='parquet')
+	if columns is not None:
+		names = dataset.schema.names
+		columns = sorted(columns, key=lambda column: names.index(column) if column in names else len(names))
+	return dataset, columns
+
+
+def iter_parquet_chunks(file_name, chunksize, columns=None):
+	"""Tables of chunksize rows (the last one fewer) of a parquet corpus, the rows of the chunks of pd.read_csv"""
+	pa = import_pyarrow()
+	dataset, columns = open_parquet_corpus(file_name, columns)
+	batches, rows = [], 0
+	for batch in dataset.to_batches(columns=columns, batch_size=chunksize):
+		batches.append(batch)
+		rows += batch.num_rows
+		while rows >= chunksize:
+			table = pa.Table.from_batches(batches)
+			yield table.slice(0, chunksize)
+			batches, rows = table.slice(chunksize).to_batches(), rows - chunksize
+	if rows:
+		yield pa.Table.from_batches(batches)
+
+
+def read_corpus(file_name, sep=',', columns=None):
+	"""DataFrame of a csv corpus file or a parquet corpus directory/file, only with columns if given"""
+	if is_parquet(file_name):
+		dataset, columns = open_parquet_corpus(file_name, columns)
+		return get_csv_values(dataset.to_table(columns=columns))
+	return pd.read_csv(file_name, encoding='utf-8', sep=sep, usecols=columns)
+
+
+def iter_corpus(file_name, chunksize, sep=',', columns=None):
+	"""DataFrames of up to chunksize rows of a csv corpus file or a parquet corpus directory/file"""
+	if is_parquet(file_name):
+		return (get_csv_values(table) for table in iter_parquet_chunks(file_name, chunksize, columns))
+	return pd.read_csv(file_name, encoding='utf-8', sep=sep, usecols=columns, chunksize=chunksize)
+
+
+def add_corpus_format_arguments(p):
+	p.add_argument(
+		'--format',
+		type=str,
+		default='csv',
+		choices=FORMATS,
+		help='csv: one QUOTE_NONNUMERIC csv file. parquet: a directory of typed columnar files, about 3x smaller, that the analysis scripts read only the columns they need of (needs pyarrow). Default: csv',
+	)
+	p.add_argument(
+		'--pages-per-row-group',
+		type=int,
+		default=10,
+		help='With --format parquet, number of pages of results buffered and written together as one row group. Default: 10',
+	)
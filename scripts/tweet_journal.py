@@ -0,0 +1,112 @@
+"""
+Journal of the raw API pages of twitter_search.py and twitter_timeline.py, replayed by replay_journal.py
+
+The corpus only keeps the columns the collectors flatten the pages into, the journal keeps every page as the API
+returned it (data + includes + errors + meta, with the request it answered) so new columns can be rebuilt from it
+without querying the API again.
+
+- a journal is a directory (default ./results/<filename>_journal/) of gzipped JSON lines segments, one line per page
+- it is append-only: every collector run starts new segments and never rewrites old ones, a segment is closed and
+  a new one started every --journal-pages-per-segment pages
+- every page is flushed as it's written, so the segment a crashed run was writing is readable up to its last page
+- segment names sort in the order they were written (run start time, then segment number)
+"""
+from datetime import datetime, timezone
+import gzip
+import json
+import os
+from pathlib import Path
+import time
+import zlib
+
+SEGMENT_SUFFIX = '.jsonl.gz'
+
+
+def get_raw_page(response):
+	"""JSON-able dict of a tweepy.Response page, its tweepy objects turned back into the raw dicts of the API"""
+	def raw(x):
+		return getattr(x, 'data', x)
+
+	return {
+		'data': [raw(x) for x in response.data or []],
+		'includes': {key: [raw(x) for x in values] for key, values in (response.includes or {}).items()},
+		'errors': response.errors or [],
+		'meta': response.meta or {},
+	}
+
+
+def get_journal_dir(filename):
+	return f'./results/{filename}_journal'
+
+
+class JournalWriter:
+	def __init__(self, directory, pages_per_segment=100):
+		Path(directory).mkdir(parents=True, exist_ok=True)
+		self.directory = directory
+		self.pages_per_segment = pages_per_segment
+		self.run = time.time_ns()
+		self.segment_count = 0
+		self.page_count = 0
+		self.file = None
+
+	def write_page(self, page, request):
+		"""Append a raw page (get_raw_page) and the request (endpoint and parameters) it answered"""
+		if self.file is None:
+			segment_name = f'segment-{self.run}-{self.segment_count:05d}{SEGMENT_SUFFIX}'
+			self.file = gzip.open(os.path.join(self.directory, segment_name), 'ab')
+			self.segment_count += 1
+		record = {'fetched_at': datetime.now(timezone.utc).isoformat(), 'request': request, **page}
+		self.file.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+		self.file.flush(zlib.Z_SYNC_FLUSH)
+		self.page_count += 1
+		if self.page_count % self.pages_per_segment == 0:
+			self.close()
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+
+def get_segments(journal):
+	"""Segment files of a journal directory (and its shard-NNNN/ subdirectories) in the order they were written, or [journal] if it's a segment file"""
+	if os.path.isfile(journal):
+		return [journal]
+	return sorted(str(path) for path in Path(journal).rglob(f'*{SEGMENT_SUFFIX}'))
+
+
+def read_segment(segment):
+	"""Pages of a segment, up to its last complete line if the run writing it was killed"""
+	with gzip.open(segment, 'rb') as file:
+		try:
+			for line in file:
+				if not line.endswith(b'\n'):
+					break
+				yield json.loads(line)
+		except (EOFError, zlib.error, gzip.BadGzipFile):
+			print(f'{segment} ends with an incomplete page, reading it up to there')
+
+
+def add_journal_arguments(p):
+	p.add_argument(
+		'--journal',
+		type=str,
+		help='Directory of the raw API pages journal, to rebuild the corpus later with replay_journal.py. Default: ./results/<filename>_journal',
+	)
+	p.add_argument(
+		'--no-journal',
+		action='store_true',
+		help='Use this to NOT keep the raw API pages',
+	)
+	p.add_argument(
+		'--journal-pages-per-segment',
+		type=int,
+		default=100,
+		help='Number of pages per gzipped segment file of the journal. Default: 100',
+	)
+
+
+def open_journal(args):
+	if args['no_journal']:
+		return None
+	return JournalWriter(args['journal'] or get_journal_dir(args['filename']), args['journal_pages_per_segment'])
@@ -1,4 +1,7 @@
 """
+Fetches the timelines of --user_ids one after the other, or --workers at a time (see timeline_collector.py)
+With --sync, timelines collected before are only fetched since their newest collected tweet
+
 Run:
 0. Fill BEARER_TOKEN in a file called settings.py
 1. Install pandas and tweepy (`$ pip install pandas tweepy`)
@@ -10,13 +13,18 @@ import time
 import os
 import traceback
 from pathlib import Path
-from csv import QUOTE_NONNUMERIC
 from datetime import datetime, timedelta
 
 import tweepy
-import pandas as pd
 
+from collector_checkpoint import get_checkpoint_file_name, get_stream, open_checkpoint, remove_finished_checkpoint, update_checkpoint
 from settings import BEARER_TOKEN
+from timeline_collector import add_timeline_collector_arguments, collect_timelines
+from tweet_files import CorpusWriter, add_corpus_format_arguments, get_corpus_file_name, get_tweet_rows
+from tweet_journal import add_journal_arguments, get_raw_page, open_journal
+
+
+CHECKPOINT_ARGS = ['user_ids', 'from_id', 'until_id', 'from_date', 'to_date', 'max_per_page', 'keep_rt', 'format']  # a checkpoint is resumed by a run with the same ones
 
 
 def search_tweets(args):
@@ -53,145 +61,67 @@ def search_tweets(args):
 
 def process_tweets(client, args, keys_exists):
 
-	first_page = True
-	session_most_recent_id, session_earliest_id = None, None
-
-
-	tweet_count = 0
+	checkpoint_file_name = get_checkpoint_file_name(args['filename'])
+
+
+	writer = CorpusWriter(get_corpus_file_name(args['filename'], args['format']), args['format'], keys_exists or not args['is_first'], args['pages_per_row_group'])
+	checkpoint = open_checkpoint(checkpoint_file_name, {key: args[key] for key in CHECKPOINT_ARGS}, writer)
+	stream = get_stream(checkpoint, args['user_id'])
+	tweet_count, session_earliest_id, session_most_recent_id = stream['tweet_count'], stream['earliest_id'], stream['most_recent_id']
+	if tweet_count or stream['next_token'] or stream['done']:
+		print(f"Resuming from {checkpoint_file_name} after {tweet_count} tweets")
+	journal = open_journal(args)
+	params = dict(
+		user_fields='verified,description,username,created_at,public_metrics',
+		expansions='author_id,referenced_tweets.id,referenced_tweets.id.author_id',
+		tweet_fields='created_at,lang,public_metrics,conversation_id,entities,attachments,referenced_tweets,in_reply_to_user_id',
+		max_results=min(args['max_per_page'], 100), since_id=args['from_id'], until_id=args['until_id'],
+		start_time=args['from_date'], end_time=args['to_date'],
+	)
+	request = {'endpoint': 'get_users_tweets', 'args': [args['user_id']], 'params': params}
 	try:
-		for page in tweepy.Paginator(
-				client.get_users_tweets, args['user_id'],
-				user_fields='verified,description,username,created_at,public_metrics',	
-				expansions='author_id,referenced_tweets.id,referenced_tweets.id.author_id',
-				tweet_fields='created_at,lang,public_metrics,conversation_id,entities,attachments,referenced_tweets,in_reply_to_user_id',
-                max_results=min(args['max_per_page'], 100), since_id=args['from_id'], until_id=args['until_id'],
-                start_time=args['from_date'], end_time=args['to_date'],
-            ):
-
-			tweets = page[0]
-			tweet_list = list()
-			if not tweets:
-				print('No tweets found.')
-				continue
-
-			users = {str(x.id): x.data for x in page[1].get('users', [])}
-			referenced_tweets = {str(x.id): x.data for x in page[1].get('tweets', [])}
-
-			for tweet_obj in tweets:
-				tweet = tweet_obj.data
-				user = users[tweet['author_id']]
-
-				tweet_row = {}
+		pages = [] if stream['done'] else tweepy.Paginator(client.get_users_tweets, args['user_id'], pagination_token=stream['next_token'], **params)
+		for page in pages:
 
-				# meta
-				tweet_row["tweet_id"] = str(tweet["id"])
-				tweet_row["text"] = tweet["text"]
-				tweet_row["created_at"] = tweet["created_at"]
-				tweet_row["lang"] = tweet["lang"]
+			raw_page = get_raw_page(page)
+			if journal is not None:
+				journal.write_page(raw_page, request)
+			if raw_page['data']:
+				tweet_list = get_tweet_rows(raw_page, args['keep_rt'])
+				for tweet_row in tweet_list:
+					if tweet_count == 0:
+						session_most_recent_id = tweet_row["tweet_id"]
+					if args['until_id'] != tweet_row["tweet_id"]:
+						session_earliest_id = tweet_row["tweet_id"]
 
-				# entities
-				tweet_row["hashtags"] = ""
-				tweet_row["user_mentions"] = ""
-				tweet_row["urls"] = ""
+					tweet_count += 1
 
-				if "entities" in tweet:
-					if 'hashtags' in tweet["entities"]:
-						tweet_row["hashtags"] = ','.join([x['tag'] for x in tweet["entities"]["hashtags"]])
-					if 'user_mentions' in tweet["entities"]:
-						tweet_row["user_mentions"] = ','.join([x['username'] for x in tweet["entities"]["mentions"]])
-					if 'urls' in tweet["entities"]:
-						for x in tweet["entities"]["urls"]:
-							urls = []
-							if 'unwound_url' in x:
-								urls.append(x['unwound_url'])
-							elif 'expanded_url' in x:
-								urls.append(x['expanded_url'])
-							else:
-								urls.append(x['url'])
+				writer.write_page(tweet_list)
 
-						tweet_row["urls"] = ','.join(urls)
-						
-				# user data
-				tweet_row["user_screen_name"] = user["username"]
-				tweet_row["user_id"] = user["id"]
-				tweet_row["user_description"] = user["description"]
-				tweet_row["user_following_count"] = user["public_metrics"]["following_count"]
-				tweet_row["user_followers_count"] = user["public_metrics"]["followers_count"]
-				tweet_row["user_total_tweets"] = user["public_metrics"]["tweet_count"]
-				tweet_row["user_created_at"] = user["created_at"]
-				tweet_row["user_verified"] = user["verified"]
-
-				# public metrics per tweet
-				tweet_row["tweet_favorite_count"] = tweet["public_metrics"]["like_count"]
-				tweet_row["tweet_retweet_count"] = tweet["public_metrics"]["retweet_count"]
-				tweet_row["tweet_reply_count"] = tweet["public_metrics"]["reply_count"]
-				tweet_row["tweet_quote_count"] = tweet["public_metrics"]["quote_count"]
-
-				# retweets and replies
-				tweet_row["is_retweet"] = False
-				tweet_row["retweet_id"] = ""
-				tweet_row["retweet_created_at"] = ""
-				tweet_row["is_quote"] = False
-				tweet_row["quote_id"] = ""
-				tweet_row["is_reply"] = False
-				tweet_row["replied_to_tweet_id"] = "" 
-				tweet_row["conversation_id"] = str(tweet["conversation_id"])
-				tweet_row["in_reply_to_user_id"] = ""
-				tweet_row["possibly_sensitive"] = ""
-
-				if 'in_reply_to_user_id' in tweet:
-					tweet_row["in_reply_to_user_id"] = str(tweet["in_reply_to_user_id"])
-				if 'possibly_sensitive' in tweet:
-					tweet_row["possibly_sensitive"] = tweet["possibly_sensitive"]
-
-				if "referenced_tweets" in tweet:
-					if args['keep_rt']:
-						retweets = [x for x in tweet["referenced_tweets"] if x["type"] == "retweeted"]
-						if len(retweets) > 0:
-							retweet_id = retweets[0]["id"]  # there can only be 1 retweeted ref tweet
-							retweet = referenced_tweets[retweet_id]
-							retweet_user = users[retweet['author_id']]
-							tweet_row["is_retweet"] = True
-							tweet_row["retweet_id"] = str(retweet_id)
-							tweet_row["retweet_created_at"] = retweet['created_at']	
-							tweet_row["text"] = "RT @" + retweet_user['username'] + ": " + retweet['text']
-
-					quotes = [x for x in tweet["referenced_tweets"] if x["type"] == "quoted"]
-					if len(quotes) > 0:
-						tweet_row["quote_id"] = str(quotes[0]["id"])
-						tweet_row["is_quote"] = True
-
-					replied_to = [x for x in tweet["referenced_tweets"] if x["type"] == "replied_to"]
-					if len(replied_to) > 0:
-						tweet_row["replied_to_tweet_id"] = str(replied_to[0]["id"])
-						tweet_row["is_reply"] = True
-
-				tweet_row["text"] = tweet_row["text"].strip()
-				tweet_list.append(tweet_row)
-
-				if tweet_count == 0:
-					session_most_recent_id = tweet["id"]
-				if args['until_id'] != tweet["id"]:
-					session_earliest_id = tweet["id"]
-				
-				tweet_count += 1
-
-			tweet_csv = pd.DataFrame(tweet_list)
-			filename = args['filename']
-			if first_page and not keys_exists and args['is_first']:
-				tweet_csv.to_csv(f'./results/{filename}.csv', index=False, mode="w+", encoding="utf-8", quoting=QUOTE_NONNUMERIC)
+				print("Downloaded %d tweets" % tweet_count)
 			else:
-				# should edit header stuff here for adding to the file later
-				tweet_csv.to_csv(f'./results/{filename}.csv', header=False, index=False, mode="a", encoding="utf-8", quoting=QUOTE_NONNUMERIC)
+				print('No tweets found.')
 
-			print("Downloaded %d tweets" % tweet_count)	
-			first_page = False
+			# the page is in the corpus (or buffered for parquet): checkpoint the next one
+			next_token = raw_page['meta'].get('next_token')
+			stream.update(
+				next_token=next_token, done=next_token is None, tweet_count=tweet_count,
+				earliest_id=session_earliest_id, most_recent_id=session_most_recent_id,
+			)
+			update_checkpoint(checkpoint_file_name, checkpoint, writer)
 
 	except KeyboardInterrupt:
 		print("Process terminated. Downloaded %d total tweets. This session's oldest tweet ID was %s and most newest tweet ID was %s" % (tweet_count, session_earliest_id, session_most_recent_id))
-	except:
-		print(traceback.exc_info())
+	except Exception:
+		traceback.print_exc()
 		print("Downloaded %d total tweets. This session's oldest tweet ID was %s and most newest tweet ID was %s" % (tweet_count, session_earliest_id, session_most_recent_id))
+	finally:
+		buffered = bool(writer.pages)
+		writer.close()  # buffered pages of a parquet corpus
+		if buffered:
+			update_checkpoint(checkpoint_file_name, checkpoint, writer)
+		if journal is not None:
+			journal.close()
 
 	return tweet_count, session_earliest_id, session_most_recent_id
 
@@ -245,6 +175,9 @@ if __name__ == '__main__':
 		type=str,
 		help='Format: YYYY-MM-DDTHH:mm:ssZ (ISO 8601/RFC 3339)'
 	)
+	add_corpus_format_arguments(p)
+	add_journal_arguments(p)
+	add_timeline_collector_arguments(p)
 	# default filename here
 	args = vars(p.parse_args())
 
@@ -253,8 +186,14 @@ if __name__ == '__main__':
 
 	args['keep_rt'] = not args['no_keep_rt']
 
+	if args['workers'] or args['sync']:
+		args['workers'] = args['workers'] or 1
+		collect_timelines(args, BEARER_TOKEN)
+		sys.exit()
+
 	args['is_first'] = True
 	for user_id in args['user_ids'].split(','):
 		args['user_id'] = user_id.strip()
 		search_tweets(args)
 		args['is_first'] = False
+	remove_finished_checkpoint(get_checkpoint_file_name(args['filename']))
@@ -0,0 +1,158 @@
+"""
+Compact unique user tracking for get_metrics.py
+
+Screen names are turned into integer keys once (UserKeys) and every tweet/retweet bucket only keeps
+the keys of its distinct users:
+- exact mode: screen names are interned to small ints, stored in a set per bucket
+- approximate mode: screen names are hashed to 64 bit ints, fed to a HyperLogLog sketch per bucket
+  (stays an exact set of hashes until it grows past a few hundred users)
+
+Memory grows with the number of distinct users (per bucket), not with the number of tweets.
+"""
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+class UserKeys:
+	def __init__(self, approximate=False, precision=12):
+		if not 11 <= precision <= 18:
+			raise ValueError('HyperLogLog precision must be between 11 and 18')
+		self.approximate = approximate
+		self.precision = precision
+		self.ids = {}  # screen_name: id (exact mode only)
+
+	def key(self, screen_name):
+		screen_name = str(screen_name)
+		if self.approximate:
+			return hash_screen_name(screen_name)
+		key = self.ids.get(screen_name)
+		if key is None:
+			key = self.ids[screen_name] = len(self.ids)
+		return key
+
+	def keys(self, screen_names):
+		screen_names = screen_names.astype(str)
+		if self.approximate:
+			return pd.util.hash_array(screen_names.values.astype(object)).astype(np.int64)
+		codes, uniques = pd.factorize(screen_names)
+		return np.array([self.key(x) for x in uniques], dtype=np.int64)[codes]
+
+	def screen_names(self):
+		return None if self.approximate else list(self.ids)
+
+	def remap(self, screen_names):
+		"""Map the keys of another UserKeys (given its screen_names()) onto ours, None if keys are already global"""
+		if screen_names is None:
+			return None
+		return np.array([self.key(x) for x in screen_names], dtype=np.int64)
+
+	def new_set(self):
+		return ApproximateUserSet(self.precision) if self.approximate else ExactUserSet()
+
+
+@lru_cache(maxsize=2 ** 16)
+def hash_screen_name(screen_name):
+	return int(pd.util.hash_array(np.array([screen_name], dtype=object)).astype(np.int64)[0])
+
+
+class ExactUserSet:
+	__slots__ = ('keys',)
+
+	def __init__(self):
+		self.keys = set()
+
+	def add(self, key):
+		self.keys.add(key)
+
+	def update(self, keys):
+		self.keys.update(keys.tolist() if isinstance(keys, np.ndarray) else keys)
+
+	def merge(self, other, user_keys=None):
+		if user_keys is None:
+			self.keys.update(other.keys)
+		elif other.keys:
+			self.update(user_keys[np.fromiter(other.keys, dtype=np.int64, count=len(other.keys))])
+
+	def count_not_in(self, other):
+		return len(self.keys.difference(other.keys))
+
+	def __len__(self):
+		return len(self.keys)
+
+
+class ApproximateUserSet:
+	"""
+	HyperLogLog sketch over 64 bit user keys (~1.04 / sqrt(2 ** precision) relative error)
+	Starts as an exact set of keys and switches to 2 ** precision registers once it gets bigger than that is worth
+	"""
+	__slots__ = ('precision', 'keys', 'registers')
+
+	def __init__(self, precision=12):
+		self.precision = precision
+		self.keys = set()
+		self.registers = None
+
+	def add(self, key):
+		if self.registers is None:
+			self.keys.add(key)
+			self._maybe_densify()
+		else:
+			self._add_hashes(np.array([key], dtype=np.int64))
+
+	def update(self, keys):
+		if self.registers is None:
+			self.keys.update(keys.tolist() if isinstance(keys, np.ndarray) else keys)
+			self._maybe_densify()
+		elif isinstance(keys, np.ndarray):
+			self._add_hashes(keys.astype(np.int64))
+		else:
+			self._add_hashes(np.fromiter(keys, dtype=np.int64))
+
+	def merge(self, other, user_keys=None):
+		if other.registers is None:
+			self.update(other.keys)
+		else:
+			self.registers = np.maximum(self._dense_registers(), other.registers)
+			self.keys = set()
+
+	def count_not_in(self, other):
+		if self.registers is None and other.registers is None:
+			return len(self.keys.difference(other.keys))
+		union = ApproximateUserSet(self.precision)
+		union.registers = np.maximum(self._dense_registers(), other._dense_registers())
+		return min(len(self), max(0, len(union) - len(other)))
+
+	def __len__(self):
+		if self.registers is None:
+			return len(self.keys)
+		m = len(self.registers)
+		alpha = 0.7213 / (1 + 1.079 / m)
+		estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+		zeros = int(np.count_nonzero(self.registers == 0))
+		if estimate <= 2.5 * m and zeros:
+			estimate = m * np.log(m / zeros)  # linear counting for small cardinalities
+		return int(round(estimate))
+
+	def _maybe_densify(self):
+		if len(self.keys) > (1 << self.precision) // 32:
+			self.registers = self._dense_registers()
+			self.keys = set()
+
+	def _dense_registers(self):
+		if self.registers is not None:
+			return self.registers
+		registers = np.zeros(1 << self.precision, dtype=np.uint8)
+		if self.keys:
+			self._add_hashes(np.fromiter(self.keys, dtype=np.int64, count=len(self.keys)), registers)
+		return registers
+
+	def _add_hashes(self, hashes, registers=None):
+		registers = self.registers if registers is None else registers
+		hashes = hashes.view(np.uint64)
+		rest_bits = 64 - self.precision  # <= 53 bits, so exact as float64
+		index = (hashes >> np.uint64(rest_bits)).astype(np.intp)
+		rest = (hashes & np.uint64((1 << rest_bits) - 1)).astype(np.float64)
+		bit_length = np.where(rest > 0, np.frexp(rest)[1], 0)
+		np.maximum.at(registers, index, (rest_bits - bit_length + 1).astype(np.uint8))
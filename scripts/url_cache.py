@@ -0,0 +1,139 @@
+"""
+Persistent URL expansion cache shared by get_metrics.py and 2_reanalyze_media.py
+
+Resolved redirect chains are stored in a SQLite file (default: ./results/url_cache.sqlite), keyed by source URL:
+- chain: every hop that was followed (json list), final_url: last hop, domain: last known domain
+- complete: whether the chain ended by itself (no further redirect), so it answers any --max-redirect-depth
+- error: nothing could be resolved. Errors are recorded but never served, so they're always retried
+- resolved_at: timestamp, entries older than the TTL are ignored and cleaned up, together with the oldest
+  entries once the cache holds more than max_entries URLs
+"""
+import json
+import sqlite3
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+
+class URLCache:
+	def __init__(self, path, ttl_days=30, max_entries=5000000):
+		Path(path).parent.mkdir(parents=True, exist_ok=True)
+		self.path = path
+		self.ttl = ttl_days * 24 * 3600
+		self.max_entries = max_entries
+		self.connection = sqlite3.connect(path)
+		self.connection.execute('PRAGMA journal_mode=WAL')
+		self.connection.execute('''CREATE TABLE IF NOT EXISTS urls (
+			url TEXT PRIMARY KEY,
+			chain TEXT NOT NULL,
+			final_url TEXT NOT NULL,
+			domain TEXT NOT NULL,
+			complete INTEGER NOT NULL,
+			error INTEGER NOT NULL,
+			resolved_at REAL NOT NULL
+		)''')
+		self.connection.execute('CREATE INDEX IF NOT EXISTS urls_resolved_at ON urls (resolved_at)')
+		self.connection.commit()
+		self.pending = []
+		self.hits = 0
+		self.misses = 0
+		self.resolved = 0
+		self.resolve_time = 0.0
+
+	def get_many(self, urls, max_redirect_depth):
+		"""Returns {url: (expanded, error, domain)} for the urls that can be answered from the cache"""
+		urls = list(set(urls))
+		found = {}
+		min_resolved_at = time.time() - self.ttl
+		for i in range(0, len(urls), 500):
+			batch = urls[i:i + 500]
+			rows = self.connection.execute(
+				'SELECT url, chain, complete FROM urls WHERE error = 0 AND resolved_at >= ? AND url IN (%s)' % ','.join('?' * len(batch)),
+				[min_resolved_at] + batch,
+			)
+			for url, chain, complete in rows:
+				chain = json.loads(chain)
+				if len(chain) >= max_redirect_depth or complete:
+					found[url] = expand_from_chain(chain, max_redirect_depth)
+		self.hits += len(found)
+		self.misses += len(urls) - len(found)
+		return found
+
+	def add(self, url, chain, complete, elapsed):
+		"""Record a resolution done over the network (written on flush)"""
+		expanded, error, domain = expand_from_chain(chain, len(chain))
+		self.pending.append((url, json.dumps(chain), expanded, domain, int(complete), int(error), time.time()))
+		self.resolved += 1
+		self.resolve_time += elapsed
+
+	def flush(self):
+		if not self.pending:
+			return
+		with self.connection:
+			self.connection.executemany(
+				'INSERT OR REPLACE INTO urls (url, chain, final_url, domain, complete, error, resolved_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+				self.pending,
+			)
+		self.pending = []
+
+	def evict(self):
+		with self.connection:
+			self.connection.execute('DELETE FROM urls WHERE resolved_at < ?', [time.time() - self.ttl])
+			excess = self.connection.execute('SELECT COUNT(*) FROM urls').fetchone()[0] - self.max_entries
+			if excess > 0:
+				self.connection.execute('DELETE FROM urls WHERE url IN (SELECT url FROM urls ORDER BY resolved_at LIMIT ?)', [excess])
+
+	def close(self):
+		self.flush()
+		self.evict()
+		self.connection.close()
+
+	def report(self):
+		lookups = self.hits + self.misses
+		hit_rate = self.hits / lookups * 100 if lookups else 0
+		summary = f'URL cache ({self.path}): {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)'
+		if self.resolved:
+			average = self.resolve_time / self.resolved
+			summary += f', ~{self.hits * average:.0f}s of network time saved (avg {average:.2f}s per resolved URL)'
+		print(summary)
+
+
+def expand_from_chain(chain, max_redirect_depth):
+	expanded = ''
+	domain = ''
+	for hop in chain[:max_redirect_depth]:
+		expanded = hop
+		domain = urlparse(expanded).netloc or domain  # if no domain, keep last known domain
+	return expanded, expanded == '', domain
+
+
+def add_url_cache_arguments(p):
+	p.add_argument(
+		'--url-cache',
+		type=str,
+		default='./results/url_cache.sqlite',
+		help='SQLite file caching expanded URLs across runs and scripts. Default: ./results/url_cache.sqlite',
+	)
+	p.add_argument(
+		'--no-url-cache',
+		action='store_true',
+		help='Use this to always expand URLs over the network',
+	)
+	p.add_argument(
+		'--url-cache-ttl',
+		type=float,
+		default=30,
+		help='Days before a cached URL expansion is resolved again. Default: 30',
+	)
+	p.add_argument(
+		'--url-cache-max-entries',
+		type=int,
+		default=5000000,
+		help='Max number of URLs kept in the cache (oldest are evicted first). Default: 5M',
+	)
+
+
+def open_url_cache(args):
+	if args['no_url_cache']:
+		return None
+	return URLCache(args['url_cache'], args['url_cache_ttl'], args['url_cache_max_entries'])
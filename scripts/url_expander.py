@@ -0,0 +1,161 @@
+"""
+Shared URL expansion scheduler for get_metrics.py and 2_reanalyze_media.py
+
+One URLExpander is opened per run and reused by every chunk:
+- one long-lived aiohttp ClientSession/TCPConnector (keep-alive connections, DNS cache)
+- a global concurrency limit, adapted with AIMD: +1 slot per window of fast successful requests,
+  halved (at most once per window) on errors/timeouts or latency above the target
+- a semaphore per host, so a single shortener (t.co...) never gets all the sockets
+
+Every request/hop of a redirect chain goes through `await expander.fetch(method, url)`, which retries
+overloaded answers (429/5xx), timeouts and connection errors with exponential backoff.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+
+
+class AIMDLimiter:
+	def __init__(self, initial, minimum, maximum, latency_target):
+		self.limit = float(initial)
+		self.minimum = minimum
+		self.maximum = maximum
+		self.latency_target = latency_target
+		self.in_flight = 0
+		self.last_decrease = 0.0
+		self.condition = asyncio.Condition()
+
+	async def acquire(self):
+		async with self.condition:
+			await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+			self.in_flight += 1
+
+	async def release(self, ok, latency):
+		async with self.condition:
+			self.in_flight -= 1
+			now = time.monotonic()
+			if not ok or latency > self.latency_target:
+				if now - self.last_decrease > max(latency, self.latency_target):
+					self.limit = max(self.minimum, self.limit / 2)
+					self.last_decrease = now
+			else:
+				self.limit = min(self.maximum, self.limit + 1 / self.limit)
+			self.condition.notify_all()
+
+
+class Overloaded(Exception):
+	pass
+
+
+class URLExpander:
+	def __init__(self, max_concurrency=100, max_per_host=20, timeout=15, latency_target=3.0, headers=None, retries=2):
+		self.max_concurrency = max_concurrency
+		self.max_per_host = max_per_host
+		self.timeout = timeout
+		self.latency_target = latency_target
+		self.headers = headers
+		self.retries = retries
+		self.session = None
+		self.limiter = None
+		self.hosts = {}
+		self.requests = 0
+		self.errors = 0
+		self.total_latency = 0.0
+
+	async def open(self):
+		connector = aiohttp.TCPConnector(
+			limit=self.max_concurrency,
+			limit_per_host=self.max_per_host,
+			use_dns_cache=True,
+			ttl_dns_cache=600,
+		)
+		self.session = aiohttp.ClientSession(
+			connector=connector,
+			timeout=aiohttp.ClientTimeout(total=self.timeout),
+			headers=self.headers,
+		)
+		initial = max(1, min(self.max_concurrency, self.max_per_host * 2))
+		self.limiter = AIMDLimiter(initial, 1, self.max_concurrency, self.latency_target)
+		return self
+
+	async def close(self):
+		if self.session is not None:
+			await self.session.close()
+			self.session = None
+
+	async def __aenter__(self):
+		return await self.open()
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def fetch(self, method, url, read=None, **kwargs):
+		"""
+		Request url within the concurrency limits, returns (status, headers, read(response) or None)
+		The last error is raised once all retries are used up
+		"""
+		for attempt in range(self.retries + 1):
+			try:
+				async with self.slot(url):
+					async with self.session.request(method, url, **kwargs) as response:
+						if response.status == 429 or response.status >= 500:
+							raise Overloaded(f'{url} answered {response.status}')
+						body = await read(response) if read is not None else None
+						return response.status, response.headers, body
+			except (Overloaded, aiohttp.ClientError, asyncio.TimeoutError):
+				if attempt == self.retries:
+					raise
+				await asyncio.sleep(0.5 * 2 ** attempt)
+
+	@asynccontextmanager
+	async def slot(self, url):
+		host = urlparse(url).netloc
+		if host not in self.hosts:
+			self.hosts[host] = asyncio.Semaphore(self.max_per_host)
+		async with self.hosts[host]:
+			await self.limiter.acquire()
+			start = time.monotonic()
+			ok = False
+			try:
+				yield
+				ok = True
+			finally:
+				latency = time.monotonic() - start
+				self.requests += 1
+				self.errors += not ok
+				self.total_latency += latency
+				await self.limiter.release(ok, latency)
+
+	def report(self):
+		if not self.requests:
+			return
+		print(f'URL expansion: {self.requests} requests, {self.errors} errors, '
+			f'avg latency {self.total_latency / self.requests:.2f}s, concurrency limit ended at {int(self.limiter.limit)}')
+
+
+def add_url_expander_arguments(p):
+	p.add_argument(
+		'--max-concurrency',
+		type=int,
+		default=100,
+		help='Max simultaneous requests when expanding URLs (adapted to observed latency/errors). Default: 100',
+	)
+	p.add_argument(
+		'--max-per-host',
+		type=int,
+		default=20,
+		help='Max simultaneous requests to a single host when expanding URLs. Default: 20',
+	)
+	p.add_argument(
+		'--request-timeout',
+		type=float,
+		default=15,
+		help='Seconds before a single URL expansion request is given up. Default: 15',
+	)
+
+
+def get_url_expander(args, headers=None):
+	return URLExpander(args['max_concurrency'], args['max_per_host'], args['request_timeout'], headers=headers)
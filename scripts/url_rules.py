@@ -0,0 +1,113 @@
+"""
+URL canonicalization rules for 3_process_url_dictionary.py
+
+Rules are read from a JSON file (default: url_rules.json next to this script) and compiled once:
+- strip_queries: tracking parameters removed from every URL (hash set)
+- strip_query_values: parameters removed only for some values, e.g. page=1 (hash set per parameter)
+- redirects: URL prefix + query parameter holding the real URL, compiled into a character trie (one walk per URL)
+- domains: rules looked up by root domain ("domain": "youtu.be") or registered name ("name": "amazon", any suffix):
+	video_id_query: the URL becomes `url` with {id} = the `query` parameter, if present
+	video_id_path: the URL becomes `url` with {id} = the path
+	unwrap_query: the real URL is in the `query` parameter
+	drop_query: the query never identifies the content, drop all of it
+"""
+import json
+import os
+from urllib.parse import urlparse, parse_qs, urljoin, urlencode
+
+DEFAULT_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'url_rules.json')
+
+DOMAIN_ACTIONS = ('video_id_query', 'video_id_path', 'unwrap_query', 'drop_query')
+
+
+class URLRules:
+	def __init__(self, rules):
+		self.strip_queries = frozenset(rules.get('strip_queries', []))
+		self.strip_query_values = {name: frozenset(values) for name, values in rules.get('strip_query_values', {}).items()}
+		self.redirects = {}  # prefix trie: char -> subtree, None -> (rule order, query parameter)
+		for order, redirect in enumerate(rules.get('redirects', [])):
+			node = self.redirects
+			for char in redirect['prefix']:
+				node = node.setdefault(char, {})
+			node.setdefault(None, (order, redirect['query']))
+		self.by_domain = {}  # root domain -> {action: rule}
+		self.by_name = {}  # registered name -> {action: rule}
+		for rule in rules.get('domains', []):
+			if rule['action'] not in DOMAIN_ACTIONS:
+				raise ValueError(f'Unknown URL rule action {rule["action"]!r}, expected one of {", ".join(DOMAIN_ACTIONS)}')
+			if 'domain' in rule:
+				self.by_domain.setdefault(rule['domain'], {}).setdefault(rule['action'], rule)
+			else:
+				self.by_name.setdefault(rule['name'], {}).setdefault(rule['action'], rule)
+		self.resolved = {}
+
+	@classmethod
+	def load(cls, file_name=DEFAULT_RULES_FILE):
+		with open(file_name, encoding='utf-8') as file:
+			return cls(json.load(file))
+
+	def domain_rules(self, root_domain):
+		"""{action: rule} for root_domain, rules by domain override rules by name (resolved once per domain)"""
+		rules = self.resolved.get(root_domain)
+		if rules is None:
+			rules = self.resolved[root_domain] = {
+				**self.by_name.get(root_domain.split('.', 1)[0], {}),
+				**self.by_domain.get(root_domain, {}),
+			}
+		return rules
+
+	def find_redirect(self, url, query):
+		"""Query parameter holding the real URL if url starts with a redirect prefix (first rule wins)"""
+		found = None
+		node = self.redirects
+		for char in url:
+			node = node.get(char)
+			if node is None:
+				break
+			match = node.get(None)
+			if match is not None and match[1] in query and (found is None or match[0] < found[0]):
+				found = match
+		return found[1] if found is not None else None
+
+	def canonicalize(self, url, parsed_url, root_domain):
+		"""Canonical form of url (already parsed, with root_domain its registered domain)"""
+		query = parse_qs(parsed_url.query)
+		rules = self.domain_rules(root_domain)
+
+		# 1. URLs rebuilt from a video id
+		rule = rules.get('video_id_query')
+		if rule is not None and rule['query'] in query:
+			return rule['url'].format(id=query[rule['query']][0])
+		rule = rules.get('video_id_path')
+		if rule is not None:
+			return rule['url'].format(id=parsed_url.path[1:])
+
+		# 2. direct redirect from URL
+		rule = rules.get('unwrap_query')
+		if rule is not None and rule['query'] in query:
+			url = query[rule['query']][0]
+			parsed_url = urlparse(url)
+			query = parse_qs(parsed_url.query)
+		query_keyword = self.find_redirect(url, query)
+		if query_keyword is not None:
+			url = query[query_keyword][0]
+			parsed_url = urlparse(url)
+			query = parse_qs(parsed_url.query)
+
+		# 3. Remove Campaign info
+		if url == parsed_url.path:
+			queryless_url = url
+		else:
+			queryless_url = urljoin(url, parsed_url.path)
+		if not queryless_url.endswith('/'):
+			queryless_url += '/'
+		if 'drop_query' in rules:
+			return queryless_url
+		query = {
+			name: values for name, values in query.items()
+			if name not in self.strip_queries and values[0] not in self.strip_query_values.get(name, ())
+		}
+		if query:
+			querystring = urlencode(query, doseq=True)
+			return queryless_url + f'?{querystring}'
+		return queryless_url